@@ -0,0 +1,320 @@
+# Benchmark for the habitat network tool
+# Builds deterministic synthetic landscapes (a fractal landcover cost
+# surface and clustered habitat patches, written as shapefiles) and
+# times each stage of the habitat network pipeline on them, using the
+# arcpy-free modules, so it runs headless (e.g. on Linux):
+#   python HabitatNetworkBenchmark.py --sizes 1000 5000 --fragmentation 0.25 0.5 0.75
+# The in-memory pipeline needs over 100 bytes a cell at its peak (cost
+# distance), so sizes above MaxInMemorySize are only run tiled, as the
+# tool's tiled pipeline (see HabitatNetworkEngine.LCNTiled):
+#   python HabitatNetworkBenchmark.py --sizes 10000 --tile-size 2048 --workers 4
+# The landscapes themselves are still built whole in memory (untimed),
+# at about 60 bytes a cell, which bounds the sizes that can be run.
+# Results are appended to a results file so they are kept across runs,
+# and each run is compared with a stored baseline (--save-baseline),
+# flagging any stage that has become slower than the tolerance allows.
+#
+#########################################################
+
+
+import argparse, datetime, itertools, json, os, platform, shutil, subprocess, sys, tempfile, time
+import numpy
+
+import HabitatNetworkEngine, HabitatNetworkInstrument, HabitatNetworkShapefile
+
+
+# The stages of the pipeline, in the order they are run, in memory and tiled
+lStages = ["Rasterise", "AreaFilter", "CostDistance", "RegionGroup", "NetworkStats", "Vectorise", "Csv"]
+lTiledStages = ["Rasterise", "LCNTiled", "NetworkStats", "Csv"]
+
+# Sides (in cells) of the largest landscape run in memory; larger ones need a tile size
+MaxInMemorySize = 5000
+
+# Costs of the landcover classes, from the most to the least permeable
+lClassCosts = [1, 2, 5, 10, 50]
+
+pthBenchmark = os.path.join(os.path.dirname(os.path.abspath(__file__)), "benchmark")
+
+
+
+def FractalSurface(nRows, nCols, Fragmentation, rng, BlockRows=1024):
+    """A fractal (value noise) surface: random grids at halving spacings, from the feature size
+    down to single cells, interpolated onto the raster and summed. Fragmentation (0 to 1) sets the
+    feature size, from 256 cells at 0 to 8 cells at 1 (never more than half the raster), and how
+    much the finer grids weigh against the coarser ones, from smooth large clusters at 0 to fine
+    grained noise at 1. As the feature size does not grow with the raster, the number of patches
+    grows with its area. The raster is built a block of rows at a time to bound memory."""
+    arrSurface = numpy.zeros((nRows, nCols), numpy.float32)
+    Persistence = 0.3 + 0.6 * Fragmentation
+    Amplitude = 1.0
+    Step = min(max(nRows, nCols) / 2.0, 2 ** (8 - 5 * Fragmentation))
+    while Step >= 1:
+        arrGrid = rng.rand(int(nRows / Step) + 2, int(nCols / Step) + 2)
+        # Smoothed interpolation weights along each axis
+        arrX = numpy.arange(nCols) / Step
+        arrX0 = arrX.astype(numpy.int64)
+        arrFx = arrX - arrX0
+        arrFx = arrFx * arrFx * (3 - 2 * arrFx)
+        for r0 in range(0, nRows, BlockRows):
+            arrY = numpy.arange(r0, min(r0 + BlockRows, nRows)) / Step
+            arrY0 = arrY.astype(numpy.int64)
+            arrFy = (arrY - arrY0)[:, None]
+            arrFy = arrFy * arrFy * (3 - 2 * arrFy)
+            arrRows = arrGrid[arrY0] * (1 - arrFy) + arrGrid[arrY0 + 1] * arrFy
+            arrSurface[r0:r0 + len(arrY)] += Amplitude * (arrRows[:, arrX0] * (1 - arrFx) + arrRows[:, arrX0 + 1] * arrFx)
+        Amplitude *= Persistence
+        Step /= 2.0
+    return arrSurface
+
+
+def Quantiles(arr, lFractions):
+    """Quantiles of a large array, estimated from a regular sample of its cells"""
+    Skip = max(1, int(numpy.sqrt(arr.size / 1e6)))
+    return numpy.percentile(arr[::Skip, ::Skip], [100 * x for x in lFractions])
+
+
+def SyntheticLandscape(Size, Fragmentation=0.5, HabCover=0.1, Seed=1):
+    """A deterministic synthetic landscape of Size x Size cells: landcover costs (lClassCosts)
+    from a fractal surface cut into equal area classes, and habitat patches from another fractal
+    surface, covering HabCover of the landscape. The same arguments always give the same landscape.
+    Returns the landcover cost array and the habitat array (NaN where there is no habitat)."""
+    rng = numpy.random.RandomState(Seed)
+    arrSurface = FractalSurface(Size, Size, Fragmentation, rng)
+    lBreaks = Quantiles(arrSurface, numpy.arange(1, len(lClassCosts)) / float(len(lClassCosts)))
+    arrCost = numpy.array(lClassCosts, numpy.float64)[numpy.searchsorted(lBreaks, arrSurface)]
+    arrSurface = FractalSurface(Size, Size, Fragmentation, rng)
+    arrHab = numpy.where(arrSurface > Quantiles(arrSurface, [1 - HabCover])[0], 1.0, numpy.nan)
+    return arrCost, arrHab
+
+
+def WriteLandscape(arrCost, arrHab, CellSize, pthOut):
+    """Writes a synthetic landscape as landcover and habitat shapefiles, one polygon per region.
+    The landcover has a COST field. Returns the filenames of the habitat and landcover shapefiles."""
+    geoGrid = HabitatNetworkEngine.GeoArray(None, 0.0, 0.0, CellSize, Shape=arrCost.shape)
+
+    # Each landcover region is a polygon with the cost of its class
+    arrRegions = HabitatNetworkEngine.RegionGroup(arrCost)
+    arrRegionCost = numpy.zeros(int(arrRegions.max()) + 1)
+    arrRegionCost[arrRegions] = arrCost
+    fnLand = os.path.join(pthOut, "Land.shp")
+    HabitatNetworkShapefile.WriteLabelShapefile(geoGrid.Like(arrRegions), fnLand, lExtraFields=[(("COST", "N", 10, 2), arrRegionCost)])
+
+    fnHab = os.path.join(pthOut, "Hab.shp")
+    HabitatNetworkShapefile.WriteLabelShapefile(geoGrid.Like(HabitatNetworkEngine.RegionGroup(arrHab)), fnHab)
+    return fnHab, fnLand
+
+
+
+class StageTimer(object):
+    """Times the stages of a run with HabitatNetworkInstrument: wall and CPU time (with the CPU
+    time of any worker processes apart), and the peak resident memory of this process during the
+    stage (None where the peak cannot be reset for each stage)."""
+    def __init__(self):
+        self.instrument = HabitatNetworkInstrument.Instrument(Enabled=True, WorkerCpu=HabitatNetworkEngine.WorkerCpuTime)
+        self.dicStages = {}
+
+    def Run(self, strStage, func, *args):
+        with self.instrument.Stage(strStage):
+            Result = func(*args)
+        dicStage = self.instrument.lStages[-1]
+        self.dicStages[strStage] = {"Wall": dicStage["Wall"], "CPU": dicStage["CPU"], "WorkerCPU": dicStage["WorkerCPU"],
+                                    "PeakRssBytes": dicStage["PeakRssBytes"]}
+        return Result
+
+
+
+def RunBenchmark(Size, Fragmentation, HabCover, Seed, CellSize, MinHabArea, MaxCost, Nhood, TileSize=0, Workers=1):
+    """Runs every stage of the pipeline on one synthetic landscape, in memory, or with a TileSize
+    a tile at a time over Workers processes (see RunTiled). Returns a dictionary of the parameters,
+    the time and memory of each stage, and the counts of what was found."""
+    pthScratch = tempfile.mkdtemp(prefix="HabitatNetworkBenchmark")
+    try:
+        # Making the landscape is not timed
+        Start = time.time()
+        arrCost, arrHab = SyntheticLandscape(Size, Fragmentation, HabCover, Seed)
+        fnHab, fnLand = WriteLandscape(arrCost, arrHab, CellSize, pthScratch)
+        del arrCost, arrHab
+        SetupTime = time.time() - Start
+
+        timer = StageTimer()
+        if TileSize > 0:
+            dicCounts = RunTiled(timer, fnHab, fnLand, CellSize, MinHabArea, MaxCost, Nhood, TileSize, Workers, pthScratch)
+        else:
+            dicCounts = RunInMemory(timer, fnHab, fnLand, CellSize, MinHabArea, MaxCost, Nhood, pthScratch)
+    finally:
+        shutil.rmtree(pthScratch, ignore_errors=True)
+
+    dicRun = {"Size": Size, "Fragmentation": Fragmentation, "HabCover": HabCover, "Seed": Seed, "CellSize": CellSize,
+              "MinHabArea": MinHabArea, "MaxCost": MaxCost, "Nhood": Nhood, "TileSize": TileSize, "Workers": Workers,
+              "SetupTime": SetupTime, "Stages": timer.dicStages, "Counts": dicCounts}
+    return dicRun
+
+
+def RunInMemory(timer, fnHab, fnLand, CellSize, MinHabArea, MaxCost, Nhood, pthScratch):
+    """Times the stages of the in-memory pipeline (see RunLCNInMemory in the tool) with timer (a
+    StageTimer), writing the outputs to pthScratch. Returns the counts of what was found."""
+    def Rasterise():
+        geoLand = HabitatNetworkShapefile.RasterisePolygons(fnLand, "COST", HabitatNetworkShapefile.ShapefileGrid(fnLand, CellSize))
+        return geoLand, HabitatNetworkShapefile.RasterisePolygons(fnHab, "FID", geoLand)
+    geoLand, geoHab = timer.Run("Rasterise", Rasterise)
+
+    # The same compact types as the in memory run: a mask of the selected habitat and a float32 cost surface
+    arrSelectedHab = timer.Run("AreaFilter", HabitatNetworkEngine.SelectHabByArea, geoHab.arr, MinHabArea, CellSize, Nhood, True)
+    arrCostDist = timer.Run("CostDistance", HabitatNetworkEngine.CostDistance, arrSelectedHab, geoLand.arr, CellSize, MaxCost, Nhood, numpy.float32)
+    del arrSelectedHab
+    arrNetworks, arrHabNetworks, arrHabRegions = timer.Run("RegionGroup", HabitatNetworkEngine.NetworksFromCostDist, arrCostDist, geoHab.arr, Nhood)
+
+    # The output stages as the tool runs them in memory (see WriteLCNOutputs), with the cost statistics
+    dicStats = timer.Run("NetworkStats", HabitatNetworkEngine.NetworkStats, arrNetworks, arrHabNetworks, arrHabRegions, CellSize, arrCostDist)
+    nHabPolygons, nNetPolygons = timer.Run("Vectorise", HabitatNetworkShapefile.WriteNetworkShapefiles, geoLand.Like(arrHabNetworks),
+                                           geoLand.Like(arrNetworks), Nhood, os.path.join(pthScratch, "HabOut.shp"),
+                                           os.path.join(pthScratch, "NetOut.shp"), dicStats)
+    timer.Run("Csv", HabitatNetworkEngine.WriteAreaCsv, os.path.join(pthScratch, "Areas.csv"), dicStats, Nhood)
+
+    return {"Networks": int(arrNetworks.max()), "HabRegions": int(arrHabRegions.max()), "Patches": int(dicStats["PartCount"].sum()),
+            "HabPolygons": nHabPolygons, "NetPolygons": nNetPolygons}
+
+
+def RunTiled(timer, fnHab, fnLand, CellSize, MinHabArea, MaxCost, Nhood, TileSize, Workers, pthScratch):
+    """Times the stages of the tiled pipeline (see RunLCNTiled in the tool) with timer (a StageTimer):
+    the inputs rasterised straight into memory mapped files, the raster stages a tile at a time over
+    Workers processes, and the stats and csv read from the memory mapped label rasters. The tool
+    vectorises tiled outputs through arcpy, so that is not timed. Returns the counts of what was found."""
+    counter = itertools.count()
+    def Scratch(strExt):
+        return os.path.join(pthScratch, "tmp%d.%s" %(next(counter), strExt))
+
+    def Rasterise():
+        geoGrid = HabitatNetworkShapefile.ShapefileGrid(fnLand, CellSize)
+        geoLand, geoHab = HabitatNetworkEngine.NewBil(geoGrid, numpy.float32, Scratch), HabitatNetworkEngine.NewBil(geoGrid, numpy.float32, Scratch)
+        HabitatNetworkShapefile.RasterisePolygons(fnLand, "COST", geoGrid, geoLand.arr)
+        HabitatNetworkShapefile.RasterisePolygons(fnHab, "FID", geoGrid, geoHab.arr)
+        geoLand.arr.flush()
+        geoHab.arr.flush()
+        return geoLand, geoHab
+    geoLand, geoHab = timer.Run("Rasterise", Rasterise)
+
+    dicLayers = timer.Run("LCNTiled", HabitatNetworkEngine.LCNTiled, HabitatNetworkEngine.MemmapReader(geoHab.arr),
+                          HabitatNetworkEngine.MemmapReader(geoLand.arr), geoLand, MaxCost, Nhood, MinHabArea, Scratch, TileSize, Workers)
+    dicStats = timer.Run("NetworkStats", HabitatNetworkEngine.NetworkStats, dicLayers["Networks"].arr, dicLayers["HabNetworks"].arr,
+                         dicLayers["HabRegions"].arr, CellSize, dicLayers["CostDist"].arr)
+    timer.Run("Csv", HabitatNetworkEngine.WriteAreaCsv, os.path.join(pthScratch, "Areas.csv"), dicStats, Nhood)
+
+    return {"Networks": int(dicLayers["Networks"].arr.max()), "HabRegions": int(dicLayers["HabRegions"].arr.max()),
+            "Patches": int(dicStats["PartCount"].sum())}
+
+
+def RunKey(dicRun):
+    """The key of a run's parameters, for comparing it with the baseline"""
+    strKey = "Size=%(Size)s Fragmentation=%(Fragmentation)s HabCover=%(HabCover)s Seed=%(Seed)s CellSize=%(CellSize)s MinHabArea=%(MinHabArea)s MaxCost=%(MaxCost)s Nhood=%(Nhood)s" %dicRun
+    if dicRun.get("TileSize"):
+        strKey += " TileSize=%(TileSize)s Workers=%(Workers)s" %dicRun
+    return strKey
+
+
+def RunStages(dicRun):
+    """The stages of a run, in the order they are run"""
+    return lTiledStages if dicRun.get("TileSize") else lStages
+
+
+def Regressions(dicRun, dicBaseline, Tolerance, MinSeconds=0.05):
+    """The stages of a run that took more than (1 + Tolerance) times their baseline wall time
+    (ignoring differences under MinSeconds, which are noise), as a list of (stage, baseline, time).
+    A change in the counts found is also flagged, as the stage timings would not be comparable."""
+    lRegressions = []
+    dicBase = dicBaseline.get(RunKey(dicRun))
+    if dicBase is None:
+        return lRegressions
+    for strStage in RunStages(dicRun):
+        if strStage in dicBase["Stages"]:
+            Base = dicBase["Stages"][strStage]["Wall"]
+            Time = dicRun["Stages"][strStage]["Wall"]
+            if Time > Base * (1 + Tolerance) and Time - Base > MinSeconds:
+                lRegressions.append((strStage, Base, Time))
+    if dicBase.get("Counts") != dicRun["Counts"]:
+        lRegressions.append(("Counts", dicBase.get("Counts"), dicRun["Counts"]))
+    return lRegressions
+
+
+def GitCommit():
+    """The current git commit of the tool, or None if it is not in a git repository"""
+    try:
+        return subprocess.check_output(["git", "rev-parse", "--short", "HEAD"], cwd=os.path.dirname(os.path.abspath(__file__)),
+                                       stderr=subprocess.STDOUT).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+
+def Main(lArgs=None):
+    parser = argparse.ArgumentParser(description="Times each stage of the habitat network pipeline on synthetic landscapes")
+    parser.add_argument("--sizes", type=int, nargs="+", default=[1000],
+                        help="landscape sizes in cells along each side (e.g. 1000 5000; over %d needs --tile-size)" %MaxInMemorySize)
+    parser.add_argument("--fragmentation", type=float, nargs="+", default=[0.5], help="landscape fragmentation, 0 (large clusters) to 1 (fine grained)")
+    parser.add_argument("--hab-cover", type=float, default=0.1, help="fraction of the landscape that is habitat")
+    parser.add_argument("--seed", type=int, default=1, help="random seed of the landscapes")
+    parser.add_argument("--cell-size", type=float, default=10.0)
+    parser.add_argument("--min-hab-area", type=float, default=1000.0)
+    parser.add_argument("--max-cost", type=float, default=1000.0)
+    parser.add_argument("--nhood", type=int, choices=[4, 8], default=8)
+    parser.add_argument("--tile-size", type=int, default=0, help="run the tiled pipeline with tiles of this many cells along each side (0 runs in memory)")
+    parser.add_argument("--workers", type=int, default=1, help="worker processes of the tiled pipeline")
+    parser.add_argument("--results", default=os.path.join(pthBenchmark, "results.jsonl"), help="file the results of every run are appended to")
+    parser.add_argument("--baseline", default=os.path.join(pthBenchmark, "baseline.json"), help="baseline results to compare with")
+    parser.add_argument("--save-baseline", action="store_true", help="store this run as the baseline")
+    parser.add_argument("--tolerance", type=float, default=0.25, help="fraction slower than the baseline that is flagged as a regression")
+    args = parser.parse_args(lArgs)
+    if args.tile_size <= 0 and max(args.sizes) > MaxInMemorySize:
+        parser.error("sizes over %d cells need --tile-size, as the in-memory pipeline needs over 100 bytes a cell" %MaxInMemorySize)
+
+    dicBaseline = {}
+    if os.path.exists(args.baseline):
+        fBaseline = open(args.baseline)
+        dicBaseline = json.load(fBaseline)
+        fBaseline.close()
+
+    strTime = datetime.datetime.now().isoformat()
+    strCommit = GitCommit()
+    nRegressions = 0
+    for Size in args.sizes:
+        for Fragmentation in args.fragmentation:
+            dicRun = RunBenchmark(Size, Fragmentation, args.hab_cover, args.seed, args.cell_size, args.min_hab_area, args.max_cost, args.nhood,
+                                  args.tile_size, args.workers)
+            dicRun.update({"Time": strTime, "Commit": strCommit, "Python": platform.python_version(), "NumPy": numpy.__version__,
+                           "Platform": platform.platform()})
+
+            # Keep every run
+            if not os.path.exists(os.path.dirname(os.path.abspath(args.results))):
+                os.makedirs(os.path.dirname(os.path.abspath(args.results)))
+            fResults = open(args.results, "a")
+            fResults.write(json.dumps(dicRun, sort_keys=True) + "\n")
+            fResults.close()
+
+            print(RunKey(dicRun))
+            for strStage in RunStages(dicRun):
+                dicStage = dicRun["Stages"][strStage]
+                strPeak = "%10.1f MB peak" %(dicStage["PeakRssBytes"] / 1e6) if dicStage["PeakRssBytes"] is not None else "   peak n/a"
+                strWorkers = " (+%.3f s workers)" %dicStage["WorkerCPU"] if dicStage["WorkerCPU"] else ""
+                print("  %-13s %9.3f s wall %9.3f s cpu %s%s" %(strStage, dicStage["Wall"], dicStage["CPU"], strPeak, strWorkers))
+            print("  %s" %", ".join(["%s %s" %(key, dicRun["Counts"][key]) for key in sorted(dicRun["Counts"])]))
+            for strStage, Base, Time in Regressions(dicRun, dicBaseline, args.tolerance):
+                nRegressions += 1
+                print("  REGRESSION %s: %s (baseline) -> %s" %(strStage, Base, Time))
+
+            if args.save_baseline:
+                dicBaseline[RunKey(dicRun)] = dicRun
+
+    if args.save_baseline:
+        if not os.path.exists(os.path.dirname(os.path.abspath(args.baseline))):
+            os.makedirs(os.path.dirname(os.path.abspath(args.baseline)))
+        fBaseline = open(args.baseline, "w")
+        json.dump(dicBaseline, fBaseline, indent=1, sort_keys=True)
+        fBaseline.close()
+
+    # A non-zero exit status if anything regressed, for use in scripts
+    return 1 if nRegressions else 0
+
+
+
+if __name__ == "__main__":
+    sys.exit(Main())
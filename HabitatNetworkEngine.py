@@ -0,0 +1,1252 @@
+# Array engine for the habitat network tool
+# Native NumPy versions of the raster stages used by RunLCN in
+# HabitatNetworkTool. Nothing in here depends on arcpy, so these
+# functions can be used from the ArcGIS version of Python or from
+# any other Python (2.7 or 3) that has numpy installed.
+#
+# Conventions used throughout:
+#   - rasters are 2D numpy arrays, row 0 at the top (north)
+#   - NoData is NaN in float arrays
+#
+# RegionGroup, SelectHabByArea and NetworkStats, which the ArcGIS file
+# pipeline uses, need numpy 1.6 or later (as shipped with ArcGIS 10.1).
+# Everything else needs numpy 1.8 or later (ArcGIS 10.4). Cost distance
+# uses the compiled Dijkstra of scipy 1.3 or later when it is installed,
+# otherwise a pure Python Dijkstra gives the same result more slowly.
+#
+#########################################################
+
+
+import glob, hashlib, heapq, math, multiprocessing, os
+import numpy
+
+from HabitatNetworkInstrument import CpuTime
+
+try:
+    import scipy.sparse, scipy.sparse.csgraph
+    # Multi-source shortest paths (min_only) came in scipy 1.3
+    if tuple(int(x) for x in scipy.__version__.split(".")[:2]) < (1, 3):
+        scipy = None
+except ImportError:
+    # Not installed with the ArcGIS Desktop version of Python
+    scipy = None
+
+
+# Neighbour offsets (row, col, distance factor) for the 4 and 8 cell neighbourhoods.
+# Diagonal moves are scaled by sqrt(2), as in ArcGIS CostDistance. ArcGIS always
+# uses the 8 cell neighbourhood for cost distance: with 4 the results differ from it.
+dicOffsets = {4: [(-1, 0, 1.0), (1, 0, 1.0), (0, -1, 1.0), (0, 1, 1.0)],
+              8: [(-1, 0, 1.0), (1, 0, 1.0), (0, -1, 1.0), (0, 1, 1.0),
+                  (-1, -1, math.sqrt(2.0)), (-1, 1, math.sqrt(2.0)),
+                  (1, -1, math.sqrt(2.0)), (1, 1, math.sqrt(2.0))]}
+
+
+def _EdgeNeighbours(nRows, nCols, Nhood):
+    """The neighbours of a cell on the raster edge for the expansions in CostDistance and CostAllocation,
+    as a function of a flat cell index returning (index offset, distance factor) pairs of the neighbours
+    inside the raster. Checking the edges this way means no padded copy of the raster is needed."""
+    lOffsets = dicOffsets[Nhood]
+    def Neighbours(i):
+        r, c = divmod(i, nCols)
+        return [(dr * nCols + dc, f) for (dr, dc, f) in lOffsets if 0 <= r + dr < nRows and 0 <= c + dc < nCols]
+    return Neighbours
+
+
+def _FlatCost(arrCost):
+    """The cost raster as a flat array for single cell lookups with .item. Float rasters are used as
+    they are (a float32 cell gives the same float64 value either way), so nothing the size of the
+    raster is copied unless arrCost is a non-contiguous window."""
+    arrCost = numpy.asarray(arrCost)
+    if arrCost.dtype.kind != "f":
+        arrCost = arrCost.astype(numpy.float64)
+    return arrCost.ravel()
+
+
+def _CostGraph(arrFlat, nRows, nCols, CellSize, Nhood):
+    """The moves between cells as a scipy sparse graph for scipy.sparse.csgraph.dijkstra, with
+    the same move costs as CostDistance. Every cell has a slot for each neighbour, so the graph
+    is built straight in compressed rows with no sorting; moves off the raster or to or from
+    NoData cells go nowhere (back to the cell itself) at infinite cost."""
+    n = nRows * nCols
+    lOffsets = dicOffsets[Nhood]
+    arrData = numpy.empty((nRows, nCols, len(lOffsets)))
+    arrData.fill(numpy.inf)
+    arrIndices = numpy.empty((nRows, nCols, len(lOffsets)), numpy.int32)
+    arrIndex = numpy.arange(n, dtype=numpy.int32).reshape(nRows, nCols)
+    arrHalf = numpy.multiply(arrFlat.reshape(nRows, nCols), 0.5 * float(CellSize), dtype=numpy.float64)
+    for k, (dr, dc, f) in enumerate(lOffsets):
+        arrIndices[:, :, k] = arrIndex
+        # The cells with the neighbour at (dr, dc) inside the raster, and those neighbours
+        slA = (slice(max(0, -dr), nRows - max(0, dr)), slice(max(0, -dc), nCols - max(0, dc)))
+        slB = (slice(max(0, dr), nRows - max(0, -dr)), slice(max(0, dc), nCols - max(0, -dc)))
+        arrIndices[slA + (k,)] = arrIndex[slB]
+        arrData[slA + (k,)] = (arrHalf[slA] + arrHalf[slB]) * f
+    del arrIndex, arrHalf
+    arrData = arrData.ravel()
+    arrData[numpy.isnan(arrData)] = numpy.inf
+    arrIndptr = numpy.arange(0, n * len(lOffsets) + 1, len(lOffsets), dtype=numpy.int32)
+    return scipy.sparse.csr_matrix((arrData, arrIndices.ravel(), arrIndptr), shape=(n, n))
+
+
+def CostDistance(arrSource, arrCost, CellSize, MaxCost=None, Nhood=8, dtype=numpy.float64):
+    """Bounded multi-source accumulated cost distance, following arcpy.gp.CostDistance_sa.
+
+    arrSource is a boolean array, True for source cells. arrCost is the cost per
+    unit distance with NaN for NoData (NoData cells are barriers). The cost of moving
+    between adjacent cells is the mean of their costs times the cell size, times
+    sqrt(2) for diagonal moves. Nhood is 8 as in ArcGIS, or 4 for moves along rows and
+    columns only (which ArcGIS does not offer). Expansion stops at MaxCost.
+    With scipy the expansion is scipy.sparse.csgraph.dijkstra over a graph of the whole
+    raster. Without it, only the cells reached are tracked, so the work done and the memory
+    used beyond the output array scale with the area within reach of the sources rather than
+    with the whole raster; it gives the same result, but takes about 10 times as long.
+    Returns an array of accumulated cost, NaN beyond MaxCost or where unreachable. The costs are
+    accumulated in float64 whatever dtype is asked for (e.g. float32, see Compact rasters), and
+    without scipy they are written straight into an array of that type."""
+    nRows, nCols = numpy.shape(arrCost)
+    if not MaxCost or MaxCost <= 0:
+        # As in ArcGIS, no maximum distance means accumulate to the edge of the raster
+        MaxCost = numpy.inf
+    arrFlat = _FlatCost(arrCost)
+    if scipy is not None:
+        arrSeeds = numpy.flatnonzero(arrSource)
+        arrSeeds = arrSeeds[~numpy.isnan(arrFlat[arrSeeds])]
+        if not len(arrSeeds):
+            arrDist = numpy.empty((nRows, nCols), dtype)
+            arrDist.fill(numpy.nan)
+            return arrDist
+        arrDist = scipy.sparse.csgraph.dijkstra(_CostGraph(arrFlat, nRows, nCols, CellSize, Nhood), indices=arrSeeds,
+                                                min_only=True, limit=MaxCost)
+        arrDist[numpy.isinf(arrDist)] = numpy.nan
+        return arrDist.astype(dtype, copy=False).reshape(nRows, nCols)
+    Half = 0.5 * float(CellSize)
+    # Cells in from the edges all have the same neighbours, the first row and column
+    # after the first edge cells and before the last
+    lInner = [(dr * nCols + dc, f) for (dr, dc, f) in dicOffsets[Nhood]]
+    EdgeNeighbours = _EdgeNeighbours(nRows, nCols, Nhood)
+    LastCol, LastInner = nCols - 1, (nRows - 1) * nCols
+
+    # Source cells that fall on NoData in the cost raster are NoData in the output
+    arrSeeds = numpy.flatnonzero(arrSource)
+    lSeeds = arrSeeds[~numpy.isnan(arrFlat[arrSeeds])].tolist()
+
+    # Accumulated cost of each cell reached so far. A dict of only the cells reached,
+    # and single cell lookups in the cost raster, keep the loop below from touching
+    # (or holding Python objects for) the cells out of reach.
+    dicDist = dict.fromkeys(lSeeds, 0.0)
+    item = arrFlat.item
+    get = dicDist.get
+    inf = numpy.inf
+
+    # Multi-source Dijkstra. All seeds start at zero, so the list is already a valid heap.
+    heap = [(0.0, i) for i in lSeeds]
+    heappop, heappush = heapq.heappop, heapq.heappush
+    while heap:
+        d, i = heappop(heap)
+        if d > dicDist[i]:
+            # Stale entry, the cell has already been reached more cheaply
+            continue
+        hi = item(i) * Half
+        c = i % nCols
+        for off, f in (lInner if nCols <= i < LastInner and 0 < c < LastCol else EdgeNeighbours(i)):
+            j = i + off
+            hj = item(j)
+            if hj != hj:
+                # NaN, i.e. NoData barrier
+                continue
+            dNew = d + (hi + hj * Half) * f
+            if dNew <= MaxCost and dNew < get(j, inf):
+                dicDist[j] = dNew
+                heappush(heap, (dNew, j))
+
+    arrDist = numpy.empty(nRows * nCols, dtype)
+    arrDist.fill(numpy.nan)
+    if dicDist:
+        arrDist[numpy.fromiter(dicDist.keys(), numpy.int64, len(dicDist))] = numpy.fromiter(dicDist.values(), numpy.float64, len(dicDist))
+    return arrDist.reshape(nRows, nCols)
+
+
+def CostAllocation(arrZones, arrCost, CellSize, MaxCost=None, Nhood=8):
+    """Bounded multi-source cost distance from labelled sources, following arcpy.sa.CostAllocation.
+
+    arrZones is an integer label array, 0 where there is no source. Every zone is expanded
+    at once in one pass, as in CostDistance, and each cell reached is allocated to the zone
+    it is cheapest to reach from (scipy is used when installed, as in CostDistance; cells
+    exactly as cheap to reach from two zones may be allocated to either). Returns the
+    accumulated cost (float64, NaN beyond MaxCost or where unreachable) and the zone of
+    each cell (0 where not reached, see LabelDType)."""
+    nRows, nCols = numpy.shape(arrCost)
+    if not MaxCost or MaxCost <= 0:
+        MaxCost = numpy.inf
+    arrFlat = _FlatCost(arrCost)
+    if scipy is not None:
+        arrZoneFlat = numpy.asarray(arrZones).ravel()
+        arrSeeds = numpy.flatnonzero(arrZoneFlat)
+        arrSeeds = arrSeeds[~numpy.isnan(arrFlat[arrSeeds])]
+        arrAlloc = numpy.zeros(nRows * nCols, dtype=LabelDType(int(arrZoneFlat[arrSeeds].max()) if len(arrSeeds) else 0))
+        if not len(arrSeeds):
+            return numpy.nan * numpy.empty((nRows, nCols)), arrAlloc.reshape(nRows, nCols)
+        arrDist, arrPred, arrFrom = scipy.sparse.csgraph.dijkstra(_CostGraph(arrFlat, nRows, nCols, CellSize, Nhood), indices=arrSeeds,
+                                                                  min_only=True, limit=MaxCost, return_predecessors=True)
+        del arrPred
+        arrReached = ~numpy.isinf(arrDist)
+        arrDist[~arrReached] = numpy.nan
+        arrAlloc[arrReached] = arrZoneFlat[arrFrom[arrReached]]
+        return arrDist.reshape(nRows, nCols), arrAlloc.reshape(nRows, nCols)
+    Half = 0.5 * float(CellSize)
+    # Cells in from the edges all have the same neighbours, the first row and column
+    # after the first edge cells and before the last
+    lInner = [(dr * nCols + dc, f) for (dr, dc, f) in dicOffsets[Nhood]]
+    EdgeNeighbours = _EdgeNeighbours(nRows, nCols, Nhood)
+    LastCol, LastInner = nCols - 1, (nRows - 1) * nCols
+
+    arrZoneFlat = numpy.asarray(arrZones).ravel()
+    arrSeeds = numpy.flatnonzero(arrZoneFlat)
+    arrSeeds = arrSeeds[~numpy.isnan(arrFlat[arrSeeds])]
+    lSeeds = arrSeeds.tolist()
+
+    # The cells reached so far, as in CostDistance, with the zone each was reached from
+    dicDist = dict.fromkeys(lSeeds, 0.0)
+    dicZone = dict(zip(lSeeds, arrZoneFlat[arrSeeds].tolist()))
+    item = arrFlat.item
+    get = dicDist.get
+    inf = numpy.inf
+
+    # The same expansion as CostDistance, passing the zone on with the cost
+    heap = [(0.0, i) for i in lSeeds]
+    heappop, heappush = heapq.heappop, heapq.heappush
+    while heap:
+        d, i = heappop(heap)
+        if d > dicDist[i]:
+            continue
+        hi = item(i) * Half
+        Zone = dicZone[i]
+        c = i % nCols
+        for off, f in (lInner if nCols <= i < LastInner and 0 < c < LastCol else EdgeNeighbours(i)):
+            j = i + off
+            hj = item(j)
+            if hj != hj:
+                continue
+            dNew = d + (hi + hj * Half) * f
+            if dNew <= MaxCost and dNew < get(j, inf):
+                dicDist[j] = dNew
+                dicZone[j] = Zone
+                heappush(heap, (dNew, j))
+
+    arrDist = numpy.empty(nRows * nCols)
+    arrDist.fill(numpy.nan)
+    arrAlloc = numpy.zeros(nRows * nCols, dtype=LabelDType(max(dicZone.values()) if dicZone else 0))
+    if dicDist:
+        arrReached = numpy.fromiter(dicDist.keys(), numpy.int64, len(dicDist))
+        arrDist[arrReached] = numpy.fromiter(dicDist.values(), numpy.float64, len(dicDist))
+        arrAlloc[arrReached] = numpy.fromiter([dicZone[i] for i in dicDist], numpy.int64, len(dicDist))
+    return arrDist.reshape(nRows, nCols), arrAlloc.reshape(nRows, nCols)
+
+
+class GeoArray(object):
+    """A raster held in memory: a numpy array plus the georeferencing needed to write it out again.
+    SpatialRef is not used by the engine, it is just carried along (e.g. an arcpy SpatialReference)."""
+    def __init__(self, arr, XMin, YMin, CellSize, SpatialRef=None, Shape=None):
+        self.arr = arr
+        self.XMin = XMin
+        self.YMin = YMin
+        self.CellSize = CellSize
+        self.SpatialRef = SpatialRef
+        # The shape only needs giving for a grid with no array (e.g. a raster too big to read in one go)
+        if arr is not None:
+            Shape = arr.shape
+        self.Shape = Shape
+
+    def Like(self, arr):
+        """A new GeoArray for arr on the same grid as this one"""
+        return GeoArray(arr, self.XMin, self.YMin, self.CellSize, self.SpatialRef, self.Shape)
+
+    def Window(self, r0, r1, c0, c1):
+        """The GeoArray of the cells [r0:r1, c0:c1], a view sharing this one's array (not a copy),
+        so changes to either show in both"""
+        arr = self.arr[r0:r1, c0:c1] if self.arr is not None else None
+        return GeoArray(arr, self.XMin + c0 * self.CellSize, self.YMin + (self.nRows - r1) * self.CellSize,
+                        self.CellSize, self.SpatialRef, (r1 - r0, c1 - c0))
+
+    @property
+    def nRows(self):
+        return self.Shape[0]
+
+    @property
+    def nCols(self):
+        return self.Shape[1]
+
+    @property
+    def XMax(self):
+        return self.XMin + self.nCols * self.CellSize
+
+    @property
+    def YMax(self):
+        return self.YMin + self.nRows * self.CellSize
+
+
+def IsData(arr):
+    """Boolean array of the cells that are not NoData.
+    NoData is NaN for float arrays, 0 for integer label arrays and False for boolean masks."""
+    arr = numpy.asarray(arr)
+    if arr.dtype == bool:
+        return arr
+    elif arr.dtype.kind == "f":
+        return ~numpy.isnan(arr)
+    else:
+        return arr != 0
+
+
+def RegionGroup(arr, Nhood=8):
+    """Labels contiguous groups of cells that have the same value, as arcpy.sa.RegionGroup.
+    Labels are numbered from 1 in the order the groups are first met scanning row by row
+    from the top left, with 0 for NoData cells. Returns an array of labels in the narrowest
+    unsigned type that holds them (see LabelDType)."""
+    arr = numpy.asarray(arr)
+    nRows, nCols = arr.shape
+    arrData = IsData(arr)
+    arrIndex = numpy.arange(arr.size, dtype=IndexDType(arr.size)).reshape(arr.shape)
+
+    # Join every pair of neighbouring data cells with the same value. Each pair is only
+    # needed once, so only look right/down (and the two downward diagonals for 8 cells).
+    # The pairs are joined one offset at a time, so only one offset's pairs are held at once.
+    lOffsets = [(0, 1), (1, 0)]
+    if Nhood == 8:
+        lOffsets += [(1, 1), (1, -1)]
+    arrRoot = None
+    for dr, dc in lOffsets:
+        slA, slB = _OffsetSlices(dr, dc, nRows, nCols)
+        same = arrData[slA] & arrData[slB] & (arr[slA] == arr[slB])
+        arrRoot = _UnionFind(arr.size, arrIndex[slA][same], arrIndex[slB][same], arrRoot)
+        del same
+    del arrIndex
+
+    # The root of each group is its first cell in scan order, so numbering the
+    # roots in scan order gives the same numbering as ArcGIS
+    flatData = arrData.ravel()
+    arrNumber = numpy.arange(arr.size, dtype=arrRoot.dtype) == arrRoot
+    arrNumber &= flatData
+    arrNumber = numpy.cumsum(arrNumber, dtype=arrRoot.dtype)
+    nLabels = int(arrNumber[-1]) if arr.size else 0
+    arrLabels = numpy.zeros(arr.size, dtype=LabelDType(nLabels))
+    arrLabels[flatData] = arrNumber[arrRoot[flatData]]
+    return arrLabels.reshape(arr.shape)
+
+
+def _OffsetSlices(dr, dc, nRows, nCols):
+    """Pair of slices giving each cell and its neighbour at (dr, dc), for dr >= 0"""
+    slA = (slice(0, nRows - dr), slice(max(0, -dc), nCols - max(0, dc)))
+    slB = (slice(dr, nRows), slice(max(0, dc), nCols - max(0, -dc)))
+    return slA, slB
+
+
+def _UnionFind(n, arrA, arrB, arrParent=None):
+    """Connected components of the graph on n nodes with edges arrA[k]-arrB[k].
+    Returns the root of each node, the root being the smallest node in its component.
+    More edges can be joined on by passing the roots back in as arrParent (which is
+    overwritten). Vectorised: each round hooks every root onto a smaller root it is
+    joined to, then compresses the paths, so only a handful of rounds are needed for rasters."""
+    if arrParent is None:
+        arrParent = numpy.arange(n, dtype=IndexDType(n))
+    while True:
+        arrPA = arrParent[arrA]
+        arrPB = arrParent[arrB]
+        diff = arrPA != arrPB
+        if not diff.any():
+            return arrParent
+        # Edges already inside one component stay that way, so drop them
+        arrA, arrB = arrA[diff], arrB[diff]
+        arrPA, arrPB = arrPA[diff], arrPB[diff]
+        # Hook the larger root of each edge onto the smaller. A root on several edges is
+        # hooked onto just one of them, but always onto a smaller root, so no cycles are
+        # made and the smallest node of each component stays its root.
+        arrParent[numpy.maximum(arrPA, arrPB)] = numpy.minimum(arrPA, arrPB)
+        del arrPA, arrPB
+        while True:
+            arrGrand = arrParent[arrParent]
+            if numpy.array_equal(arrGrand, arrParent):
+                break
+            arrParent = arrGrand
+
+
+def SelectHabByArea(arrHab, MinHabArea, CellSize, Nhood=8, Mask=False):
+    """Removes habitat patches smaller than MinHabArea, directly on the habitat raster.
+    Patches are region grouped as arcpy.sa.RegionGroup, and their areas counted in one
+    bincount. The result matches the vector route (RegionGroup, RasterToPolygon, Dissolve,
+    Select, PolygonToRaster): the kept patches are numbered 0, 1, 2... in region group
+    order (the FIDs of the selected polygons), and everything else is NaN (float32).
+    If Mask, just the boolean mask of the kept cells is returned, which is all the cost
+    distance needs, at a quarter of the memory."""
+    arrPatches = RegionGroup(arrHab, Nhood)
+    arrArea = numpy.bincount(arrPatches.ravel()) * float(CellSize) ** 2
+    arrKeep = arrArea >= MinHabArea
+    arrKeep[0] = False
+    if Mask:
+        return arrKeep[arrPatches]
+    arrValue = (numpy.cumsum(arrKeep) - 1).astype(numpy.float32)
+    arrValue[~arrKeep] = numpy.nan
+    return arrValue[arrPatches]
+
+
+def NetworkStats(arrNetworks, arrHabNetworks, arrHabRegions, CellSize, arrCostDist=None, BlockRows=1024):
+    """Areas and patch counts of every network from the label rasters, with a bincount over each
+    rather than the geometry of the output polygons. The rasters are read a block of rows at a time,
+    so they can be memmaps of rasters too big for memory. Returns a dictionary of arrays indexed by
+    network label (index 0, NoData, unused): NetCells, NetArea, HabArea and PartCount, plus
+    MeanCost and MaxCost (of the cells of each network) if the cost distance is given."""
+    nNets = int(arrNetworks.max()) + 1
+    nRegions = int(arrHabRegions.max()) + 1
+    arrNetCells = numpy.zeros(nNets, numpy.int64)
+    arrHabCells = numpy.zeros(nNets, numpy.int64)
+    arrCostSum = numpy.zeros(nNets)
+    arrCostMax = numpy.empty(nNets)
+    arrCostMax.fill(numpy.nan)
+    lPairs = []
+    for r0 in range(0, arrNetworks.shape[0], BlockRows):
+        arrNet = numpy.asarray(arrNetworks[r0:r0 + BlockRows]).ravel()
+        arrNetCells += numpy.bincount(arrNet, minlength=nNets)
+        arrHabCells += numpy.bincount(numpy.asarray(arrHabNetworks[r0:r0 + BlockRows]).ravel(), minlength=nNets)
+        # The (network, patch) pairs, to count the patches of each network once all the blocks are in
+        arrRegion = numpy.asarray(arrHabRegions[r0:r0 + BlockRows]).ravel()
+        arrData = (arrNet > 0) & (arrRegion > 0)
+        lPairs.append(numpy.unique(arrNet[arrData].astype(numpy.int64) * nRegions + arrRegion[arrData]))
+        if arrCostDist is not None:
+            arrData = arrNet > 0
+            arrCost = numpy.asarray(arrCostDist[r0:r0 + BlockRows], numpy.float64).ravel()[arrData]
+            arrCostSum += numpy.bincount(arrNet[arrData], weights=arrCost, minlength=nNets)
+            arrCostMax = numpy.fmax(arrCostMax, LabelMax(arrNet[arrData], arrCost, nNets))
+
+    dicStats = {"NetCells": arrNetCells, "NetArea": arrNetCells * float(CellSize) ** 2, "HabArea": arrHabCells * float(CellSize) ** 2,
+                "PartCount": numpy.bincount(numpy.unique(numpy.concatenate(lPairs)) // nRegions, minlength=nNets)}
+    if arrCostDist is not None:
+        with numpy.errstate(invalid="ignore", divide="ignore"):
+            dicStats["MeanCost"] = arrCostSum / arrNetCells
+        dicStats["MaxCost"] = arrCostMax
+    return dicStats
+
+
+
+def WriteAreaCsv(fnCsv, dicStats, Nhood, strHabUnit="undefined", strNetUnit="undefined"):
+    """Writes the csv of the habitat and network areas from the stats of NetworkStats, one row per
+    network in the output shapefile (in GRIDCODE order, so the ID is its FID). With a 4 cell
+    neighbourhood only the networks containing habitat are in the output, so only they are written.
+    If dicStats has the cost distance statistics, they are written too."""
+    arrNets = numpy.nonzero(dicStats["NetCells"])[0]
+    arrNets = arrNets[arrNets > 0]
+    if Nhood == 4:
+        arrNets = arrNets[dicStats["HabArea"][arrNets] > 0]
+    lColumns = [numpy.arange(len(arrNets)), dicStats["NetArea"][arrNets], dicStats["PartCount"][arrNets], dicStats["HabArea"][arrNets]]
+    strHeader = "Network,,Home,\nID,Area (%s^2),Count,Area (%s^2)" %(strHabUnit, strNetUnit)
+    if "MeanCost" in dicStats:
+        lColumns += [dicStats["NetCells"][arrNets], dicStats["MeanCost"][arrNets], dicStats["MaxCost"][arrNets]]
+        strHeader = strHeader.replace("\n", ",Network cost distance,,\n") + ",Cells,Mean,Max"
+
+    # Written in one go
+    fOut = open(fnCsv, "w")
+    fOut.write(strHeader + "\n")
+    fOut.write("".join([",".join([str(x) for x in row]) + "\n" for row in zip(*[arr.tolist() for arr in lColumns])]))
+    fOut.close()
+
+
+def LabelMax(arrLabels, arrValues, nLabels):
+    """The maximum of arrValues for each label of arrLabels (NaN values ignored), as an array
+    indexed by label, NaN for labels with no values. Found by sorting on the label and reducing
+    each run (numpy.maximum.at would do, but needs numpy 1.8)."""
+    arrMax = numpy.empty(nLabels)
+    arrMax.fill(numpy.nan)
+    arrData = ~numpy.isnan(arrValues)
+    arrLabels, arrValues = arrLabels[arrData], arrValues[arrData]
+    if len(arrLabels) == 0:
+        return arrMax
+    arrOrder = numpy.argsort(arrLabels, kind="mergesort")
+    arrLabels = arrLabels[arrOrder]
+    arrStart = numpy.flatnonzero(numpy.concatenate(([True], arrLabels[1:] != arrLabels[:-1])))
+    arrMax[arrLabels[arrStart]] = numpy.maximum.reduceat(arrValues[arrOrder], arrStart)
+    return arrMax
+
+
+def NetworksFromCostDist(arrCostDist, arrHab, Nhood=8, MaxCost=None):
+    """The networks, the habitat labelled by network, and the habitat regions, from a cost distance surface.
+    Networks are region groups of the cells within the cost distance. If MaxCost is given only
+    cells within MaxCost count, so a surface calculated for a larger maximum distance can be
+    reused for a smaller one. Returns three label arrays (see LabelDType) with 0 for NoData."""
+    if MaxCost:
+        # NaN compares False, so NoData is left out in the same pass
+        with numpy.errstate(invalid="ignore"):
+            arrWithin = arrCostDist <= MaxCost
+    else:
+        arrWithin = ~numpy.isnan(arrCostDist)
+    arrNetworks = RegionGroup(arrWithin, Nhood)
+    # Label the habitat cells with the network they are in (as Con + Plus in RunLCN)
+    arrHabNetworks = numpy.where(arrHab >= 0, arrNetworks, 0)
+    arrHabRegions = RegionGroup(arrHabNetworks, Nhood)
+    return arrNetworks, arrHabNetworks, arrHabRegions
+
+
+#########################################################
+# Compact rasters
+# Each stage keeps its rasters in the narrowest type that holds them: masks
+# as bool (a byte a cell, or bit packed on disk), labels as the smallest
+# unsigned integer for the number of labels, and cost surfaces as float32
+# with NaN for NoData rather than a separate mask. For a 20000 x 20000 grid
+# that is 0.4 GB a mask, 0.8-1.6 GB a label raster and 1.6 GB a cost surface,
+# against 3.2 GB for each as float64. The engine's algorithms still work in
+# float64 internally, where the accumulated costs need the precision, and
+# their working memory is well above the rasters they return. Measured per
+# raster cell: RegionGroup about 35 bytes (joining one neighbour offset at a
+# time), CostDistance about 120 bytes with scipy (the graph of moves over the
+# whole raster) or 123 bytes a cell reached without. An in-memory run of a
+# 20000 x 20000 grid mostly within reach so needs nearer 50 GB for the cost
+# distance, and grids that size are best run tiled (see LCNTiled), where
+# these costs are per tile.
+
+def IndexDType(n):
+    """The integer type for indices into n cells"""
+    return numpy.int32 if n < 2 ** 31 else numpy.int64
+
+
+def LabelDType(nLabels):
+    """The narrowest unsigned type for labels 0 to nLabels. Beyond uint32 this is int64,
+    as mixing uint64 with signed integers gives floats."""
+    for dtype in (numpy.uint8, numpy.uint16, numpy.uint32):
+        if nLabels <= numpy.iinfo(dtype).max:
+            return dtype
+    return numpy.int64
+
+
+def PackMask(arrMask):
+    """Bit packs a boolean mask, eight cells a byte (see UnpackMask)"""
+    return numpy.packbits(numpy.asarray(arrMask, dtype=bool).ravel())
+
+
+def UnpackMask(arrPacked, Shape):
+    """The boolean mask of the given shape from PackMask"""
+    nCells = int(numpy.prod(Shape))
+    return numpy.unpackbits(arrPacked)[:nCells].astype(bool).reshape(Shape)
+
+
+
+#########################################################
+# Connectivity between networks
+# One cost allocation from every network at once splits the landscape into
+# the cells cheapest to reach from each network. Two networks are linked
+# where their cells meet, so the links form a sparse graph found in a single
+# pass, rather than a cost distance run for every pair of networks.
+
+def ZoneLinks(arrDist, arrAlloc, arrCost, CellSize, Nhood=8, MaxCost=None):
+    """The least-cost links between the zones of a cost allocation (see CostAllocation).
+    Where a cell allocated to zone a neighbours a cell allocated to zone b, the cheapest path
+    from a to b through the two cells costs the accumulated cost of each plus the move between
+    them. The cheapest such crossing over all the cells where a and b meet is the cost of the link.
+    Returns a dictionary of arrays with one entry per linked pair of zones: From and To (From < To),
+    Cost, and Row and Col, the position of the crossing (midway between the two cell centres, in
+    cells from the top left corner of the raster). If the allocation was bounded by a MaxCost, give
+    it here too: links dearer than MaxCost are dropped, as their cheapest crossing may not have been
+    reached, and those left are exactly the links of an unbounded allocation up to MaxCost."""
+    arrCost = numpy.asarray(arrCost, dtype=numpy.float64)
+    nRows, nCols = arrAlloc.shape
+    lFrom, lTo, lLinkCost, lRow, lCol = [], [], [], [], []
+    # Each pair of neighbours once, so only the offsets pointing down or right
+    for dr, dc, f in dicOffsets[Nhood]:
+        if dr < 0 or (dr == 0 and dc < 0):
+            continue
+        slA, slB = _OffsetSlices(dr, dc, nRows, nCols)
+        arrA, arrB = arrAlloc[slA], arrAlloc[slB]
+        arrMeet = (arrA != arrB) & (arrA > 0) & (arrB > 0)
+        if not arrMeet.any():
+            continue
+        arrR, arrC = numpy.nonzero(arrMeet)
+        arrA, arrB = arrA[arrMeet], arrB[arrMeet]
+        lFrom.append(numpy.minimum(arrA, arrB))
+        lTo.append(numpy.maximum(arrA, arrB))
+        lLinkCost.append(arrDist[slA][arrMeet] + arrDist[slB][arrMeet] + (arrCost[slA][arrMeet] + arrCost[slB][arrMeet]) * (0.5 * float(CellSize) * f))
+        # Cells of the slices are offset from the raster by the start of slA
+        lRow.append(arrR + 0.5 + 0.5 * dr)
+        lCol.append(arrC + slA[1].start + 0.5 + 0.5 * dc)
+    return _CheapestLinks(lFrom, lTo, lLinkCost, lRow, lCol, MaxCost)
+
+
+def _CheapestLinks(lFrom, lTo, lLinkCost, lRow, lCol, MaxCost=None):
+    """The cheapest of the crossings (lists of arrays, as in ZoneLinks) of each pair of zones,
+    as the dictionary of ZoneLinks, dropping those dearer than MaxCost if given"""
+    if not lFrom:
+        return {"From": numpy.zeros(0, numpy.int32), "To": numpy.zeros(0, numpy.int32), "Cost": numpy.zeros(0),
+                "Row": numpy.zeros(0), "Col": numpy.zeros(0)}
+
+    # Sort by pair then cost, and keep the cheapest crossing of each pair
+    arrFrom, arrTo, arrLinkCost = numpy.concatenate(lFrom), numpy.concatenate(lTo), numpy.concatenate(lLinkCost)
+    arrOrder = numpy.lexsort((arrLinkCost, arrTo, arrFrom))
+    arrFrom, arrTo = arrFrom[arrOrder], arrTo[arrOrder]
+    arrFirst = numpy.ones(len(arrOrder), dtype=bool)
+    arrFirst[1:] = (arrFrom[1:] != arrFrom[:-1]) | (arrTo[1:] != arrTo[:-1])
+    arrOrder = arrOrder[arrFirst]
+    arrFrom, arrTo, arrLinkCost = arrFrom[arrFirst], arrTo[arrFirst], arrLinkCost[arrOrder]
+    arrRow, arrCol = numpy.concatenate(lRow)[arrOrder], numpy.concatenate(lCol)[arrOrder]
+    if MaxCost:
+        arrKeep = arrLinkCost <= MaxCost
+        arrFrom, arrTo, arrLinkCost, arrRow, arrCol = arrFrom[arrKeep], arrTo[arrKeep], arrLinkCost[arrKeep], arrRow[arrKeep], arrCol[arrKeep]
+    return {"From": arrFrom, "To": arrTo, "Cost": arrLinkCost, "Row": arrRow, "Col": arrCol}
+
+
+def LabelCentroids(arrLabels, BlockRows=1024):
+    """The centre of each label (the mean row and column of its cell centres, in cells from the top
+    left corner of the raster), read a block of rows at a time as NetworkStats.
+    Returns two float arrays indexed by label, NaN for absent labels."""
+    nLabels = int(arrLabels.max()) + 1
+    arrCount = numpy.zeros(nLabels)
+    arrRowSum = numpy.zeros(nLabels)
+    arrColSum = numpy.zeros(nLabels)
+    for r0 in range(0, arrLabels.shape[0], BlockRows):
+        arrBlock = numpy.asarray(arrLabels[r0:r0 + BlockRows])
+        arrR, arrC = numpy.nonzero(arrBlock)
+        arrL = arrBlock[arrR, arrC]
+        arrCount += numpy.bincount(arrL, minlength=nLabels)
+        arrRowSum += numpy.bincount(arrL, weights=arrR + r0 + 0.5, minlength=nLabels)
+        arrColSum += numpy.bincount(arrL, weights=arrC + 0.5, minlength=nLabels)
+    with numpy.errstate(invalid="ignore", divide="ignore"):
+        return arrRowSum / arrCount, arrColSum / arrCount
+
+
+def LabelBoxes(arrLabels, nLabels=None, BlockRows=1024):
+    """The bounding box of each label, as arrays of the first and last + 1 rows and columns
+    (r0, r1, c0, c1) indexed by label, read a block of rows at a time as NetworkStats.
+    Labels of nLabels or more are left out. Absent labels have empty boxes (r0 >= r1)."""
+    nRows, nCols = arrLabels.shape
+    if nLabels is None:
+        nLabels = int(arrLabels.max()) + 1
+    arrR0, arrC0 = numpy.full(nLabels, nRows, numpy.int64), numpy.full(nLabels, nCols, numpy.int64)
+    arrR1, arrC1 = numpy.zeros(nLabels, numpy.int64), numpy.zeros(nLabels, numpy.int64)
+    for r0 in range(0, nRows, BlockRows):
+        arrBlock = numpy.asarray(arrLabels[r0:r0 + BlockRows])
+        arrR, arrC = numpy.nonzero((arrBlock > 0) & (arrBlock < nLabels))
+        arrL = arrBlock[arrR, arrC]
+        arrR += r0
+        numpy.minimum.at(arrR0, arrL, arrR)
+        numpy.minimum.at(arrC0, arrL, arrC)
+        numpy.maximum.at(arrR1, arrL, arrR + 1)
+        numpy.maximum.at(arrC1, arrL, arrC + 1)
+    return arrR0, arrR1, arrC0, arrC1
+
+
+def PatchNetworks(arrNetworks, arrPatches, BlockRows=1024):
+    """The network of each patch (e.g. each habitat region), with the cells in each patch and in
+    each network, read a block of rows at a time as NetworkStats. Returns three arrays: the network
+    of each patch and the cells of each patch, indexed by patch label (network 0 for absent patches),
+    and the cells of each network, indexed by network label."""
+    arrPatchNet = numpy.zeros(int(arrPatches.max()) + 1, numpy.int64)
+    arrPatchCells = numpy.zeros(len(arrPatchNet), numpy.int64)
+    arrNetCells = numpy.zeros(int(arrNetworks.max()) + 1, numpy.int64)
+    for r0 in range(0, arrNetworks.shape[0], BlockRows):
+        arrNet = numpy.asarray(arrNetworks[r0:r0 + BlockRows]).ravel()
+        arrPatch = numpy.asarray(arrPatches[r0:r0 + BlockRows]).ravel()
+        arrNetCells += numpy.bincount(arrNet, minlength=len(arrNetCells))
+        arrPatchCells += numpy.bincount(arrPatch, minlength=len(arrPatchCells))
+        arrData = arrPatch > 0
+        arrPatchNet[arrPatch[arrData]] = arrNet[arrData]
+    return arrPatchNet, arrPatchCells, arrNetCells
+
+
+def PatchLinks(arrNetworks, arrPatches, ReadCost, CellSize, Nhood=8, BlockRows=1024):
+    """The least-cost links between the habitat patches in each network, as ZoneLinks, from one
+    cost allocation per network over its own cells (so bounded by the network's window), with the
+    patches (e.g. the habitat regions) as the zones. Networks with a single patch are skipped.
+    The cost is given by a window reader (see ArrayReader), and only each network's window of it
+    is read, and the label rasters are read a block of rows at a time as NetworkStats, so with
+    memmaps of them nothing is held whole.
+    Returns a dictionary of arrays as ZoneLinks, with the Network of each link added."""
+    nRegions = int(arrPatches.max()) + 1
+    # Patches in each network, from the unique (network, patch) pairs of each block of rows
+    lPairs = []
+    for r0 in range(0, arrNetworks.shape[0], BlockRows):
+        arrNet = numpy.asarray(arrNetworks[r0:r0 + BlockRows]).ravel()
+        arrPatch = numpy.asarray(arrPatches[r0:r0 + BlockRows]).ravel()
+        arrData = (arrNet > 0) & (arrPatch > 0)
+        lPairs.append(numpy.unique(arrNet[arrData].astype(numpy.int64) * nRegions + arrPatch[arrData]))
+    arrPairs = numpy.unique(numpy.concatenate(lPairs))
+    arrPatchCount = numpy.bincount(arrPairs // nRegions, minlength=int(arrNetworks.max()) + 1)
+    arrR0, arrR1, arrC0, arrC1 = LabelBoxes(arrNetworks, len(arrPatchCount), BlockRows)
+
+    dicLinks = {"Network": [], "From": [], "To": [], "Cost": [], "Row": [], "Col": []}
+    for Network in numpy.nonzero(arrPatchCount > 1)[0].tolist():
+        r0, r1, c0, c1 = arrR0[Network], arrR1[Network], arrC0[Network], arrC1[Network]
+        arrIn = arrNetworks[r0:r1, c0:c1] == Network
+        arrWindowCost = numpy.where(arrIn, ReadCost(r0, r1, c0, c1), numpy.nan)
+        arrDist, arrAlloc = CostAllocation(numpy.where(arrIn, arrPatches[r0:r1, c0:c1], 0), arrWindowCost, CellSize, None, Nhood)
+        dicNet = ZoneLinks(arrDist, arrAlloc, arrWindowCost, CellSize, Nhood)
+        dicNet["Row"] = dicNet["Row"] + r0
+        dicNet["Col"] = dicNet["Col"] + c0
+        dicNet["Network"] = numpy.full(len(dicNet["From"]), Network, numpy.int32)
+        for key in dicLinks:
+            dicLinks[key].append(dicNet[key])
+    if not dicLinks["From"]:
+        return {"Network": numpy.zeros(0, numpy.int32), "From": numpy.zeros(0, numpy.int32), "To": numpy.zeros(0, numpy.int32),
+                "Cost": numpy.zeros(0), "Row": numpy.zeros(0), "Col": numpy.zeros(0)}
+    return dict([(key, numpy.concatenate(dicLinks[key])) for key in dicLinks])
+
+
+def LeastCostCorridors(arrZones, ReadCost, CellSize, arrFrom, arrTo, arrLinkCost, PercentLCP, Nhood=8, BlockRows=1024):
+    """Least-cost corridors between linked zones (e.g. the links from ZoneLinks), as arcpy.sa.Corridor.
+    The cost distance from each zone is calculated once and shared by every corridor the zone is in.
+    The corridor from a to b is the sum of the cost distances from a and from b: its minimum is the
+    cost of the least-cost path, and the cells kept are those within PercentLCP percent of it.
+    Each zone's cost distance is only calculated as far as its dearest corridor can reach (the link
+    cost plus PercentLCP percent), in a window around the zone no bigger than the cheapest possible
+    path to that cost can cross, and it is dropped once its last corridor is done. The cost is given
+    by a window reader (see ArrayReader) and only read a window at a time, and the zones are read a
+    block of rows at a time, so they can be memmaps of rasters too big for memory.
+    Yields a dictionary for each corridor, in link order: From, To, LCP (the least-cost path cost),
+    Window (r0, r1, c0, c1, the rows and columns holding the corridor) and PathCost (an array over
+    the window of the cost of the cheapest path from a to b through each cell, NaN outside the corridor)."""
+    nRows, nCols = arrZones.shape
+    if len(arrFrom) == 0:
+        return
+    # Cells on the least-cost path itself are kept whatever the rounding
+    Slack = 1.0 + PercentLCP / 100.0 + 1e-9
+    nZones = int(max(arrFrom.max(), arrTo.max())) + 1
+
+    # How far each zone's cost distance needs to go, for the dearest corridor it is in
+    arrBound = numpy.zeros(nZones)
+    numpy.maximum.at(arrBound, arrFrom, arrLinkCost * Slack)
+    numpy.maximum.at(arrBound, arrTo, arrLinkCost * Slack)
+    arrR0, arrR1, arrC0, arrC1 = LabelBoxes(arrZones, nZones, BlockRows)
+    # No move costs less than a straight step over the cheapest cells
+    MinStep = min([_NanMinTile((ReadCost, bounds)) for bounds in Tiles(nRows, nCols, BlockRows)]) * float(CellSize)
+
+    # Corridors still to do for each zone, so its cost distance can be dropped after its last one
+    arrLeft = numpy.bincount(arrFrom, minlength=nZones) + numpy.bincount(arrTo, minlength=nZones)
+    dicSurfaces = {}
+    def Surface(Zone):
+        if Zone not in dicSurfaces:
+            if MinStep > 0:
+                Reach = int(math.ceil(arrBound[Zone] / MinStep)) + 1
+            else:
+                Reach = max(nRows, nCols)
+            r0, r1 = max(0, arrR0[Zone] - Reach), min(nRows, arrR1[Zone] + Reach)
+            c0, c1 = max(0, arrC0[Zone] - Reach), min(nCols, arrC1[Zone] + Reach)
+            arrDist = CostDistance(arrZones[r0:r1, c0:c1] == Zone, numpy.asarray(ReadCost(r0, r1, c0, c1), numpy.float64), CellSize, arrBound[Zone], Nhood)
+            dicSurfaces[Zone] = (r0, r1, c0, c1, arrDist)
+        return dicSurfaces[Zone]
+
+    for From, To in zip(arrFrom.tolist(), arrTo.tolist()):
+        ar0, ar1, ac0, ac1, arrDistA = Surface(From)
+        br0, br1, bc0, bc1, arrDistB = Surface(To)
+        for Zone in (From, To):
+            arrLeft[Zone] -= 1
+            if arrLeft[Zone] == 0:
+                del dicSurfaces[Zone]
+
+        # The sum of the two cost distances where both windows overlap
+        r0, r1, c0, c1 = max(ar0, br0), min(ar1, br1), max(ac0, bc0), min(ac1, bc1)
+        if r0 >= r1 or c0 >= c1:
+            continue
+        arrPath = arrDistA[r0 - ar0:r1 - ar0, c0 - ac0:c1 - ac0] + arrDistB[r0 - br0:r1 - br0, c0 - bc0:c1 - bc0]
+        arrIn = ~numpy.isnan(arrPath)
+        if not arrIn.any():
+            continue
+        LCP = arrPath[arrIn].min()
+        arrIn[arrIn] = arrPath[arrIn] <= LCP * Slack
+        arrPath[~arrIn] = numpy.nan
+
+        # Trim the window to the corridor
+        arrRows, arrCols = numpy.nonzero(arrIn.any(axis=1))[0], numpy.nonzero(arrIn.any(axis=0))[0]
+        yield {"From": From, "To": To, "LCP": LCP,
+               "Window": (r0 + arrRows[0], r0 + arrRows[-1] + 1, c0 + arrCols[0], c0 + arrCols[-1] + 1),
+               "PathCost": arrPath[arrRows[0]:arrRows[-1] + 1, arrCols[0]:arrCols[-1] + 1]}
+
+
+#########################################################
+# Cache
+# Rasterised inputs, filtered habitat and cost surfaces kept on disk between
+# runs, so a repeat run (or one where only the outputs changed) can skip the
+# stages whose inputs have not changed.
+
+# Hashes of files already read in this session, by (filename, size, modified time)
+dicFileHashes = {}
+
+def HashFile(fn):
+    """Hash of the contents of a file and its sidecar files (the .dbf, .shx, .prj... of a
+    shapefile, the .tfw of a tif), or of every file in a directory (e.g. an ESRI grid)"""
+    if os.path.isdir(fn):
+        lFiles = sorted(os.path.join(pth, f) for (pth, lDirs, lNames) in os.walk(fn) for f in lNames)
+    else:
+        pth, strName = os.path.split(os.path.abspath(fn))
+        strRoot = os.path.splitext(strName)[0]
+        lFiles = sorted(os.path.join(pth, f) for f in os.listdir(pth) if os.path.splitext(f)[0] == strRoot and not f.endswith(".lock"))
+    hash = hashlib.sha1()
+    for f in lFiles:
+        key = (f, os.path.getsize(f), os.path.getmtime(f))
+        if key not in dicFileHashes:
+            hashFile = hashlib.sha1()
+            fIn = open(f, "rb")
+            for block in iter(lambda: fIn.read(1024 * 1024), b""):
+                hashFile.update(block)
+            fIn.close()
+            dicFileHashes[key] = hashFile.hexdigest()
+        hash.update(("%s %s\n" %(os.path.splitext(f)[1].lower(), dicFileHashes[key])).encode("utf-8"))
+    return hash.hexdigest()
+
+
+# Version of what the engine makes, part of every cache key. Bump it whenever a change to the
+# engine changes what a cached stage would hold, so entries made before are not reused.
+CacheVersion = 2
+
+class Cache(object):
+    """Content-addressed on-disk cache of GeoArrays, limited to MaxBytes by removing the least
+    recently used entries. Entries are keyed by a hash of the contents of the input files and
+    the parameters they were made with, and CacheVersion (see Key), so a changed input,
+    parameter or engine just misses.
+    With no directory (pthCache None) nothing is kept and every entry is made afresh.
+    The spatial reference of a GeoArray is not kept."""
+    def __init__(self, pthCache, MaxBytes=4 * 1024 ** 3):
+        self.pthCache = pthCache
+        self.MaxBytes = MaxBytes
+        self.nHits = 0
+        self.nMisses = 0
+        if pthCache is not None and not os.path.exists(pthCache):
+            os.makedirs(pthCache)
+
+    def Key(self, *args):
+        """Key for an entry made from the given parameters (pass input files through HashFile)"""
+        return hashlib.sha1("|".join([str(x) for x in (CacheVersion,) + args]).encode("utf-8")).hexdigest()
+
+    def Get(self, key):
+        """The GeoArray for key, or None if it is not in the cache"""
+        if self.pthCache is None:
+            return None
+        fn = os.path.join(self.pthCache, key + ".npz")
+        if not os.path.exists(fn):
+            self.nMisses += 1
+            return None
+        # The modified time marks when an entry was last used, for the eviction
+        os.utime(fn, None)
+        npz = numpy.load(fn)
+        XMin, YMin, CellSize = npz["grid"]
+        if "shape" in npz.files:
+            # A bit packed mask
+            geo = GeoArray(UnpackMask(npz["arr"], tuple(npz["shape"])), XMin, YMin, CellSize)
+        else:
+            geo = GeoArray(npz["arr"], XMin, YMin, CellSize)
+        npz.close()
+        self.nHits += 1
+        return geo
+
+    def Put(self, key, geo):
+        """Adds a GeoArray to the cache, then removes old entries if it is over size"""
+        if self.pthCache is None:
+            return
+        # Write to a temporary name first, so a half written entry is never read
+        fn = os.path.join(self.pthCache, key + ".npz")
+        fnTmp = os.path.join(self.pthCache, key + ".tmp.npz")
+        grid = numpy.array([geo.XMin, geo.YMin, geo.CellSize], dtype=numpy.float64)
+        if geo.arr.dtype == bool:
+            # Masks are kept bit packed, an eighth of the size
+            numpy.savez(fnTmp, arr=PackMask(geo.arr), shape=numpy.array(geo.arr.shape), grid=grid)
+        else:
+            numpy.savez(fnTmp, arr=geo.arr, grid=grid)
+        if os.path.exists(fn):
+            os.remove(fn)
+        os.rename(fnTmp, fn)
+        self.Evict()
+
+    def GetOrMake(self, key, Make):
+        """The GeoArray for key from the cache, or from calling Make() (and then cached)"""
+        geo = self.Get(key)
+        if geo is None:
+            geo = Make()
+            self.Put(key, geo)
+        return geo
+
+    def Evict(self):
+        """Removes the least recently used entries until the cache is within MaxBytes"""
+        lEntries = sorted((os.path.getmtime(f), os.path.getsize(f), f) for f in glob.glob(os.path.join(self.pthCache, "*.npz")))
+        nBytes = sum([entry[1] for entry in lEntries])
+        for Time, Size, f in lEntries:
+            if nBytes <= self.MaxBytes:
+                break
+            os.remove(f)
+            nBytes -= Size
+
+    def Report(self):
+        """Summary of cache use"""
+        return "Cache: %s hits, %s misses" %(self.nHits, self.nMisses)
+
+#########################################################
+# Tiled processing
+# For rasters too big to hold in memory. Rasters are read a window at a time
+# through a reader function, ReadWindow(r0, r1, c0, c1), returning the cells
+# [r0:r1, c0:c1] with NoData as NaN. Intermediate rasters are kept in memory
+# mapped ESRI BIL files (which ArcGIS can read directly) rather than in RAM.
+# The work on each tile can be spread over a pool of worker processes.
+
+def ArrayReader(arr):
+    """Window reader for an array already in memory, or memory mapped (e.g. numpy.load(fn, mmap_mode="r"))"""
+    def ReadWindow(r0, r1, c0, c1):
+        return numpy.asarray(arr[r0:r1, c0:c1])
+    return ReadWindow
+
+
+class MemmapReader(object):
+    """Window reader for a memory mapped raster that can be passed to worker processes.
+    It is pickled as just the filename, and the file is reopened in the worker.
+    Mode "Within" reads the cells that are not NaN (or, if MaxCost is given, no more than MaxCost),
+    "Data" the cells that are not NoData."""
+    def __init__(self, arrMemmap, Mode=None, MaxCost=None):
+        self.fn = arrMemmap.filename
+        self.dtype = arrMemmap.dtype.str
+        self.Shape = arrMemmap.shape
+        self.Mode = Mode
+        self.MaxCost = MaxCost
+        self._arr = None
+
+    def __getstate__(self):
+        dic = self.__dict__.copy()
+        dic["_arr"] = None
+        return dic
+
+    def __call__(self, r0, r1, c0, c1):
+        if self._arr is None:
+            self._arr = numpy.memmap(self.fn, self.dtype, "r", shape=self.Shape)
+        arr = numpy.array(self._arr[r0:r1, c0:c1])
+        if self.Mode == "Within":
+            if self.MaxCost:
+                # NaN compares False, so NoData is left out too
+                with numpy.errstate(invalid="ignore"):
+                    return arr <= self.MaxCost
+            return ~numpy.isnan(arr)
+        elif self.Mode == "Data":
+            return IsData(arr)
+        return arr
+
+
+def Tiles(nRows, nCols, TileSize):
+    """The (r0, r1, c0, c1) bounds of each tile, row by row from the top left"""
+    for r0 in range(0, nRows, TileSize):
+        for c0 in range(0, nCols, TileSize):
+            yield r0, min(r0 + TileSize, nRows), c0, min(c0 + TileSize, nCols)
+
+
+# Header values for the BIL pixel types used here
+dicBilTypes = {"int32": (32, "SIGNEDINT"), "uint8": (8, "UNSIGNEDINT"), "float32": (32, "FLOAT"), "float64": (64, "FLOAT")}
+
+def NewBil(geoGrid, dtype, Scratch):
+    """Creates a memory mapped ESRI BIL raster on the grid of geoGrid, filled with zeros.
+    Scratch is a function returning a new scratch filename for an extension (e.g. tmp).
+    Returns a GeoArray of the memmap; the filename is in .arr.filename."""
+    dtype = numpy.dtype(dtype)
+    fnBil = Scratch("bil")
+    arr = numpy.memmap(fnBil, dtype=dtype, mode="w+", shape=geoGrid.Shape)
+    nBits, strPixelType = dicBilTypes[dtype.name]
+    fHdr = open(fnBil[:-4] + ".hdr", "w")
+    fHdr.write("BYTEORDER I\nLAYOUT BIL\nNROWS %s\nNCOLS %s\nNBANDS 1\nNBITS %s\nPIXELTYPE %s\n" %(geoGrid.nRows, geoGrid.nCols, nBits, strPixelType))
+    # BIL georeferencing is the centre of the top left cell
+    fHdr.write("ULXMAP %r\nULYMAP %r\nXDIM %r\nYDIM %r\n" %(geoGrid.XMin + 0.5 * geoGrid.CellSize, geoGrid.YMax - 0.5 * geoGrid.CellSize, geoGrid.CellSize, geoGrid.CellSize))
+    if dtype.kind != "f":
+        fHdr.write("NODATA 0\n")
+    fHdr.close()
+    return geoGrid.Like(arr)
+
+
+def CopyToBil(ReadWindow, geoGrid, dtype, Scratch, TileSize=2048):
+    """Copies a raster a tile at a time from a window reader into a new memory mapped BIL file"""
+    geo = NewBil(geoGrid, dtype, Scratch)
+    for r0, r1, c0, c1 in Tiles(geoGrid.nRows, geoGrid.nCols, TileSize):
+        geo.arr[r0:r1, c0:c1] = ReadWindow(r0, r1, c0, c1)
+    geo.arr.flush()
+    return geo
+
+
+def _Map(func, lTasks, pool=None):
+    """Runs func on each task, in the worker pool if there is one, returning the results in task order.
+    The CPU time of the tasks run in the pool is added up for WorkerCpuTime."""
+    global _WorkerCpu
+    if pool is None:
+        return [func(task) for task in lTasks]
+    lTimed = pool.map(_TimedTask, [(func, task) for task in lTasks], chunksize=1)
+    _WorkerCpu += sum([Cpu for Result, Cpu in lTimed])
+    return [Result for Result, Cpu in lTimed]
+
+
+def _TimedTask(FuncTask):
+    """Worker side of _Map: runs func on a task, returning its result and the CPU time it took"""
+    func, task = FuncTask
+    Start = CpuTime()
+    Result = func(task)
+    return Result, CpuTime() - Start
+
+
+# CPU seconds used by tile tasks in worker processes (see _Map)
+_WorkerCpu = 0.0
+
+def WorkerCpuTime():
+    """The CPU seconds used so far by tile tasks run in worker processes, which the CPU time
+    of this process leaves out"""
+    return _WorkerCpu
+
+
+def _OutRef(arrOut, pool):
+    """How a tile task refers to its output array: the array itself when run in this
+    process, or enough to reopen the memmap when run in a worker process"""
+    if pool is None:
+        return arrOut
+    return (arrOut.filename, arrOut.dtype.str, arrOut.shape)
+
+
+def _OpenOut(Out):
+    """The output array of a tile task (see _OutRef)"""
+    if isinstance(Out, numpy.ndarray):
+        return Out
+    fn, dtype, Shape = Out
+    return numpy.memmap(fn, dtype, "r+", shape=Shape)
+
+
+def _NanMinTile(task):
+    """Tile task: minimum of a window, or inf if it is all NoData"""
+    ReadWindow, (r0, r1, c0, c1) = task
+    arr = ReadWindow(r0, r1, c0, c1)
+    if numpy.isnan(arr).all():
+        return numpy.inf
+    return numpy.nanmin(arr)
+
+
+def _CostDistanceTile(task):
+    """Tile task: cost distance for a tile plus its halo, keeping just the tile"""
+    ReadSource, ReadLand, Out, (r0, r1, c0, c1), Halo, CellSize, MaxCost, Nhood = task
+    arrOut = _OpenOut(Out)
+    nRows, nCols = arrOut.shape
+    h0, h1, w0, w1 = max(0, r0 - Halo), min(nRows, r1 + Halo), max(0, c0 - Halo), min(nCols, c1 + Halo)
+    arrSource = ReadSource(h0, h1, w0, w1)
+    if arrSource.any():
+        arrDist = CostDistance(arrSource, ReadLand(h0, h1, w0, w1), CellSize, MaxCost, Nhood, arrOut.dtype)
+        arrOut[r0:r1, c0:c1] = arrDist[r0 - h0:r1 - h0, c0 - w0:c1 - w0]
+    else:
+        arrOut[r0:r1, c0:c1] = numpy.nan
+    if isinstance(arrOut, numpy.memmap):
+        arrOut.flush()
+
+
+def _ZoneLinksTile(task):
+    """Tile task: the crossings between the zones of a bounded allocation, from the tile's cells to
+    their neighbours below and beside (see ZoneLinksTiled), with positions in the whole raster"""
+    ReadZones, ReadCost, (r0, r1, c0, c1), (nRows, nCols), Halo, CellSize, MaxCost, Nhood = task
+    # The allocation of the tile plus its halo, and a ring of cells around the tile for the crossings out of it
+    h0, h1, w0, w1 = max(0, r0 - Halo - 1), min(nRows, r1 + Halo + 1), max(0, c0 - Halo - 1), min(nCols, c1 + Halo + 1)
+    arrCost = ReadCost(h0, h1, w0, w1)
+    arrDist, arrAlloc = CostAllocation(ReadZones(h0, h1, w0, w1), arrCost, CellSize, MaxCost, Nhood)
+    e0, e1, f0, f1 = r0 - h0, min(r1 + 1, nRows) - h0, max(c0 - 1, 0) - w0, min(c1 + 1, nCols) - w0
+    dicLinks = ZoneLinks(arrDist[e0:e1, f0:f1], arrAlloc[e0:e1, f0:f1], arrCost[e0:e1, f0:f1], CellSize, Nhood, MaxCost)
+    dicLinks["Row"] += r0
+    dicLinks["Col"] += w0 + f0
+    return dicLinks
+
+
+def _RegionGroupTile(task):
+    """Tile task: region group one tile, writing the tile's own labels (from 1) to the output.
+    Returns the first cell of each label as an index into the whole raster in scan order
+    (scan order within a tile agrees with scan order over the whole raster)."""
+    ReadWindow, Out, (r0, r1, c0, c1), Nhood = task
+    arrOut = _OpenOut(Out)
+    nCols = arrOut.shape[1]
+    arrLab = RegionGroup(ReadWindow(r0, r1, c0, c1), Nhood)
+    arrOut[r0:r1, c0:c1] = arrLab
+    if isinstance(arrOut, numpy.memmap):
+        arrOut.flush()
+    arrUnique, arrFirst = numpy.unique(arrLab.ravel(), return_index=True)
+    arrFirst = arrFirst[arrUnique > 0]
+    return (r0 + arrFirst // (c1 - c0)) * nCols + c0 + arrFirst % (c1 - c0)
+
+
+def RegionGroupTiled(ReadWindow, arrOut, Nhood=8, TileSize=2048, pool=None):
+    """RegionGroup a raster a tile at a time, giving the same labels as RegionGroup on the whole raster.
+    Each tile is grouped on its own, then groups that meet across tile boundaries are merged
+    with a union-find on the tile labels, and finally everything is renumbered in scan order.
+    arrOut is the int32 array (normally a memmap) the labels are written to. If a pool of worker
+    processes is given the tiles are grouped in parallel, in which case ReadWindow must be
+    picklable (e.g. a MemmapReader) and arrOut a memmap. Returns the number of labels."""
+    nRows, nCols = arrOut.shape
+    lTiles = list(Tiles(nRows, nCols, TileSize))
+
+    # Group each tile. The tile labels are made unique over the whole raster by
+    # offsetting them by the number of labels in the tiles before.
+    lFirst = _Map(_RegionGroupTile, [(ReadWindow, _OutRef(arrOut, pool), bounds, Nhood) for bounds in lTiles], pool)
+    arrFirst = numpy.concatenate([numpy.zeros(1, dtype=numpy.int64)] + lFirst)
+    nLabels = len(arrFirst) - 1
+    nTileCols = len(range(0, nCols, TileSize))
+    arrTileOffset = numpy.cumsum([0] + [len(arr) for arr in lFirst])[:-1].reshape(-1, nTileCols)
+    def Provisional(r0, r1, c0, c1):
+        arrLab = numpy.asarray(arrOut[r0:r1, c0:c1]).astype(numpy.int64)
+        arrOffset = arrTileOffset[numpy.arange(r0, r1)[:, None] // TileSize, numpy.arange(c0, c1)[None, :] // TileSize]
+        return numpy.where(arrLab > 0, arrLab + arrOffset, 0)
+
+    # Pairs of labels that meet across the tile boundaries, looking at the two rows
+    # (or columns) either side of each boundary
+    lA, lB = [numpy.zeros(0, dtype=numpy.int64)], [numpy.zeros(0, dtype=numpy.int64)]
+    lRowOffsets = [(1, 0)]
+    lColOffsets = [(0, 1)]
+    if Nhood == 8:
+        lRowOffsets += [(1, 1), (1, -1)]
+        lColOffsets += [(1, 1), (1, -1)]
+    lStrips = [(r - 1, r + 1, 0, nCols, lRowOffsets) for r in range(TileSize, nRows, TileSize)]
+    lStrips += [(0, nRows, c - 1, c + 1, lColOffsets) for c in range(TileSize, nCols, TileSize)]
+    for r0, r1, c0, c1, lOffsets in lStrips:
+        arrVal = ReadWindow(r0, r1, c0, c1)
+        arrData = IsData(arrVal)
+        arrLab = Provisional(r0, r1, c0, c1)
+        for dr, dc in lOffsets:
+            slA, slB = _OffsetSlices(dr, dc, r1 - r0, c1 - c0)
+            same = arrData[slA] & arrData[slB] & (arrVal[slA] == arrVal[slB])
+            lA.append(arrLab[slA][same])
+            lB.append(arrLab[slB][same])
+    arrRoot = _UnionFind(nLabels + 1, numpy.concatenate(lA), numpy.concatenate(lB))
+
+    # Renumber the merged groups in order of their first cell
+    arrRootFirst = numpy.empty(nLabels + 1, dtype=numpy.int64)
+    arrRootFirst.fill(numpy.iinfo(numpy.int64).max)
+    numpy.minimum.at(arrRootFirst, arrRoot, arrFirst)
+    arrRoots = numpy.unique(arrRoot[1:])
+    arrRank = numpy.zeros(nLabels + 1, dtype=numpy.int32)
+    arrRank[arrRoots[numpy.argsort(arrRootFirst[arrRoots], kind="mergesort")]] = numpy.arange(1, len(arrRoots) + 1)
+    arrFinal = arrRank[arrRoot]
+    arrFinal[0] = 0
+    for r0, r1, c0, c1 in lTiles:
+        arrOut[r0:r1, c0:c1] = arrFinal[Provisional(r0, r1, c0, c1)]
+    return len(arrRoots)
+
+
+def LCNTiled(ReadHab, ReadLand, geoGrid, MaxCost, Nhood, MinHabArea, Scratch, TileSize=2048, Workers=1):
+    """The raster stages of RunLCN a tile at a time, so peak memory is bounded by the tile size.
+    ReadHab and ReadLand are window readers for the habitat and landcover (cost) rasters on
+    the grid of geoGrid. Cost distance is calculated for each tile with a halo of extra cells
+    around it, wide enough that no path within MaxCost can leave it, so it is exact at the
+    tile edges. Region group labels are stitched across tiles (see RegionGroupTiled), so the
+    results are the same as a whole-raster run.
+    With more than one worker, cost distance and region grouping of the tiles are shared
+    out over a pool of processes. Each tile's result is written to its own part of the
+    output, so the output is identical to a serial run.
+    Returns a dictionary of GeoArrays (memory mapped BIL files) for "CostDist", "Networks",
+    "HabNetworks" and "HabRegions", and the patch count of each network as "PartCount".
+    The networks for a smaller distance can be found from the same "CostDist" with NetworksTiled."""
+    nRows, nCols = geoGrid.Shape
+    CellSize = float(geoGrid.CellSize)
+    if not MaxCost or MaxCost <= 0:
+        raise ValueError("Tiled processing needs a maximum dispersal distance")
+    lTiles = list(Tiles(nRows, nCols, TileSize))
+
+    pool = None
+    if Workers > 1:
+        # The readers are passed to the worker processes, so copy the inputs into
+        # memory mapped files the workers can open for themselves
+        ReadHab = MemmapReader(CopyToBil(ReadHab, geoGrid, numpy.float32, Scratch, TileSize).arr)
+        ReadLand = MemmapReader(CopyToBil(ReadLand, geoGrid, numpy.float32, Scratch, TileSize).arr)
+        pool = multiprocessing.Pool(Workers)
+
+    try:
+        # The halo must hold the longest path (in cells) that costs no more than MaxCost,
+        # i.e. MaxCost / CellSize cells where every cell costs at least 1
+        MinCost = min(_Map(_NanMinTile, [(ReadLand, bounds) for bounds in lTiles], pool))
+        if MinCost <= 0:
+            raise ValueError("Tiled processing needs landcover costs greater than zero")
+        Halo = int(math.ceil(MaxCost / (CellSize * min(MinCost, 1.0))))
+
+        # The cost distance sources: the habitat, less any patches below the minimum area
+        geoSource = NewBil(geoGrid, numpy.uint8, Scratch)
+        if MinHabArea > 0:
+            geoPatches = NewBil(geoGrid, numpy.int32, Scratch)
+            nPatches = RegionGroupTiled(ReadHab, geoPatches.arr, Nhood, TileSize, pool)
+            arrCells = numpy.zeros(nPatches + 1, dtype=numpy.int64)
+            for r0, r1, c0, c1 in lTiles:
+                arrCells += numpy.bincount(numpy.asarray(geoPatches.arr[r0:r1, c0:c1]).ravel(), minlength=nPatches + 1)
+            arrKeep = arrCells * CellSize ** 2 >= MinHabArea
+            arrKeep[0] = False
+            for r0, r1, c0, c1 in lTiles:
+                geoSource.arr[r0:r1, c0:c1] = arrKeep[geoPatches.arr[r0:r1, c0:c1]]
+        else:
+            for r0, r1, c0, c1 in lTiles:
+                geoSource.arr[r0:r1, c0:c1] = IsData(ReadHab(r0, r1, c0, c1))
+        geoSource.arr.flush()
+
+        # Cost distance for each tile plus its halo
+        geoCostDist = NewBil(geoGrid, numpy.float32, Scratch)
+        _Map(_CostDistanceTile, [(MemmapReader(geoSource.arr, "Data"), ReadLand, _OutRef(geoCostDist.arr, pool), bounds,
+                                  Halo, CellSize, MaxCost, Nhood) for bounds in lTiles], pool)
+
+        dicLayers = NetworksTiled(geoCostDist, ReadHab, Nhood, Scratch, TileSize, pool=pool)
+    finally:
+        if pool is not None:
+            pool.close()
+            pool.join()
+
+    geoCostDist.arr.flush()
+    dicLayers["CostDist"] = geoCostDist
+    return dicLayers
+
+
+def NetworksTiled(geoCostDist, ReadHab, Nhood, Scratch, TileSize=2048, Workers=1, MaxCost=None, pool=None):
+    """The networks, the habitat labelled by network, and the habitat regions from a cost distance
+    surface (a memory mapped BIL, as from LCNTiled), a tile at a time, as NetworksFromCostDist.
+    If MaxCost is given only cells within MaxCost count, so the surface for the largest of several
+    distances can be reused for the smaller ones. With more than one worker (or a pool of them)
+    the region grouping is shared out over the pool. Returns a dictionary of GeoArrays (memory
+    mapped BIL files) for "Networks", "HabNetworks" and "HabRegions", and the patch count of each
+    network as "PartCount"."""
+    nRows, nCols = geoCostDist.Shape
+    lTiles = list(Tiles(nRows, nCols, TileSize))
+    poolOwn = None
+    if pool is None and Workers > 1:
+        pool = poolOwn = multiprocessing.Pool(Workers)
+
+    try:
+        # Region group everything within the cost distance into networks
+        geoNetworks = NewBil(geoCostDist, numpy.int32, Scratch)
+        RegionGroupTiled(MemmapReader(geoCostDist.arr, "Within", MaxCost), geoNetworks.arr, Nhood, TileSize, pool)
+
+        # Label the habitat cells with the network they are in
+        geoHabNetworks = NewBil(geoCostDist, numpy.int32, Scratch)
+        for r0, r1, c0, c1 in lTiles:
+            geoHabNetworks.arr[r0:r1, c0:c1] = numpy.where(ReadHab(r0, r1, c0, c1) >= 0, geoNetworks.arr[r0:r1, c0:c1], 0)
+        geoHabNetworks.arr.flush()
+
+        # Region group the habitat patches
+        geoHabRegions = NewBil(geoCostDist, numpy.int32, Scratch)
+        RegionGroupTiled(MemmapReader(geoHabNetworks.arr), geoHabRegions.arr, Nhood, TileSize, pool)
+    finally:
+        if poolOwn is not None:
+            poolOwn.close()
+            poolOwn.join()
+
+    # Count the patches in each network from the unique (network, patch) pairs of every tile
+    nRegions = int(geoHabRegions.arr.max()) + 1
+    lPairs = []
+    for r0, r1, c0, c1 in lTiles:
+        arrNet = numpy.asarray(geoNetworks.arr[r0:r1, c0:c1])
+        arrReg = numpy.asarray(geoHabRegions.arr[r0:r1, c0:c1])
+        arrData = arrReg > 0
+        lPairs.append(numpy.unique(arrNet[arrData].astype(numpy.int64) * nRegions + arrReg[arrData]))
+    arrPairs = numpy.unique(numpy.concatenate(lPairs))
+    arrPartCount = numpy.bincount(arrPairs // nRegions, minlength=int(geoNetworks.arr.max()) + 1)
+
+    for geo in (geoNetworks, geoHabNetworks, geoHabRegions):
+        geo.arr.flush()
+    return {"Networks": geoNetworks, "HabNetworks": geoHabNetworks, "HabRegions": geoHabRegions, "PartCount": arrPartCount}
+
+
+def ZoneLinksTiled(ReadZones, ReadCost, Shape, CellSize, MaxCost, Nhood=8, TileSize=2048, pool=None):
+    """The links of ZoneLinks from a CostAllocation bounded by MaxCost, a tile at a time, so peak memory
+    is bounded by the tile size. ReadZones and ReadCost are window readers for the zone labels and the
+    cost. Each tile is allocated with a halo of extra cells around it wide enough that no path within
+    MaxCost can leave it, as in LCNTiled, so the links are those of the whole raster (apart from which
+    of two equally cheap crossings of a pair is given). If a pool of worker processes is given the tiles
+    are done in parallel, in which case the readers must be picklable (e.g. MemmapReaders).
+    Returns a dictionary of arrays as ZoneLinks."""
+    nRows, nCols = Shape
+    if not MaxCost or MaxCost <= 0:
+        raise ValueError("Tiled links need a maximum link cost")
+    lTiles = list(Tiles(nRows, nCols, TileSize))
+    MinCost = min(_Map(_NanMinTile, [(ReadCost, bounds) for bounds in lTiles], pool))
+    if MinCost <= 0:
+        raise ValueError("Tiled processing needs landcover costs greater than zero")
+    Halo = int(math.ceil(MaxCost / (CellSize * min(MinCost, 1.0))))
+
+    # Crossings near the tile edges are found from both tiles, and the cheapest of every pair kept
+    lLinks = _Map(_ZoneLinksTile, [(ReadZones, ReadCost, bounds, Shape, Halo, float(CellSize), MaxCost, Nhood) for bounds in lTiles], pool)
+    lFrom, lTo, lLinkCost, lRow, lCol = [[dicLinks[key] for dicLinks in lLinks] for key in ("From", "To", "Cost", "Row", "Col")]
+    return _CheapestLinks(lFrom, lTo, lLinkCost, lRow, lCol, MaxCost)
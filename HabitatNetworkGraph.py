@@ -0,0 +1,135 @@
+# Graph connectivity metrics for the habitat network tool
+# The habitat patches in a network are the nodes of a sparse graph, joined
+# by the least-cost links between neighbouring patches (see PatchLinks in
+# HabitatNetworkEngine). Shortest paths are found a batch of sources at a
+# time, so memory stays bounded by the batch size times the number of
+# patches, rather than the square of the number of patches. scipy is used
+# for the shortest paths when it is installed, otherwise a pure Python
+# Dijkstra does the same job more slowly.
+#
+#########################################################
+
+
+import heapq
+import numpy
+
+from HabitatNetworkEngine import _UnionFind
+
+try:
+    import scipy.sparse, scipy.sparse.csgraph
+except ImportError:
+    # Not installed with the ArcGIS version of Python
+    scipy = None
+
+
+# Predecessor of a node with none (the source, or unreachable), as scipy.sparse.csgraph
+NoPredecessor = -9999
+
+
+def ShortestPaths(nNodes, arrA, arrB, arrWeight, arrSources, Unweighted=False):
+    """Shortest paths from each of arrSources over the undirected graph on nNodes nodes with
+    edges arrA[k]-arrB[k] weighted by arrWeight[k] (or all weighted 1 if Unweighted). Returns
+    the distances (inf where unreachable) and the predecessor of each node on its shortest
+    path (NoPredecessor for the source and unreachable nodes), one row per source."""
+    if scipy is not None:
+        if Unweighted:
+            arrWeight = numpy.ones(len(arrA))
+        csGraph = scipy.sparse.csr_matrix((arrWeight, (arrA, arrB)), shape=(nNodes, nNodes))
+        return scipy.sparse.csgraph.dijkstra(csGraph, directed=False, indices=arrSources, return_predecessors=True)
+
+    # Adjacency lists, each edge both ways
+    lAdjacent = [[] for i in range(nNodes)]
+    lWeight = [1.0] * len(arrA) if Unweighted else numpy.asarray(arrWeight, numpy.float64).tolist()
+    for a, b, w in zip(numpy.asarray(arrA).tolist(), numpy.asarray(arrB).tolist(), lWeight):
+        lAdjacent[a].append((b, w))
+        lAdjacent[b].append((a, w))
+    arrDist = numpy.empty((len(arrSources), nNodes))
+    arrPred = numpy.empty((len(arrSources), nNodes), numpy.int32)
+    heappop, heappush = heapq.heappop, heapq.heappush
+    for iSource, Source in enumerate(numpy.asarray(arrSources).tolist()):
+        lDist = [numpy.inf] * nNodes
+        lPred = [NoPredecessor] * nNodes
+        lDist[Source] = 0.0
+        heap = [(0.0, Source)]
+        while heap:
+            d, i = heappop(heap)
+            if d > lDist[i]:
+                continue
+            for j, w in lAdjacent[i]:
+                if d + w < lDist[j]:
+                    lDist[j] = d + w
+                    lPred[j] = i
+                    heappush(heap, (d + w, j))
+        arrDist[iSource] = lDist
+        arrPred[iSource] = lPred
+    return arrDist, arrPred
+
+
+def Components(nNodes, arrA, arrB):
+    """Connected components of the graph, numbered from 0. Returns the component of each node."""
+    arrRoot = _UnionFind(nNodes, numpy.asarray(arrA, numpy.int64), numpy.asarray(arrB, numpy.int64))
+    return numpy.unique(arrRoot, return_inverse=True)[1]
+
+
+def PathCounts(arrDist, arrPred, arrSources):
+    """The number of nodes reached through each node on the shortest paths from each source,
+    found by passing the size of each node's branch of the shortest path tree back to its
+    predecessor, furthest nodes first, for all the sources at once. Returns one row per source."""
+    nSources, nNodes = arrDist.shape
+    arrRows = numpy.arange(nSources)
+    # Every node reached is its own branch to start with
+    arrSize = numpy.isfinite(arrDist).astype(numpy.float64)
+    arrOrder = numpy.argsort(numpy.where(numpy.isfinite(arrDist), arrDist, -1.0), axis=1, kind="mergesort")[:, ::-1]
+    for k in range(nNodes):
+        arrNode = arrOrder[:, k]
+        arrP = arrPred[arrRows, arrNode]
+        arrHas = arrP >= 0
+        arrSize[arrRows[arrHas], arrP[arrHas]] += arrSize[arrRows[arrHas], arrNode[arrHas]]
+    # Leaving out the node itself, and the source, which every path goes from
+    arrSize = numpy.maximum(arrSize - 1, 0)
+    arrSize[arrRows, arrSources] = 0
+    return arrSize
+
+
+def PatchGraphMetrics(arrArea, arrA, arrB, arrCost, Threshold, lFractions, AreaTotal, BatchSize=256):
+    """Connectivity metrics of one network's patches, from the sparse graph of the least-cost links
+    between them. arrArea is the area of each patch (the nodes, numbered from 0), and arrA, arrB and
+    arrCost the links. Links cheaper than Threshold join patches, as for Conefor and Graphab.
+    Returns a dictionary of:
+        IIC, the integral index of connectivity, sum of a_i * a_j / (1 + links between i and j)
+            over every pair of joined patches (and each patch with itself) over AreaTotal squared
+        Components, the number of components with links cheaper than each fraction of Threshold in lFractions
+        MeanCost, the mean least-cost distance between the patches, over the links
+        Betweenness, the number of pairs of patches whose least-cost path goes through each patch
+    Shortest paths are found BatchSize patches at a time."""
+    nNodes = len(arrArea)
+    arrArea = numpy.asarray(arrArea, numpy.float64)
+    arrCost = numpy.asarray(arrCost, numpy.float64)
+    if len(arrCost) == 0:
+        # Nothing joined, e.g. a network with a single patch, so no paths to find
+        return {"IIC": (arrArea ** 2).sum() / float(AreaTotal) ** 2, "Components": [nNodes] * len(lFractions),
+                "MeanCost": numpy.nan, "Betweenness": numpy.zeros(nNodes)}
+    lComponents = [int(Components(nNodes, arrA[arrCost <= Fraction * Threshold], arrB[arrCost <= Fraction * Threshold]).max()) + 1
+                   for Fraction in lFractions]
+    arrJoined = arrCost <= Threshold
+
+    IIC = 0.0
+    CostSum = 0.0
+    nPairs = 0
+    arrBetween = numpy.zeros(nNodes)
+    for s0 in range(0, nNodes, BatchSize):
+        arrSources = numpy.arange(s0, min(nNodes, s0 + BatchSize))
+        # Topological distances over the joined patches
+        arrLinks = ShortestPaths(nNodes, arrA[arrJoined], arrB[arrJoined], None, arrSources, Unweighted=True)[0]
+        IIC += (arrArea[arrSources, None] * arrArea[None, :] / (1.0 + arrLinks)).sum()
+        # Least-cost paths over all the links
+        arrDist, arrPred = ShortestPaths(nNodes, arrA, arrB, arrCost, arrSources)
+        arrPair = numpy.isfinite(arrDist)
+        arrPair[numpy.arange(len(arrSources)), arrSources] = False
+        CostSum += arrDist[arrPair].sum()
+        nPairs += int(arrPair.sum())
+        arrBetween += PathCounts(arrDist, arrPred, arrSources).sum(axis=0)
+
+    # Each pair was counted from both ends
+    return {"IIC": IIC / float(AreaTotal) ** 2, "Components": lComponents,
+            "MeanCost": CostSum / nPairs if nPairs else numpy.nan, "Betweenness": arrBetween / 2.0}
@@ -0,0 +1,219 @@
+# Instrumentation for the habitat network tool
+# Records, for each stage of a run, the wall and CPU time, the peak
+# resident memory, the bytes written to the scratch folder, and the
+# dimensions and label counts of the stage's input and output rasters,
+# and writes them out as a JSON report at the end of the run. One stage
+# can also be run under cProfile. It is opt-in: a disabled Instrument
+# just runs the stages.
+# CPU time is measured on Windows (the ArcGIS platform) as well as Linux,
+# and the peak memory through the Windows API there. Only on Linux can the
+# peak be reset for each stage; elsewhere a stage's own peak is given as
+# unavailable, with the process peak so far alongside it.
+#
+#########################################################
+
+
+import contextlib, cProfile, ctypes, json, os, platform, sys, time
+import numpy
+
+try:
+    import resource
+except ImportError:
+    # Not available on Windows
+    resource = None
+
+
+
+def CpuTime():
+    """The CPU time (user plus system) of this process in seconds. time.clock is not used
+    before Python 3.3, as on Windows it gives the wall time; os.times gives the CPU time there."""
+    if hasattr(time, "process_time"):
+        return time.process_time()
+    lTimes = os.times()
+    return lTimes[0] + lTimes[1]
+
+
+class _ProcessMemoryCounters(ctypes.Structure):
+    """PROCESS_MEMORY_COUNTERS of the Windows API, for GetProcessMemoryInfo"""
+    _fields_ = [("cb", ctypes.c_uint32), ("PageFaultCount", ctypes.c_uint32),
+                ("PeakWorkingSetSize", ctypes.c_size_t), ("WorkingSetSize", ctypes.c_size_t),
+                ("QuotaPeakPagedPoolUsage", ctypes.c_size_t), ("QuotaPagedPoolUsage", ctypes.c_size_t),
+                ("QuotaPeakNonPagedPoolUsage", ctypes.c_size_t), ("QuotaNonPagedPoolUsage", ctypes.c_size_t),
+                ("PagefileUsage", ctypes.c_size_t), ("PeakPagefileUsage", ctypes.c_size_t)]
+
+
+def _WindowsPeakRss():
+    """The peak working set of this process in bytes through the Windows API, or None"""
+    try:
+        GetCurrentProcess = ctypes.windll.kernel32.GetCurrentProcess
+        GetCurrentProcess.restype = ctypes.c_void_p
+        GetProcessMemoryInfo = ctypes.windll.psapi.GetProcessMemoryInfo
+        GetProcessMemoryInfo.argtypes = [ctypes.c_void_p, ctypes.POINTER(_ProcessMemoryCounters), ctypes.c_uint32]
+        counters = _ProcessMemoryCounters()
+        counters.cb = ctypes.sizeof(counters)
+        if GetProcessMemoryInfo(GetCurrentProcess(), ctypes.byref(counters), counters.cb):
+            return int(counters.PeakWorkingSetSize)
+    except (AttributeError, OSError):
+        pass
+    return None
+
+
+
+def ResetPeakRss():
+    """Resets the peak resident memory of the process where the system allows it (Linux),
+    so that the peak of each stage can be read on its own. Returns False where it cannot be."""
+    try:
+        fClear = open("/proc/self/clear_refs", "w")
+        fClear.write("5")
+        fClear.close()
+        return True
+    except (IOError, OSError):
+        return False
+
+
+def PeakRss():
+    """The peak resident memory of the process in bytes (since the last reset on Linux), or None
+    where it cannot be measured"""
+    try:
+        fStatus = open("/proc/self/status")
+        for strLine in fStatus:
+            if strLine.startswith("VmHWM:"):
+                fStatus.close()
+                return int(strLine.split()[1]) * 1024
+        fStatus.close()
+    except (IOError, OSError):
+        pass
+    if resource is not None:
+        # Kilobytes on Linux, bytes on Mac
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * (1 if sys.platform == "darwin" else 1024)
+    if sys.platform == "win32":
+        return _WindowsPeakRss()
+    return None
+
+
+def DescribeItem(Item, Describe=None):
+    """A description of an input or output of a stage for the report. Arrays (or GeoArrays) give
+    their shape and type, with the number of labels of integer arrays, data cells of float arrays
+    (not NaN) and true cells of masks. Shapefiles give their number of features. Anything else is
+    described by the Describe function if one is given (e.g. rasters through arcpy)."""
+    if hasattr(Item, "arr") and hasattr(Item, "CellSize"):
+        dic = DescribeItem(Item.arr)
+        dic["CellSize"] = Item.CellSize
+        return dic
+    if isinstance(Item, numpy.ndarray):
+        dic = {"Shape": list(Item.shape), "DType": Item.dtype.name}
+        if isinstance(Item, numpy.memmap):
+            dic["File"] = Item.filename
+        if Item.size == 0:
+            return dic
+        if Item.dtype == bool:
+            dic["TrueCells"] = int(numpy.count_nonzero(Item))
+        elif Item.dtype.kind in "iu":
+            dic["Labels"] = int(Item.max())
+        elif Item.dtype.kind == "f":
+            dic["DataCells"] = int(Item.size - numpy.count_nonzero(numpy.isnan(Item)))
+        return dic
+    if hasattr(Item, "lower") and Item.lower().endswith(".shp") and os.path.exists(Item[:-4] + ".shx"):
+        # Each record of a shapefile has 8 bytes in the index after its 100 byte header
+        return {"File": Item, "Features": (os.path.getsize(Item[:-4] + ".shx") - 100) // 8}
+    if Describe is not None:
+        try:
+            return Describe(Item)
+        except Exception as e:
+            return {"Item": str(Item), "Error": str(e)}
+    return {"Item": str(Item)}
+
+
+
+class Stage(object):
+    """A stage being run, to which its outputs are given for the report"""
+    def __init__(self):
+        self.lOutputs = []
+
+    def Outputs(self, *lItems):
+        self.lOutputs.extend(lItems)
+
+
+
+class Instrument(object):
+    """Instruments the stages of a run. Each stage is run inside "with instrument.Stage(name, inputs)
+    as stage:", and gives its outputs with stage.Outputs(...). ScratchBytes is a function returning
+    the bytes in the scratch files, so the bytes each stage writes can be found; WorkerCpu is a
+    function returning the CPU seconds used so far in worker processes (which the CPU time of this
+    process leaves out); Describe describes inputs and outputs the instrument cannot (see
+    DescribeItem). If ProfileStage is the name of a stage, that stage is run under cProfile.
+    Nothing is recorded unless Enabled."""
+    def __init__(self, Enabled=False, ProfileStage=None, ScratchBytes=None, Describe=None, WorkerCpu=None):
+        self.Enabled = Enabled
+        self.ProfileStage = ProfileStage
+        self.ScratchBytes = ScratchBytes
+        self.WorkerCpu = WorkerCpu
+        self.Describe = Describe
+        self.dicUnavailable = {}
+        self.lStages = []
+        self.lProfilers = []
+        self.Start = time.time()
+
+    @contextlib.contextmanager
+    def Stage(self, strStage, lInputs=None):
+        stage = Stage()
+        if not self.Enabled:
+            yield stage
+            return
+
+        # The inputs are described before the clock starts, so describing them is not counted
+        dicStage = {"Stage": strStage, "Inputs": [DescribeItem(Item, self.Describe) for Item in (lInputs or [])]}
+        ScratchBytes = self.ScratchBytes() if self.ScratchBytes is not None else None
+        WorkerCpu = self.WorkerCpu() if self.WorkerCpu is not None else None
+        Reset = ResetPeakRss()
+        profiler = None
+        if strStage == self.ProfileStage:
+            profiler = cProfile.Profile()
+            profiler.enable()
+        Wall, CPU = time.time(), CpuTime()
+        try:
+            yield stage
+        finally:
+            dicStage["Wall"] = time.time() - Wall
+            dicStage["CPU"] = CpuTime() - CPU
+            if profiler is not None:
+                profiler.disable()
+                self.lProfilers.append((len(self.lStages), strStage, profiler))
+            if WorkerCpu is not None:
+                dicStage["WorkerCPU"] = self.WorkerCpu() - WorkerCpu
+            # Without a reset the peak so far may be an earlier stage's, so the stage's own is not known
+            dicStage["ProcessPeakRssBytes"] = PeakRss()
+            dicStage["PeakRssBytes"] = dicStage["ProcessPeakRssBytes"] if Reset else None
+            if dicStage["ProcessPeakRssBytes"] is None:
+                self.dicUnavailable["PeakRssBytes"] = "peak memory cannot be measured on this platform"
+            elif not Reset:
+                self.dicUnavailable["PeakRssBytes"] = "the peak memory cannot be reset for each stage on this platform, see ProcessPeakRssBytes for the peak so far"
+            if ScratchBytes is not None:
+                dicStage["ScratchBytes"] = self.ScratchBytes() - ScratchBytes
+            dicStage["Outputs"] = [DescribeItem(Item, self.Describe) for Item in stage.lOutputs]
+            self.lStages.append(dicStage)
+
+    def Report(self, fnReport, dicRun=None):
+        """Writes the JSON report of the stages run so far, with the run parameters in dicRun.
+        Measurements that are not available on this platform are None, with the reason under
+        Unavailable. A profiled stage's statistics are saved next to it, named after the report
+        with the stage's number and name, e.g. Networks_report_3_CostDistance.prof.
+        Returns the report as a dictionary, or None if not Enabled."""
+        if not self.Enabled:
+            return None
+        lPeaks = [dicStage["ProcessPeakRssBytes"] for dicStage in self.lStages if dicStage["ProcessPeakRssBytes"] is not None]
+        dicTotals = {"Wall": time.time() - self.Start, "StageWall": sum([dicStage["Wall"] for dicStage in self.lStages]),
+                     "CPU": sum([dicStage["CPU"] for dicStage in self.lStages]), "PeakRssBytes": max(lPeaks) if lPeaks else None,
+                     "ScratchBytes": sum([dicStage.get("ScratchBytes", 0) for dicStage in self.lStages])}
+        if self.WorkerCpu is not None:
+            dicTotals["WorkerCPU"] = sum([dicStage["WorkerCPU"] for dicStage in self.lStages])
+        dicReport = {"Run": dicRun or {}, "Stages": self.lStages, "Totals": dicTotals, "Unavailable": self.dicUnavailable,
+                     "Python": platform.python_version(), "NumPy": numpy.__version__, "Platform": platform.platform()}
+        for iStage, strStage, profiler in self.lProfilers:
+            fnProfile = "%s_%s_%s.prof" %(os.path.splitext(fnReport)[0], iStage, strStage)
+            profiler.dump_stats(fnProfile)
+            dicReport.setdefault("Profiles", []).append(fnProfile)
+        fReport = open(fnReport, "w")
+        json.dump(dicReport, fReport, indent=1, sort_keys=True, default=str)
+        fReport.close()
+        return dicReport
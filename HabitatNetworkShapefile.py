@@ -0,0 +1,444 @@
+# Shapefile reading, rasterising and vectorising for the habitat network tool
+# A native replacement for arcpy.PolygonToRaster_conversion, so that
+# vector inputs can be used without arcpy (e.g. on Linux). Records
+# are streamed from the .shp and .dbf one at a time, so the whole
+# shapefile is never held in memory.
+# Label rasters are vectorised the other way by tracing the region
+# boundaries straight into one multipart polygon per label, in place
+# of RasterToPolygon_conversion followed by Dissolve_management. The
+# vectoriser is used by the ArcGIS file pipeline too, so it needs no
+# more than that pipeline's numpy 1.6.
+#
+#########################################################
+
+
+import math, os, struct
+import numpy
+
+from HabitatNetworkEngine import GeoArray
+
+
+# Shape types that hold polygons (Polygon, PolygonZ, PolygonM)
+lPolygonTypes = [5, 15, 25]
+
+
+def ReadShpHeader(fnShp):
+    """The shape type and extent (XMin, YMin, XMax, YMax) from the header of a .shp file"""
+    fShp = open(fnShp, "rb")
+    header = fShp.read(100)
+    fShp.close()
+    ShapeType = struct.unpack("<i", header[32:36])[0]
+    return ShapeType, struct.unpack("<4d", header[36:68])
+
+
+def DbfFields(fnShp):
+    """The fields of the .dbf of a shapefile, as a list of (name, type, length, decimals)"""
+    fDbf = open(os.path.splitext(fnShp)[0] + ".dbf", "rb")
+    fDbf.read(32)
+    lFields = []
+    while True:
+        descriptor = fDbf.read(32)
+        if descriptor[:1] == b"\r" or len(descriptor) < 32:
+            break
+        strName = descriptor[:11].split(b"\0")[0].decode("latin-1")
+        lFields.append((strName, descriptor[11:12].decode("latin-1"), ord(descriptor[16:17]), ord(descriptor[17:18])))
+    fDbf.close()
+    return lFields
+
+
+def ListFields(fnShp):
+    """The field names of a shapefile, in the order arcpy.ListFields gives them (FID first)"""
+    return ["FID", "Shape"] + [field[0] for field in DbfFields(fnShp)]
+
+
+def ReadPrj(fnShp):
+    """The spatial reference of a shapefile as WKT from its .prj, or None if there is none"""
+    fnPrj = os.path.splitext(fnShp)[0] + ".prj"
+    if not os.path.exists(fnPrj):
+        return None
+    fPrj = open(fnPrj)
+    strWkt = fPrj.read().strip()
+    fPrj.close()
+    return strWkt
+
+
+def IterPolygons(fnShp, Field="FID"):
+    """Streams the polygons of a shapefile, yielding (value, list of rings) for each record,
+    where each ring is an (n, 2) array of x, y. The value is that of the numeric dbf Field,
+    or the record number for "FID" (NaN for a blank value). Only the text number fields of
+    dBase (types N and F) can be read; anything else, including the binary integer, double
+    and date types of Visual FoxPro (I, B, O and T), is an error. Null shapes are skipped."""
+    ShapeType = ReadShpHeader(fnShp)[0]
+    if ShapeType not in lPolygonTypes:
+        raise ValueError("%s is not a polygon shapefile" %fnShp)
+
+    # Find where the field is in each dbf record
+    if Field != "FID":
+        lFields = DbfFields(fnShp)
+        lNames = [field[0].upper() for field in lFields]
+        if Field.upper() not in lNames:
+            raise ValueError("%s has no field %s" %(fnShp, Field))
+        iField = lNames.index(Field.upper())
+        if lFields[iField][1] not in ("N", "F"):
+            raise ValueError("Field %s of %s is of dbf type %s; only the number types N and F can be read"
+                             %(Field, fnShp, lFields[iField][1]))
+        # Each record starts with a deletion flag byte
+        Offset = 1 + sum([field[2] for field in lFields[:iField]])
+        Width = lFields[iField][2]
+        fDbf = open(os.path.splitext(fnShp)[0] + ".dbf", "rb")
+        dbfHeader = fDbf.read(12)
+        HeaderLength, RecordLength = struct.unpack("<HH", dbfHeader[8:12])
+        fDbf.seek(HeaderLength)
+
+    fShp = open(fnShp, "rb")
+    fShp.seek(100)
+    FID = 0
+    try:
+        while True:
+            recHeader = fShp.read(8)
+            if len(recHeader) < 8:
+                break
+            nBytes = struct.unpack(">i", recHeader[4:8])[0] * 2
+            content = fShp.read(nBytes)
+            if Field == "FID":
+                Value = float(FID)
+            else:
+                strValue = fDbf.read(RecordLength)[Offset:Offset + Width].strip()
+                try:
+                    Value = float(strValue)
+                except ValueError:
+                    Value = numpy.nan
+            FID += 1
+            if struct.unpack("<i", content[:4])[0] == 0:
+                # Null shape
+                continue
+            nParts, nPoints = struct.unpack("<ii", content[36:44])
+            lStarts = list(struct.unpack("<%si" %nParts, content[44:44 + 4 * nParts])) + [nPoints]
+            arrPoints = numpy.frombuffer(content, dtype="<f8", count=2 * nPoints, offset=44 + 4 * nParts).reshape(-1, 2)
+            yield Value, [arrPoints[lStarts[i]:lStarts[i + 1]] for i in range(nParts)]
+    finally:
+        fShp.close()
+        if Field != "FID":
+            fDbf.close()
+
+
+def ShapefileGrid(fnShp, CellSize):
+    """The grid PolygonToRaster gives a shapefile at CellSize: starting at the lower left of the
+    shapefile's extent, with enough rows and columns to cover it. A GeoArray with no array."""
+    XMin, YMin, XMax, YMax = ReadShpHeader(fnShp)[1]
+    nCols = max(1, int(math.ceil((XMax - XMin) / CellSize)))
+    nRows = max(1, int(math.ceil((YMax - YMin) / CellSize)))
+    return GeoArray(None, XMin, YMin, CellSize, ReadPrj(fnShp), (nRows, nCols))
+
+
+def BurnPolygon(arrOut, lRings, Value, geoGrid):
+    """Sets the cells of arrOut whose centres fall inside the polygon to Value.
+    A vectorised scanline fill: every edge is crossed with every row centre line it spans,
+    the crossings are sorted along each row, and cells are filled between alternate crossings
+    (even-odd rule, so holes are left empty). Edges include their lower end but not their
+    upper end, and spans their left end but not their right, so a cell centre on a boundary
+    shared by two polygons goes to just one of them."""
+    nRows, nCols = arrOut.shape
+    CellSize = float(geoGrid.CellSize)
+    YMax = geoGrid.YMax
+
+    # All the edges of all the rings
+    arrX0 = numpy.concatenate([ring[:-1, 0] for ring in lRings])
+    arrY0 = numpy.concatenate([ring[:-1, 1] for ring in lRings])
+    arrX1 = numpy.concatenate([ring[1:, 0] for ring in lRings])
+    arrY1 = numpy.concatenate([ring[1:, 1] for ring in lRings])
+    arrSloped = arrY0 != arrY1
+    arrX0, arrY0, arrX1, arrY1 = arrX0[arrSloped], arrY0[arrSloped], arrX1[arrSloped], arrY1[arrSloped]
+    arrYLo = numpy.minimum(arrY0, arrY1)
+    arrYHi = numpy.maximum(arrY0, arrY1)
+
+    # The rows whose centre line y = YMax - (r + 0.5) * CellSize is in [YLo, YHi) for each edge
+    arrFirst = numpy.floor((YMax - arrYHi) / CellSize - 0.5).astype(numpy.int64) + 1
+    arrLast = numpy.floor((YMax - arrYLo) / CellSize - 0.5).astype(numpy.int64)
+    # A centre line exactly on YHi belongs to the edge above (YHi is excluded)
+    arrFirst[YMax - (arrFirst + 0.5) * CellSize >= arrYHi] += 1
+    arrFirst = numpy.maximum(arrFirst, 0)
+    arrLast = numpy.minimum(arrLast, nRows - 1)
+    arrCount = numpy.maximum(arrLast - arrFirst + 1, 0)
+    nCross = int(arrCount.sum())
+    if nCross == 0:
+        return
+
+    # One crossing per edge per row
+    arrEdge = numpy.repeat(numpy.arange(len(arrCount)), arrCount)
+    arrRow = arrFirst[arrEdge] + numpy.arange(nCross) - numpy.repeat(numpy.cumsum(arrCount) - arrCount, arrCount)
+    arrYc = YMax - (arrRow + 0.5) * CellSize
+    arrX = arrX0[arrEdge] + (arrYc - arrY0[arrEdge]) * (arrX1[arrEdge] - arrX0[arrEdge]) / (arrY1[arrEdge] - arrY0[arrEdge])
+
+    # Pair up the crossings along each row; each row has an even number of them
+    arrOrder = numpy.lexsort((arrX, arrRow))
+    arrRow = arrRow[arrOrder][::2]
+    arrXa = arrX[arrOrder][::2]
+    arrXb = arrX[arrOrder][1::2]
+
+    # Columns whose centre XMin + (c + 0.5) * CellSize is in [Xa, Xb)
+    arrStart = numpy.clip(numpy.ceil((arrXa - geoGrid.XMin) / CellSize - 0.5).astype(numpy.int64), 0, nCols)
+    arrEnd = numpy.clip(numpy.ceil((arrXb - geoGrid.XMin) / CellSize - 0.5).astype(numpy.int64), 0, nCols)
+    arrLength = numpy.maximum(arrEnd - arrStart, 0)
+    nCells = int(arrLength.sum())
+    if nCells == 0:
+        return
+    arrCell = numpy.repeat(arrRow * nCols + arrStart - (numpy.cumsum(arrLength) - arrLength), arrLength) + numpy.arange(nCells)
+    if isinstance(arrOut, numpy.memmap) or not arrOut.flags.c_contiguous:
+        r = arrCell // nCols
+        arrOut[r, arrCell - r * nCols] = Value
+    else:
+        arrOut.reshape(-1)[arrCell] = Value
+
+
+def RasterisePolygons(fnShp, Field, geoGrid, arrOut=None):
+    """Rasterises a polygon shapefile onto the grid of geoGrid, as PolygonToRaster_conversion
+    with cell centre assignment: each cell takes the value of Field for the polygon its centre
+    falls in (the later record where polygons overlap), or NaN if none. Records are streamed
+    from the file. The values are burnt into arrOut if given (e.g. a memmap for a raster too
+    big for memory), otherwise into a new float32 array (as arcpy reads rasters through Float).
+    Returns a GeoArray."""
+    if arrOut is None:
+        arrOut = numpy.empty(geoGrid.Shape, numpy.float32)
+    arrOut[...] = numpy.nan
+
+    # Only polygons overlapping the grid need burning
+    XMin, YMin, XMax, YMax = geoGrid.XMin, geoGrid.YMin, geoGrid.XMax, geoGrid.YMax
+    for Value, lRings in IterPolygons(fnShp, Field):
+        arrAll = numpy.concatenate(lRings)
+        if arrAll[:, 0].max() < XMin or arrAll[:, 0].min() > XMax or arrAll[:, 1].max() < YMin or arrAll[:, 1].min() > YMax:
+            continue
+        BurnPolygon(arrOut, lRings, Value, geoGrid)
+    return geoGrid.Like(arrOut)
+
+
+# Directions of the cell edges, as (row, col) steps between vertices: East, South, West, North
+lSteps = [(0, 1), (1, 0), (0, -1), (-1, 0)]
+
+
+def TraceRings(arrLabels):
+    """Traces the boundaries of the labelled regions of arrLabels (0 for NoData) into rings.
+    Every cell edge between different labels is a directed edge with its cell on the right,
+    so outer rings run clockwise and holes anticlockwise, as shapefiles want them. At a vertex
+    where two cells of a label only touch diagonally, the ring turns right, keeping the cells
+    in separate rings that touch at the vertex. The edges are linked and ordered into rings
+    with pointer jumping rather than walked one at a time, so it is all done in numpy.
+    Returns the label of each ring, the ring of each vertex, and the (row, col) vertex lines
+    of each vertex, in ring order with only the corners kept."""
+    nRows, nCols = arrLabels.shape
+    nVertCols = nCols + 1
+    arrPad = numpy.zeros((nRows + 2, nCols + 2), arrLabels.dtype)
+    arrPad[1:-1, 1:-1] = arrLabels
+    arrCentre = arrPad[1:-1, 1:-1]
+
+    # The directed boundary edges: key = start vertex * 4 + direction
+    lKeys = []
+    lLabels = []
+    for d, (arrOther, dr, dc) in enumerate([(arrPad[:-2, 1:-1], 0, 0), (arrPad[1:-1, 2:], 0, 1),
+                                             (arrPad[2:, 1:-1], 1, 1), (arrPad[1:-1, :-2], 1, 0)]):
+        r, c = numpy.nonzero((arrCentre != 0) & (arrCentre != arrOther))
+        lKeys.append(((r + dr).astype(numpy.int64) * nVertCols + c + dc) * 4 + d)
+        lLabels.append(arrCentre[r, c])
+    arrKey = numpy.concatenate(lKeys)
+    arrLabel = numpy.concatenate(lLabels)
+    arrOrder = numpy.argsort(arrKey)
+    arrKey = arrKey[arrOrder]
+    arrLabel = arrLabel[arrOrder]
+    nEdges = len(arrKey)
+    if nEdges == 0:
+        return arrLabel, numpy.zeros(0, numpy.int64), numpy.zeros((0, 2), numpy.int64)
+
+    # The end vertex of each edge, and the cells around it in the padded array
+    arrDir = arrKey % 4
+    arrStart = arrKey // 4
+    arrEnd = arrStart + numpy.array([1, nVertCols, -1, -nVertCols])[arrDir]
+    i, j = arrEnd // nVertCols, arrEnd % nVertCols
+    arrFlat = arrPad.reshape(-1)
+    arrUL, arrUR = arrFlat[i * (nCols + 2) + j], arrFlat[i * (nCols + 2) + j + 1]
+    arrLL, arrLR = arrFlat[(i + 1) * (nCols + 2) + j], arrFlat[(i + 1) * (nCols + 2) + j + 1]
+    # The cells ahead on the right and ahead on the left, for each direction
+    arrFrontRight = numpy.choose(arrDir, [arrLR, arrLL, arrUL, arrUR])
+    arrFrontLeft = numpy.choose(arrDir, [arrUR, arrLR, arrLL, arrUL])
+
+    # Turn right if the cell ahead on the right is not the label's, else go straight on if
+    # the cell ahead on the left is not the label's, else turn left
+    arrNextDir = numpy.where(arrFrontRight != arrLabel, (arrDir + 1) % 4, numpy.where(arrFrontLeft != arrLabel, arrDir, (arrDir + 3) % 4))
+    arrNext = numpy.searchsorted(arrKey, arrEnd * 4 + arrNextDir)
+
+    # Each ring is a cycle of arrNext; label each by its smallest edge
+    arrRing = numpy.arange(nEdges)
+    arrJump = arrNext.copy()
+    while True:
+        arrRing = numpy.minimum(arrRing, arrRing[arrJump])
+        if (arrRing == arrRing[arrNext]).all():
+            break
+        arrJump = arrJump[arrJump]
+
+    # Cut each cycle before its smallest edge, and rank the edges by the steps to the cut
+    arrRoot = arrRing == numpy.arange(nEdges)
+    arrJump = numpy.where(arrRoot[arrNext], numpy.arange(nEdges), arrNext)
+    arrRank = (arrJump != numpy.arange(nEdges)).astype(numpy.int64)
+    while True:
+        arrJumpJump = arrJump[arrJump]
+        if (arrJumpJump == arrJump).all():
+            break
+        arrRank += arrRank[arrJump]
+        arrJump = arrJumpJump
+    arrOrder = numpy.lexsort((-arrRank, arrRing))
+
+    # Only the corners are needed: drop vertices where the direction does not change
+    arrRing = arrRing[arrOrder]
+    arrDir = arrDir[arrOrder]
+    arrPrevDir = numpy.roll(arrDir, 1)
+    arrFirst = numpy.r_[True, arrRing[1:] != arrRing[:-1]]
+    arrLast = numpy.r_[arrRing[1:] != arrRing[:-1], True]
+    arrPrevDir[arrFirst] = arrDir[arrLast]
+    arrCorner = arrDir != arrPrevDir
+    arrVertex = arrStart[arrOrder][arrCorner]
+    return arrLabel[arrRoot], arrRing[arrCorner], numpy.column_stack((arrVertex // nVertCols, arrVertex % nVertCols))
+
+
+def IterLabelPolygons(geoLabels, lKeep=None):
+    """Vectorises a label raster (0 for NoData), yielding (label, points, part starts) with one
+    multipart polygon for each label in label order, as RasterToPolygon then Dissolve by GRIDCODE
+    would give. The points are an (n, 2) array of x, y holding every ring, each closed by repeating
+    its first vertex, and the part starts are the index of the first point of each ring.
+    If lKeep is given only those labels are vectorised."""
+    arrLabels = geoLabels.arr
+    if lKeep is not None:
+        # A lookup of the labels to keep (numpy.in1d is not in every numpy)
+        arrKeepLabels = numpy.asarray(lKeep, numpy.int64).ravel()
+        nLabels = max(int(arrLabels.max()) if arrLabels.size else 0, int(arrKeepLabels.max()) if len(arrKeepLabels) else 0) + 1
+        arrKeep = numpy.zeros(nLabels, dtype=bool)
+        arrKeep[arrKeepLabels] = True
+        arrLabels = numpy.where(arrKeep[arrLabels], arrLabels, 0)
+    arrRingLabel, arrVertexRing, arrVertex = TraceRings(arrLabels)
+    nRings = len(arrRingLabel)
+    if nRings == 0:
+        return
+
+    # Number the rings 0, 1, 2... and put them in label order, keeping each ring's vertices together
+    arrVertexRing = numpy.searchsorted(numpy.unique(arrVertexRing), arrVertexRing)
+    arrRingOrder = numpy.argsort(arrRingLabel, kind="mergesort")
+    arrRingRank = numpy.empty(nRings, numpy.int64)
+    arrRingRank[arrRingOrder] = numpy.arange(nRings)
+    arrOrder = numpy.argsort(arrRingRank[arrVertexRing], kind="mergesort")
+    arrVertex = arrVertex[arrOrder]
+    arrVertexRing = arrRingRank[arrVertexRing[arrOrder]]
+    arrRingLabel = arrRingLabel[arrRingOrder]
+
+    # Close each ring by repeating its first vertex after its last
+    arrRingStart = numpy.r_[0, numpy.nonzero(arrVertexRing[1:] != arrVertexRing[:-1])[0] + 1]
+    arrRingEnd = numpy.r_[arrRingStart[1:], len(arrVertex)]
+    arrPoints = numpy.empty((len(arrVertex) + nRings, 2))
+    arrPoints[numpy.arange(len(arrVertex)) + arrVertexRing] = arrVertex
+    arrPoints[arrRingEnd + numpy.arange(nRings)] = arrVertex[arrRingStart]
+    arrPartStart = arrRingStart + numpy.arange(nRings)
+
+    # Vertex lines to coordinates
+    arrRowLine = arrPoints[:, 0].copy()
+    arrPoints[:, 0] = geoLabels.XMin + arrPoints[:, 1] * geoLabels.CellSize
+    arrPoints[:, 1] = geoLabels.YMax - arrRowLine * geoLabels.CellSize
+
+    # One record for each label, from its first ring to the first ring of the next label
+    arrFirstRing = numpy.r_[0, numpy.nonzero(arrRingLabel[1:] != arrRingLabel[:-1])[0] + 1, nRings]
+    arrPartStart = numpy.r_[arrPartStart, len(arrPoints)]
+    for k0, k1 in zip(arrFirstRing[:-1], arrFirstRing[1:]):
+        Start = arrPartStart[k0]
+        yield arrRingLabel[k0], arrPoints[Start:arrPartStart[k1]], arrPartStart[k0:k1] - Start
+
+
+def WritePolygons(fnShp, iterRecords, lFields, strWkt=None, ShapeType=5):
+    """Writes a polygon shapefile (.shp, .shx, .dbf, and .prj if strWkt is given) from
+    (values, points, part starts) records, streaming each record to the files as it comes.
+    The points are an (n, 2) array of x, y holding all the rings of the polygon, each closed,
+    with outer rings clockwise and holes anticlockwise, and the part starts are the index of
+    the first point of each ring. lFields is a list of (name, type, length, decimals) for
+    the dbf, with type "N" or "F" and values in the same order. Returns the number of records.
+    With ShapeType 3 a polyline shapefile is written instead, the parts being lines rather
+    than rings (polyline records are laid out in the same way)."""
+    strRoot = os.path.splitext(fnShp)[0]
+    fShp = open(strRoot + ".shp", "wb")
+    fShx = open(strRoot + ".shx", "wb")
+    fDbf = open(strRoot + ".dbf", "wb")
+    # The headers are written again with the lengths and extent once all the records are in
+    fShp.write(b"\0" * 100)
+    fShx.write(b"\0" * 100)
+    RecordLength = 1 + sum([field[2] for field in lFields])
+    fDbf.write(b"\0" * (32 + 32 * len(lFields) + 1))
+
+    nRecords = 0
+    Offset = 50
+    lExtent = [numpy.inf, numpy.inf, -numpy.inf, -numpy.inf]
+    for lValues, arrPoints, arrParts in iterRecords:
+        Box = arrPoints.min(axis=0).tolist() + arrPoints.max(axis=0).tolist()
+        lExtent = [min(lExtent[0], Box[0]), min(lExtent[1], Box[1]), max(lExtent[2], Box[2]), max(lExtent[3], Box[3])]
+        content = struct.pack("<i4dii", ShapeType, Box[0], Box[1], Box[2], Box[3], len(arrParts), len(arrPoints))
+        # The raw bytes through the buffer (ndarray.tobytes needs numpy 1.9, and tostring is gone from numpy 2)
+        content += bytes(numpy.ascontiguousarray(arrParts, "<i4").data) + bytes(numpy.ascontiguousarray(arrPoints, "<f8").data)
+        nRecords += 1
+        fShp.write(struct.pack(">ii", nRecords, len(content) // 2) + content)
+        fShx.write(struct.pack(">ii", Offset, len(content) // 2))
+        Offset += 4 + len(content) // 2
+
+        # Numbers are right aligned in the dbf
+        strRecord = " "
+        for (strName, strType, Length, Decimals), Value in zip(lFields, lValues):
+            if Decimals:
+                strValue = "%.*f" %(Decimals, Value)
+            else:
+                strValue = "%d" %Value
+            strRecord += strValue.rjust(Length)[:Length]
+        fDbf.write(strRecord.encode("latin-1"))
+    fDbf.write(b"\x1a")
+
+    # Headers: file code, length in 16 bit words, version, shape type and extent
+    if nRecords == 0:
+        lExtent = [0.0, 0.0, 0.0, 0.0]
+    for f, Length in ((fShp, Offset), (fShx, 50 + 4 * nRecords)):
+        f.seek(0)
+        f.write(struct.pack(">i20xi", 9994, Length) + struct.pack("<ii4d32x", 1000, ShapeType, *lExtent))
+        f.close()
+    fDbf.seek(0)
+    fDbf.write(struct.pack("<B3BIHH20x", 3, 116, 1, 1, nRecords, 32 + 32 * len(lFields) + 1, RecordLength))
+    for strName, strType, Length, Decimals in lFields:
+        fDbf.write(struct.pack("<11sc4xBB14x", strName.encode("latin-1"), strType.encode("latin-1"), Length, Decimals))
+    fDbf.write(b"\r")
+    fDbf.close()
+
+    if strWkt is not None:
+        fPrj = open(strRoot + ".prj", "w")
+        fPrj.write(strWkt)
+        fPrj.close()
+    return nRecords
+
+
+def WriteNetworkShapefiles(geoHabNetworks, geoNetworks, Nhood, fnHabOut, fnNetOut, dicStats=None):
+    """Writes the habitat and network output shapefiles of the tool from the label rasters, one
+    multipart polygon per network, already dissolved. The areas and patch counts of the networks
+    from dicStats (see HabitatNetworkEngine.NetworkStats) are written along with the polygons if
+    given. With a 4 cell neighbourhood only the networks that contain habitat are kept, as networks
+    can then become separated from their habitat. Returns the numbers of habitat and network polygons."""
+    lHabFields = lNetFields = []
+    if dicStats is not None:
+        lHabFields = [(("POLY_AREA", "F", 19, 11), dicStats["HabArea"]), (("PART_COUNT", "N", 10, 0), dicStats["PartCount"])]
+        lNetFields = [(("POLY_AREA", "F", 19, 11), dicStats["NetArea"])]
+    nHab = WriteLabelShapefile(geoHabNetworks, fnHabOut, lExtraFields=lHabFields)
+    lKeep = None
+    if Nhood == 4:
+        lKeep = numpy.unique(geoHabNetworks.arr[geoHabNetworks.arr > 0])
+    return nHab, WriteLabelShapefile(geoNetworks, fnNetOut, lKeep, lExtraFields=lNetFields)
+
+
+def WriteLabelShapefile(geoLabels, fnShp, lKeep=None, strWkt=None, lExtraFields=None):
+    """Writes a label raster straight to a dissolved polygon shapefile with a GRIDCODE field:
+    one multipart polygon for each label, with no polygon per cell cluster in between.
+    If lKeep is given only those labels are written. lExtraFields is a list of
+    ((name, type, length, decimals), array of values indexed by label) for more fields
+    to write along with GRIDCODE. Returns the number of polygons."""
+    if lExtraFields is None:
+        lExtraFields = []
+    lFields = [("GRIDCODE", "N", 10, 0)] + [field for field, arr in lExtraFields]
+    iterRecords = (([Label] + [arr[Label] for field, arr in lExtraFields], arrPoints, arrParts)
+                   for Label, arrPoints, arrParts in IterLabelPolygons(geoLabels, lKeep))
+    return WritePolygons(fnShp, iterRecords, lFields, strWkt)
@@ -2,14 +2,35 @@
 # 8 Nov 2016
 #
 # Habitat network tool for Forest Research
-# A number of parameters are currently greyed out.
-# These will be added in future versions, and relate to
-# within and between network connectivity and corridors.
+# The minimum network area is currently greyed out, and will
+# be added in a future version.
+# Between network connectivity gives the least-cost links
+# between neighbouring networks, and the least-cost corridors
+# along them (see WriteNetworkLinks). Within network
+# connectivity gives graph metrics of the habitat patches
+# in each network (see WriteWithinNetwork).
 #
-# The tool currently relies entirely on arcpy (ESRI ArcGIS),
+# The tool currently relies on arcpy (ESRI ArcGIS),
 # and must be run from a version of Python with the arcpy
 # library. ESRI usually installs its own ArcGIS version
 # of Python here: C:\Python27
+# The default ArcGIS file pipeline needs ArcGIS 10.1 or later
+# (numpy 1.6); the other options need ArcGIS 10.4 or later
+# (numpy 1.8), see HabitatNetworkEngine.py.
+# Cost distance can optionally be calculated with the NumPy
+# engine in HabitatNetworkEngine.py instead of ArcGIS (much
+# faster if scipy is installed). ArcGIS cost distance always
+# moves to all 8 neighbours, the NumPy engine follows the
+# Neighbourhood setting, so with 4 the two differ. The
+# raster stages can be run in memory as numpy arrays rather
+# than through scratch files, or a tile at a time for rasters
+# too big to fit in memory (optionally over several processes).
+# Several maximum dispersal distances can be run together,
+# sharing one cost distance surface (see RunLCNSweep), and
+# the rasterised inputs and cost surfaces can be cached
+# between runs. Outside the ArcGIS file pipeline, vector inputs
+# are rasterised by HabitatNetworkShapefile.py rather than
+# PolygonToRaster.
 #
 #########################################################
 
@@ -17,6 +38,7 @@
 import Tkinter, Tkconstants, tkFileDialog, tkMessageBox
 import os, numpy, tempfile
 import arcpy
+import HabitatNetworkEngine, HabitatNetworkGraph, HabitatNetworkInstrument, HabitatNetworkShapefile
 
 arcpy.env.overwriteOutput = True
 
@@ -39,9 +61,9 @@ class BeetleGUI(Tkinter.Tk):
         # Parameter label names and text for GUI
         # Use list lLabs to determine order
         # Use dictionary dText to store the actual GUI text
-        lLabs = ["VectorRaster","HabFile","LandFile","LandField","CellSize","Neighbourhood","MinHabArea","MaxDist",
-                 "WithinNet","BetweenNet","MinNetArea","Corridors","PercentLCP",
-                 "HabOutFname","NetOutFname","OutAreaCsv"]
+        lLabs = ["VectorRaster","HabFile","LandFile","LandField","CellSize","Neighbourhood","MinHabArea","MaxDist","CostEngine","InMemory","UseCache","TileSize","Workers",
+                 "WithinNet","BetweenNet","LinkCostFactor","MinNetArea","Corridors","PercentLCP",
+                 "HabOutFname","NetOutFname","OutAreaCsv","CsvNetStats","RunReport"]
         dText = {"VectorRaster":"Vector or raster input files",
                  "HabFile":"Home habitat file",
                  "LandFile":"Landcover file",
@@ -49,15 +71,23 @@ class BeetleGUI(Tkinter.Tk):
                  "CellSize":"Cell size",
                  "Neighbourhood":"Neighbourhood",
                  "MinHabArea":"Minimum viable habitat area",
-                 "MaxDist":"Maximum dispersal distance",
+                 "MaxDist":"Maximum dispersal distance(s)",
+                 "CostEngine":"Cost distance engine",
+                 "InMemory":"In-memory pipeline",
+                 "UseCache":"Cache inputs and cost surfaces",
+                 "TileSize":"Tile size (cells, 0 for no tiling)",
+                 "Workers":"Worker processes",
                  "WithinNet":"Within network",
                  "BetweenNet":"Between network",
+                 "LinkCostFactor":"Link search (x max dispersal, 0 for no limit)",
                  "MinNetArea":"Minimum network area",
                  "Corridors":"Corridors between network",
                  "PercentLCP":"% of least-cost path",
                  "HabOutFname":"Home habitat output filename",
                  "NetOutFname":"Network output filename",
-                 "OutAreaCsv":"Output area csv file"}
+                 "OutAreaCsv":"Output area csv file",
+                 "CsvNetStats":"Network cost distance stats in csv",
+                 "RunReport":"Write a run report (JSON)"}
         
         # Put list into dictionary of labels and order
         dLabOrder = {}
@@ -76,13 +106,28 @@ class BeetleGUI(Tkinter.Tk):
         self.dEntryValue = {} # stores the entry value
         self.dEntryField = {} # stores the field into which the user enters the value
         # Create the integer based entry fields
-        keys = ["CellSize","MinHabArea","MaxDist","MinNetArea","PercentLCP"]
+        keys = ["CellSize","MinHabArea","TileSize","Workers","MinNetArea","PercentLCP"]
         for key in keys:
             self.dEntryValue[key] = Tkinter.IntVar()
             self.dEntryField[key] = Tkinter.Entry(self,textvariable=self.dEntryValue[key])
             self.dEntryField[key].grid(column=1,row=dLabOrder[key],padx=5,pady=5,sticky=Tkinter.W)
         # Default(s)
         self.dEntryValue["CellSize"].set(10)
+        self.dEntryValue["Workers"].set(1)
+
+        # Maximum dispersal distance is text, so that a comma separated list of distances can be given
+        key = "MaxDist"
+        self.dEntryValue[key] = Tkinter.StringVar()
+        self.dEntryValue[key].set("0")
+        self.dEntryField[key] = Tkinter.Entry(self,textvariable=self.dEntryValue[key])
+        self.dEntryField[key].grid(column=1,row=dLabOrder[key],padx=5,pady=5,sticky=Tkinter.W)
+
+        # Links between networks are looked for up to this multiple of the maximum dispersal distance
+        key = "LinkCostFactor"
+        self.dEntryValue[key] = Tkinter.DoubleVar()
+        self.dEntryValue[key].set(2)
+        self.dEntryField[key] = Tkinter.Entry(self,textvariable=self.dEntryValue[key])
+        self.dEntryField[key].grid(column=1,row=dLabOrder[key],padx=5,pady=5,sticky=Tkinter.W)
 
         # Option menus
         key = "Neighbourhood"
@@ -95,6 +140,11 @@ class BeetleGUI(Tkinter.Tk):
         self.dEntryValue[key].set("Vector")
         self.dEntryField[key] = Tkinter.OptionMenu(self, self.dEntryValue[key], "Vector", "Raster")
         self.dEntryField[key].grid(column=1,row=dLabOrder[key],padx=5,pady=5,sticky=Tkinter.W)
+        key = "CostEngine"
+        self.dEntryValue[key] = Tkinter.StringVar()
+        self.dEntryValue[key].set("ArcGIS")
+        self.dEntryField[key] = Tkinter.OptionMenu(self, self.dEntryValue[key], "ArcGIS", "NumPy")
+        self.dEntryField[key].grid(column=1,row=dLabOrder[key],padx=5,pady=5,sticky=Tkinter.W)
         key = "LandField"
         self.dEntryValue[key] = Tkinter.StringVar()
         self.LandFieldOpt = Tkinter.OptionMenu(self, self.dEntryValue[key],"")
@@ -122,7 +172,7 @@ class BeetleGUI(Tkinter.Tk):
             Tkinter.Button(self,text="...", command=lambda key=key:  self.OnSaveAsButtonClick(key)).grid(column=2,row=dLabOrder[key],padx=5,pady=5,sticky=Tkinter.W)
 
         # Create check button fields
-        keys = ["WithinNet","BetweenNet","Corridors","OutAreaCsv"]
+        keys = ["InMemory","UseCache","WithinNet","BetweenNet","Corridors","OutAreaCsv","CsvNetStats","RunReport"]
         for key in keys:
             self.dEntryValue[key] = Tkinter.IntVar()
             self.dEntryField[key] = Tkinter.Checkbutton(self, text="", variable=self.dEntryValue[key])
@@ -130,7 +180,7 @@ class BeetleGUI(Tkinter.Tk):
 
         # DISABLED Entry fields until functionality coded in
         # Grey-out/DISABLED until functionality coded in
-        for key in ["WithinNet","BetweenNet","MinNetArea","Corridors","PercentLCP"]:
+        for key in ["MinNetArea"]:
             self.dLabel[key].configure(fg="grey")
             self.dEntryField[key].configure(state="disabled")
 
@@ -202,7 +252,7 @@ class BeetleGUI(Tkinter.Tk):
         LandFile = self.dEntryValue["LandFile"].get()
         LandField = self.dEntryValue["LandField"].get()
         MinHabArea = self.dEntryValue["MinHabArea"].get()
-        MaxDist = self.dEntryValue["MaxDist"].get()
+        lMaxDist = [int(x) for x in self.dEntryValue["MaxDist"].get().split(",")]
         Neighbourhood = self.dEntryValue["Neighbourhood"].get()
         if VectorRaster == "Vector":
             CellSize = self.dEntryValue["CellSize"].get()
@@ -211,7 +261,23 @@ class BeetleGUI(Tkinter.Tk):
         HabOutFile = self.dEntryValue["HabOutFname"].get()
         NetOutFile = self.dEntryValue["NetOutFname"].get()
         OutCsvFile = self.dEntryValue["OutAreaCsv"].get()
-        RunLCN(VectorRaster, HabFile, LandFile, LandField, MinHabArea, MaxDist, Neighbourhood, CellSize, HabOutFile, NetOutFile, OutCsvFile)
+        CostEngine = self.dEntryValue["CostEngine"].get()
+        InMemory = self.dEntryValue["InMemory"].get()
+        TileSize = self.dEntryValue["TileSize"].get()
+        Workers = self.dEntryValue["Workers"].get()
+        UseCache = self.dEntryValue["UseCache"].get()
+        NetStats = self.dEntryValue["CsvNetStats"].get()
+        Report = self.dEntryValue["RunReport"].get()
+        WithinNet = self.dEntryValue["WithinNet"].get()
+        BetweenNet = self.dEntryValue["BetweenNet"].get()
+        Corridors = self.dEntryValue["Corridors"].get()
+        PercentLCP = self.dEntryValue["PercentLCP"].get()
+        LinkCostFactor = self.dEntryValue["LinkCostFactor"].get()
+        if len(lMaxDist) > 1:
+            # More than one distance given, so share one cost distance surface between them
+            RunLCNSweep(VectorRaster, HabFile, LandFile, LandField, MinHabArea, lMaxDist, Neighbourhood, CellSize, HabOutFile, NetOutFile, OutCsvFile, CostEngine, UseCache=UseCache, NetStats=NetStats, Report=Report, WithinNet=WithinNet, BetweenNet=BetweenNet, Corridors=Corridors, PercentLCP=PercentLCP, LinkCostFactor=LinkCostFactor, TileSize=TileSize, Workers=Workers)
+        else:
+            RunLCN(VectorRaster, HabFile, LandFile, LandField, MinHabArea, lMaxDist[0], Neighbourhood, CellSize, HabOutFile, NetOutFile, OutCsvFile, CostEngine, InMemory, TileSize=TileSize, Workers=Workers, UseCache=UseCache, NetStats=NetStats, Report=Report, WithinNet=WithinNet, BetweenNet=BetweenNet, Corridors=Corridors, PercentLCP=PercentLCP, LinkCostFactor=LinkCostFactor)
 
 
     def ChangeVectorRaster(self, *args):
@@ -233,191 +299,861 @@ class BeetleGUI(Tkinter.Tk):
 
 
 
-def RunLCN(VecOrRast, HabFname, LandFname, Field, MinHabArea, MaxCost, Nhood, CellSize, fnHabOut, fnNetOut, intCsv):
+def RunLCN(VecOrRast, HabFname, LandFname, Field, MinHabArea, MaxCost, Nhood, CellSize, fnHabOut, fnNetOut, intCsv, CostEngine="ArcGIS", InMemory=False, Debug=False, TileSize=0, Workers=1, UseCache=False, NetStats=False, Report=False, ProfileStage=None, WithinNet=False, BetweenNet=False, Corridors=False, PercentLCP=0, LinkCostFactor=2):
+    """Runs the habitat network analysis.
+    With InMemory the raster stages are passed between each other as numpy arrays,
+    otherwise every stage is saved to a scratch file. With a TileSize the raster stages
+    are run a tile at a time (always with the NumPy engine), for rasters too big for memory.
+    With more than one worker the tiles are processed in parallel (tiles of 2048 cells
+    if no TileSize is given). With UseCache the in-memory pipeline is used, taking the
+    rasterised inputs and cost surface from the cache (pthCache) when they have been made
+    before (tiled runs do not use the cache, so UseCache is ignored with a TileSize or
+    more than one worker). With NetStats the area csv also gets cost distance statistics
+    for each network.
+    With Report, the time, memory and scratch space of each stage are written to a JSON
+    report next to the network output (see ReportFilename), and the stage named by
+    ProfileStage (e.g. "CostDistance") is run under cProfile. With WithinNet, connectivity
+    metrics of the habitat patches in each network are written (see WriteWithinNetwork).
+    With BetweenNet the least-cost links between the networks are also written, and with
+    Corridors the corridors along them, keeping the cells within PercentLCP percent of the
+    least-cost path (see WriteNetworkLinks). The links are only looked for up to LinkCostFactor
+    times MaxCost (2 by default, so two networks are linked if a disperser from each could meet
+    halfway), so dearer links are left out; 0 looks over the whole landscape, which can take far
+    longer, and cannot be done in a tiled run.
+    Scratch files are deleted at the end of the run, unless Debug is set, when they are kept
+    for inspection."""
 
     arcpy.CheckOutExtension("spatial")
+
+    if Workers > 1 and TileSize <= 0:
+        TileSize = 2048
+    if TileSize > 0:
+        # Tiled runs never hold a whole raster in memory, so have nothing to cache
+        UseCache = False
+        if (BetweenNet or Corridors) and LinkCostFactor <= 0:
+            raise ValueError("Tiled runs need a link cost factor above 0 to find the links between networks")
+    cache = None
+    if UseCache:
+        cache = HabitatNetworkEngine.Cache(pthCache, CacheMaxBytes)
+    StartInstrument(Report, ProfileStage)
+
+    try:
+        if TileSize > 0:
+            RunLCNTiled(VecOrRast, HabFname, LandFname, Field, MinHabArea, MaxCost, Nhood, CellSize, fnHabOut, fnNetOut, intCsv, TileSize, Debug, Workers, NetStats, WithinNet, BetweenNet, Corridors, PercentLCP, LinkCostFactor)
+        elif InMemory or UseCache:
+            RunLCNInMemory(VecOrRast, HabFname, LandFname, Field, MinHabArea, MaxCost, Nhood, CellSize, fnHabOut, fnNetOut, intCsv, CostEngine, Debug, cache, NetStats, WithinNet, BetweenNet, Corridors, PercentLCP, LinkCostFactor)
+        else:
+            RunLCNFiles(VecOrRast, HabFname, LandFname, Field, MinHabArea, MaxCost, Nhood, CellSize, fnHabOut, fnNetOut, intCsv, CostEngine, NetStats, WithinNet, BetweenNet, Corridors, PercentLCP, LinkCostFactor)
+    finally:
+        # The report is written even if the run fails, to show how far it got
+        instrument.Report(ReportFilename(fnNetOut), {"VecOrRast": VecOrRast, "HabFname": HabFname, "LandFname": LandFname, "Field": Field,
+                          "MinHabArea": MinHabArea, "MaxCost": MaxCost, "Nhood": Nhood, "CellSize": CellSize, "fnHabOut": fnHabOut,
+                          "fnNetOut": fnNetOut, "intCsv": intCsv, "CostEngine": CostEngine, "InMemory": InMemory, "TileSize": TileSize,
+                          "Workers": Workers, "UseCache": UseCache, "NetStats": NetStats, "WithinNet": WithinNet,
+                          "BetweenNet": BetweenNet, "Corridors": Corridors, "PercentLCP": PercentLCP, "LinkCostFactor": LinkCostFactor,
+                          "Cache": cache.Report() if cache else None})
+        if not Debug:
+            CleanScratch()
+    if Debug and cache is not None:
+        print(cache.Report())
+
+    # Message box to confirm that the analysis is complete
+    tkMessageBox.showinfo("Finised", "Habitat network tool has finished running")
     
+    return
+
+
+
+def RunLCNFiles(VecOrRast, HabFname, LandFname, Field, MinHabArea, MaxCost, Nhood, CellSize, fnHabOut, fnNetOut, intCsv, CostEngine, NetStats=False, WithinNet=False, BetweenNet=False, Corridors=False, PercentLCP=0, LinkCostFactor=2):
+    """The habitat network pipeline with every raster stage saved to a scratch file"""
+
     # Dictionary to convert to ArcGIS syntax for neighbourhoods
     dicNeighbours = {4: "FOUR", 8: "EIGHT"}
     
     # If vector files have been chosen, convert them to rasters first
     if VecOrRast == "Vector":
-        # Convert vector files to rasters
-        fnGivenHab = tmp("tif")
-        arcpy.PolygonToRaster_conversion(HabFname, arcpy.ListFields(HabFname)[0].name, fnGivenHab, "", "", CellSize) # DEBUG tmp.tif
-        fnGivenLand = tmp("tif")
-        arcpy.PolygonToRaster_conversion(LandFname, Field, fnGivenLand, "", "", CellSize) # DEBUG tmp0.tif
+        with instrument.Stage("Rasterise", [HabFname, LandFname]) as stage:
+            # Convert vector files to rasters
+            fnGivenHab = tmp("tif")
+            arcpy.PolygonToRaster_conversion(HabFname, arcpy.ListFields(HabFname)[0].name, fnGivenHab, "", "", CellSize) # DEBUG tmp.tif
+            fnGivenLand = tmp("tif")
+            arcpy.PolygonToRaster_conversion(LandFname, Field, fnGivenLand, "", "", CellSize) # DEBUG tmp0.tif
+            stage.Outputs(fnGivenHab, fnGivenLand)
     else:
         # If the user started with raster files, just use those original raster files
         fnGivenHab = HabFname
         fnGivenLand = LandFname
 
-    # If a minimum habitat area has been set, calculate the area of each patch
+    # If a minimum habitat area has been set, remove the patches that are too small
     if MinHabArea > 0:
-        RegionGroupHab = arcpy.sa.RegionGroup(fnGivenHab, dicNeighbours[Nhood]) # DEBUG tmp1.tif
-        fnRegionGroup = tmp("tif")
-        RegionGroupHab.save(fnRegionGroup)
-        fnVecRegionGroup = tmp("shp")
-        arcpy.RasterToPolygon_conversion(fnRegionGroup, fnVecRegionGroup, "NO_SIMPLIFY", "VALUE") # DEBUG tmp.shp (GRIDCODE field)
-        fnVecRegionGroupByGridCode = tmp("shp")
-        arcpy.Dissolve_management(fnVecRegionGroup, fnVecRegionGroupByGridCode, "GRIDCODE") # DEBUG tmp0.shp
-        # Does not work in ArcGIS 10.0
-        #arcpy.AddGeometryAttributes_management(fnVecRegionGroupByGridCode, "AREA")
-        # So do it manually below:
-        arcpy.AddField_management(fnVecRegionGroupByGridCode, "POLY_AREA", "DOUBLE")
-        geometryField = arcpy.Describe(fnVecRegionGroupByGridCode).shapeFieldName
-        cursor = arcpy.UpdateCursor(fnVecRegionGroupByGridCode)
-        for row in cursor:
-            row.setValue("POLY_AREA", row.getValue(geometryField).area)
-            cursor.updateRow(row)
-        del row, cursor
-        fnVecSelectedHab = tmp("shp")
-        arcpy.Select_analysis(fnVecRegionGroupByGridCode, fnVecSelectedHab, '"POLY_AREA" >= %s' %MinHabArea) # DEBUG tmp1.shp
-        fnSelectedHab = tmp("tif")
-        arcpy.PolygonToRaster_conversion(fnVecSelectedHab, arcpy.ListFields(fnVecSelectedHab)[0].name, fnSelectedHab, "", "", CellSize) # DEBUG tmp2.tif
+        with instrument.Stage("AreaFilter", [fnGivenHab]) as stage:
+            fnSelectedHab = SelectHabByArea(fnGivenHab, MinHabArea, Nhood)
+            stage.Outputs(fnSelectedHab)
     else:
         # If no minimum habitat area was set, just just use the habitat as given
         fnSelectedHab = fnGivenHab
     
     # Quick way to reclassify all values in habitat raster to zero
-    Habs = arcpy.sa.Plus(fnSelectedHab, 1)# DEBUG tmp3.tif
-    fnHabs = tmp("tif")
-    Habs.save(fnHabs)
+    with instrument.Stage("HabSources", [fnSelectedHab]) as stage:
+        Habs = arcpy.sa.Plus(fnSelectedHab, 1)# DEBUG tmp3.tif
+        fnHabs = tmp("tif")
+        Habs.save(fnHabs)
+        stage.Outputs(fnHabs)
         
     # Cost distance
-    fnCostDist = tmp("tif")
-    arcpy.gp.CostDistance_sa(fnHabs, fnGivenLand, fnCostDist, MaxCost, "") # DEBUG tmp4.tif
+    with instrument.Stage("CostDistance", [fnHabs, fnGivenLand]) as stage:
+        fnCostDist = tmp("tif")
+        if CostEngine == "NumPy":
+            CostDistanceNumPy(fnHabs, fnGivenLand, fnCostDist, MaxCost, Nhood) # DEBUG tmp4.tif
+        else:
+            arcpy.gp.CostDistance_sa(fnHabs, fnGivenLand, fnCostDist, MaxCost, "") # DEBUG tmp4.tif
+        stage.Outputs(fnCostDist)
     
     # Reclassify everything within the cost distance to zero
-    fnWithinCost = tmp("tif")
-    arcpy.gp.Reclassify_sa(fnCostDist, "VALUE", "0 " + str(MaxCost) + " 0", fnWithinCost) # DEBUG tmp5.tif
+    with instrument.Stage("Reclassify", [fnCostDist]) as stage:
+        fnWithinCost = tmp("tif")
+        arcpy.gp.Reclassify_sa(fnCostDist, "VALUE", "0 " + str(MaxCost) + " 0", fnWithinCost) # DEBUG tmp5.tif
+        stage.Outputs(fnWithinCost)
     
     # Region group networks to identify contiguous areas
-    Networks = arcpy.sa.RegionGroup(fnWithinCost, dicNeighbours[Nhood]) # DEBUG tmp6.tif
-    fnNetworks = tmp("tif")
-    Networks.save(fnNetworks)
+    with instrument.Stage("RegionGroupNetworks", [fnWithinCost]) as stage:
+        Networks = arcpy.sa.RegionGroup(fnWithinCost, dicNeighbours[Nhood]) # DEBUG tmp6.tif
+        fnNetworks = tmp("tif")
+        Networks.save(fnNetworks)
+        stage.Outputs(fnNetworks)
     
     # Convert original habitat raster to all zeros and add to network raster
     # to relabel habitat patches that are in the same network, and to remove habitat patches
     # that are outside of the network (i.e. those less than the minimum patch size)
-    OrigHabRasterZero = arcpy.sa.Con(arcpy.sa.Raster(fnGivenHab) >= 0, 0, fnGivenHab) # DEBUG tmp7.tif
-    fnOrigHabRasterZero = tmp("tif")
-    OrigHabRasterZero.save(fnOrigHabRasterZero)
-    HabNetworks = arcpy.sa.Plus(fnNetworks, fnOrigHabRasterZero) # DEBUG tmp8.tif
-    fnHabNetworks = tmp("tif")
-    HabNetworks.save(fnHabNetworks)
-
-    # The output hab file
-    fnHabPoly = tmp("shp")
-    arcpy.RasterToPolygon_conversion(fnHabNetworks, fnHabPoly, "NO_SIMPLIFY", "VALUE")
-    arcpy.Dissolve_management(fnHabPoly, fnHabOut, "GRIDCODE")
+    with instrument.Stage("HabNetworks", [fnNetworks, fnGivenHab]) as stage:
+        OrigHabRasterZero = arcpy.sa.Con(arcpy.sa.Raster(fnGivenHab) >= 0, 0, fnGivenHab) # DEBUG tmp7.tif
+        fnOrigHabRasterZero = tmp("tif")
+        OrigHabRasterZero.save(fnOrigHabRasterZero)
+        HabNetworks = arcpy.sa.Plus(fnNetworks, fnOrigHabRasterZero) # DEBUG tmp8.tif
+        fnHabNetworks = tmp("tif")
+        HabNetworks.save(fnHabNetworks)
+        stage.Outputs(fnHabNetworks)
 
     # Region group the habitat patches...
-    HabRegions = arcpy.sa.RegionGroup(fnHabNetworks, dicNeighbours[Nhood]) # DEBUG tmp9.tif
-    fnHabRegions = tmp("tif")
-    HabRegions.save(fnHabRegions)
-
-    # Prepare shapefiles to allow habitat patches to be counted within each network
-    if Nhood == 4:
-        fnHabForPartCount = tmp("shp")
-        arcpy.RasterToPolygon_conversion(fnHabRegions, fnHabForPartCount, "NO_SIMPLIFY", "VALUE") # DEBUG tmp2.shp
-    else:
-        fnHabPoly = tmp("shp")
-        arcpy.RasterToPolygon_conversion(fnHabRegions, fnHabPoly, "NO_SIMPLIFY", "VALUE")
-        fnHabForPartCount = tmp("shp")
-        arcpy.Dissolve_management(fnHabPoly, fnHabForPartCount, "GRIDCODE")
-        fnHabDissolve = tmp("shp")
-    
-    # Output networks as vector (shape) file
-    fnNetSeparate = tmp("shp")
-    arcpy.RasterToPolygon_conversion(fnNetworks, fnNetSeparate, "NO_SIMPLIFY", "VALUE")
-    fnNetDissolve = tmp("shp")
-    arcpy.Dissolve_management(fnNetSeparate, fnNetDissolve, "GRIDCODE")
-
-    # Network polygons can become separated from habitats when considering a 4 cell neighbourhood,
-    # so remove these when the neighbourhood has been set as 4
-    # NETWORK SHAPEFILE FINAL OUTPUT
-    if Nhood == 4:
-        arcpy.MakeFeatureLayer_management(fnNetDissolve, "NetLyr")
-        arcpy.SelectLayerByLocation_management("NetLyr", "contains", fnHabOut)
-        arcpy.Select_analysis("NetLyr", fnNetOut)
-        arcpy.Delete_management("NetLyr")
+    with instrument.Stage("RegionGroupHabitat", [fnHabNetworks]) as stage:
+        HabRegions = arcpy.sa.RegionGroup(fnHabNetworks, dicNeighbours[Nhood]) # DEBUG tmp9.tif
+        fnHabRegions = tmp("tif")
+        HabRegions.save(fnHabRegions)
+        stage.Outputs(fnHabRegions)
+
+    # Vector outputs and the area csv
+    WriteLCNOutputs(fnHabNetworks, fnHabRegions, fnNetworks, Nhood, fnHabOut, fnNetOut, intCsv, CostDist=fnCostDist if NetStats else None)
+    if WithinNet:
+        WriteWithinNetwork(fnHabRegions, fnNetworks, fnGivenLand, Nhood, MaxCost, fnNetOut)
+    if BetweenNet or Corridors:
+        WriteNetworkLinks(fnNetworks, fnGivenLand, Nhood, fnNetOut, arcpy.Describe(fnNetworks).spatialReference, BetweenNet, PercentLCP if Corridors else None, MaxCost, LinkCostFactor)
+
+    return
+
+
+
+def RunLCNSweep(VecOrRast, HabFname, LandFname, Field, MinHabArea, lMaxCost, Nhood, CellSize, fnHabOut, fnNetOut, intCsv, CostEngine="NumPy", Debug=False, UseCache=False, NetStats=False, Report=False, ProfileStage=None, WithinNet=False, BetweenNet=False, Corridors=False, PercentLCP=0, LinkCostFactor=2, TileSize=0, Workers=1):
+    """Runs the habitat network analysis for a list of maximum dispersal distances.
+    The cost distance is only calculated once, for the largest distance, as that surface
+    holds everything the smaller distances need. The networks, output shapefiles and area
+    csv for each distance are then found from it, so each extra distance only costs the
+    thresholding and region grouping. The outputs are named after fnHabOut and fnNetOut
+    with the distance added, e.g. Networks_1000.shp. With UseCache the rasterised inputs
+    and cost surface are taken from the cache when they have been made before (not in tiled
+    sweeps, which ignore UseCache). Report,
+    ProfileStage, WithinNet, BetweenNet, Corridors, PercentLCP and LinkCostFactor are as for RunLCN, with
+    one report for the whole sweep. The sweep works in memory, unless a TileSize (or more than
+    one worker) is given, when it is run a tile at a time as RunLCN (see RunLCNSweepTiled)."""
+
+    arcpy.CheckOutExtension("spatial")
+
+    if Workers > 1 and TileSize <= 0:
+        TileSize = 2048
+    if TileSize > 0:
+        # Tiled runs never hold a whole raster in memory, so have nothing to cache
+        UseCache = False
+        if (BetweenNet or Corridors) and LinkCostFactor <= 0:
+            raise ValueError("Tiled runs need a link cost factor above 0 to find the links between networks")
+    cache = None
+    if UseCache:
+        cache = HabitatNetworkEngine.Cache(pthCache, CacheMaxBytes)
+    StartInstrument(Report, ProfileStage)
+
+    try:
+        if TileSize > 0:
+            RunLCNSweepTiled(VecOrRast, HabFname, LandFname, Field, MinHabArea, lMaxCost, Nhood, CellSize, fnHabOut, fnNetOut, intCsv, TileSize, Debug, Workers, NetStats, WithinNet, BetweenNet, Corridors, PercentLCP, LinkCostFactor)
+        else:
+            RunLCNSweepInMemory(VecOrRast, HabFname, LandFname, Field, MinHabArea, lMaxCost, Nhood, CellSize, fnHabOut, fnNetOut, intCsv, CostEngine, Debug, cache, NetStats, WithinNet, BetweenNet, Corridors, PercentLCP, LinkCostFactor)
+    finally:
+        instrument.Report(ReportFilename(fnNetOut), {"VecOrRast": VecOrRast, "HabFname": HabFname, "LandFname": LandFname, "Field": Field,
+                          "MinHabArea": MinHabArea, "lMaxCost": lMaxCost, "Nhood": Nhood, "CellSize": CellSize, "fnHabOut": fnHabOut,
+                          "fnNetOut": fnNetOut, "intCsv": intCsv, "CostEngine": CostEngine, "UseCache": UseCache, "NetStats": NetStats,
+                          "TileSize": TileSize, "Workers": Workers, "WithinNet": WithinNet, "BetweenNet": BetweenNet, "Corridors": Corridors, "PercentLCP": PercentLCP,
+                          "LinkCostFactor": LinkCostFactor, "Cache": cache.Report() if cache else None})
+        if not Debug:
+            CleanScratch()
+    if Debug and cache is not None:
+        print(cache.Report())
+
+    # Message box to confirm that the analysis is complete
+    tkMessageBox.showinfo("Finised", "Habitat network tool has finished running")
+
+    return
+
+
+
+def RunLCNSweepInMemory(VecOrRast, HabFname, LandFname, Field, MinHabArea, lMaxCost, Nhood, CellSize, fnHabOut, fnNetOut, intCsv, CostEngine, Debug, cache=None, NetStats=False, WithinNet=False, BetweenNet=False, Corridors=False, PercentLCP=0, LinkCostFactor=2):
+    """The sweep of RunLCNSweep with the raster stages held in memory as numpy arrays: one cost
+    distance surface for the largest distance, thresholded for each of the distances."""
+    geoLand, geoHab, geoSelectedHab, strSourceKey = ReadLCNInputs(VecOrRast, HabFname, LandFname, Field, MinHabArea, Nhood, CellSize, cache)
+    with instrument.Stage("CostDistance", [geoSelectedHab, geoLand]) as stage:
+        arrCostDist = CostDistanceArray(geoSelectedHab, geoLand, max(lMaxCost), Nhood, CostEngine, cache, strSourceKey)
+        stage.Outputs(arrCostDist)
+    DebugSave(geoLand.Like(arrCostDist), Debug)
+
+    for MaxCost in sorted(lMaxCost):
+        with instrument.Stage("RegionGroup", [arrCostDist, geoHab]) as stage:
+            arrNetworks, arrHabNetworks, arrHabRegions = HabitatNetworkEngine.NetworksFromCostDist(arrCostDist, geoHab.arr, Nhood, MaxCost)
+            stage.Outputs(arrNetworks, arrHabNetworks, arrHabRegions)
+        WriteLCNOutputs(geoLand.Like(arrHabNetworks), geoLand.Like(arrHabRegions), geoLand.Like(arrNetworks), Nhood,
+                        SweepFilename(fnHabOut, MaxCost), SweepFilename(fnNetOut, MaxCost), intCsv, True, geoLand.SpatialRef,
+                        geoLand.Like(arrCostDist) if NetStats else None)
+        if WithinNet:
+            WriteWithinNetwork(geoLand.Like(arrHabRegions), geoLand.Like(arrNetworks), geoLand, Nhood, MaxCost, SweepFilename(fnNetOut, MaxCost))
+        if BetweenNet or Corridors:
+            WriteNetworkLinks(geoLand.Like(arrNetworks), geoLand, Nhood, SweepFilename(fnNetOut, MaxCost), geoLand.SpatialRef,
+                              BetweenNet, PercentLCP if Corridors else None, MaxCost, LinkCostFactor)
+
+    return
+
+
+
+def RunLCNSweepTiled(VecOrRast, HabFname, LandFname, Field, MinHabArea, lMaxCost, Nhood, CellSize, fnHabOut, fnNetOut, intCsv, TileSize, Debug, Workers=1, NetStats=False, WithinNet=False, BetweenNet=False, Corridors=False, PercentLCP=0, LinkCostFactor=2):
+    """The sweep of RunLCNSweep a tile at a time, as RunLCNTiled, for rasters too big for memory.
+    The tiled pipeline is run for the largest distance, and its cost distance surface (a memory
+    mapped file) is thresholded a tile at a time for each of the smaller distances."""
+    geoGrid, ReadHab, ReadLand, Land = ReadTiledInputs(VecOrRast, HabFname, LandFname, Field, CellSize)
+    with instrument.Stage("LCNTiled", [HabFname, LandFname]) as stage:
+        dicLayers = HabitatNetworkEngine.LCNTiled(ReadHab, ReadLand, geoGrid, max(lMaxCost), Nhood, MinHabArea, tmp, TileSize, Workers)
+        stage.Outputs(*[dicLayers[key] for key in ["CostDist", "Networks", "HabNetworks", "HabRegions"]])
+    if Debug:
+        print("DEBUG CostDist %s" %dicLayers["CostDist"].arr.filename)
+
+    for MaxCost in sorted(lMaxCost):
+        dicNetworks = dicLayers
+        if MaxCost != max(lMaxCost):
+            with instrument.Stage("RegionGroup", [dicLayers["CostDist"]]) as stage:
+                dicNetworks = HabitatNetworkEngine.NetworksTiled(dicLayers["CostDist"], ReadHab, Nhood, tmp, TileSize, Workers, MaxCost)
+                dicNetworks["CostDist"] = dicLayers["CostDist"]
+                stage.Outputs(*[dicNetworks[key] for key in ["Networks", "HabNetworks", "HabRegions"]])
+        WriteTiledOutputs(dicNetworks, Land, geoGrid, MaxCost, Nhood, SweepFilename(fnHabOut, MaxCost), SweepFilename(fnNetOut, MaxCost),
+                          intCsv, NetStats, WithinNet, BetweenNet, Corridors, PercentLCP, LinkCostFactor, TileSize)
+
+    return
+
+
+
+def RunLCNInMemory(VecOrRast, HabFname, LandFname, Field, MinHabArea, MaxCost, Nhood, CellSize, fnHabOut, fnNetOut, intCsv, CostEngine, Debug, cache=None, NetStats=False, WithinNet=False, BetweenNet=False, Corridors=False, PercentLCP=0, LinkCostFactor=2):
+    """The habitat network pipeline with the raster stages held in memory as numpy arrays.
+    Only the final outputs are written, plus copies of the intermediates if debugging.
+    If a cache is given, stages made before with the same inputs are taken from it."""
+
+    # Read the inputs and remove habitat patches below the minimum area
+    geoLand, geoHab, geoSelectedHab, strSourceKey = ReadLCNInputs(VecOrRast, HabFname, LandFname, Field, MinHabArea, Nhood, CellSize, cache)
+    DebugSave(geoSelectedHab, Debug)
+
+    # Cost distance from every remaining habitat cell
+    with instrument.Stage("CostDistance", [geoSelectedHab, geoLand]) as stage:
+        arrCostDist = CostDistanceArray(geoSelectedHab, geoLand, MaxCost, Nhood, CostEngine, cache, strSourceKey)
+        stage.Outputs(arrCostDist)
+    DebugSave(geoLand.Like(arrCostDist), Debug)
+
+    # Region group everything within the cost distance into networks, and the habitat into patches
+    with instrument.Stage("RegionGroup", [arrCostDist, geoHab]) as stage:
+        arrNetworks, arrHabNetworks, arrHabRegions = HabitatNetworkEngine.NetworksFromCostDist(arrCostDist, geoHab.arr, Nhood)
+        stage.Outputs(arrNetworks, arrHabNetworks, arrHabRegions)
+    for arr in (arrNetworks, arrHabNetworks, arrHabRegions):
+        DebugSave(geoLand.Like(arr), Debug)
+
+    # Vector outputs and the area csv
+    WriteLCNOutputs(geoLand.Like(arrHabNetworks), geoLand.Like(arrHabRegions), geoLand.Like(arrNetworks),
+                    Nhood, fnHabOut, fnNetOut, intCsv, True, geoLand.SpatialRef, geoLand.Like(arrCostDist) if NetStats else None)
+    if WithinNet:
+        WriteWithinNetwork(geoLand.Like(arrHabRegions), geoLand.Like(arrNetworks), geoLand, Nhood, MaxCost, fnNetOut)
+    if BetweenNet or Corridors:
+        WriteNetworkLinks(geoLand.Like(arrNetworks), geoLand, Nhood, fnNetOut, geoLand.SpatialRef, BetweenNet, PercentLCP if Corridors else None, MaxCost, LinkCostFactor)
+
+    return
+
+
+
+def RunLCNTiled(VecOrRast, HabFname, LandFname, Field, MinHabArea, MaxCost, Nhood, CellSize, fnHabOut, fnNetOut, intCsv, TileSize, Debug, Workers=1, NetStats=False, WithinNet=False, BetweenNet=False, Corridors=False, PercentLCP=0, LinkCostFactor=2):
+    """The habitat network pipeline a tile at a time, so that peak memory is bounded by the tile size
+    rather than the size of the landscape. Windows of the input rasters are read through arcpy, and the
+    intermediates are kept in memory mapped files in the scratch folder (see HabitatNetworkEngine.LCNTiled).
+    With more than one worker the tiles are shared out over a pool of processes."""
+    geoGrid, ReadHab, ReadLand, Land = ReadTiledInputs(VecOrRast, HabFname, LandFname, Field, CellSize)
+    with instrument.Stage("LCNTiled", [HabFname, LandFname]) as stage:
+        dicLayers = HabitatNetworkEngine.LCNTiled(ReadHab, ReadLand, geoGrid, MaxCost, Nhood, MinHabArea, tmp, TileSize, Workers)
+        stage.Outputs(*[dicLayers[key] for key in ["CostDist", "Networks", "HabNetworks", "HabRegions"]])
+    if Debug:
+        for key in ["CostDist", "Networks", "HabNetworks", "HabRegions"]:
+            print("DEBUG %s %s" %(key, dicLayers[key].arr.filename))
+
+    WriteTiledOutputs(dicLayers, Land, geoGrid, MaxCost, Nhood, fnHabOut, fnNetOut, intCsv, NetStats, WithinNet, BetweenNet, Corridors, PercentLCP, LinkCostFactor, TileSize)
+
+    return
+
+
+
+def ReadTiledInputs(VecOrRast, HabFname, LandFname, Field, CellSize):
+    """The grid and window readers of the habitat and landcover for the tiled pipeline, everything
+    on the grid of the landcover raster. Vector inputs are rasterised straight into memory mapped
+    files. Returns the grid, the habitat and landcover readers, and the landcover for the outputs
+    (its GeoArray for vector inputs, otherwise the raster filename; see LandReader)."""
+    if VecOrRast == "Vector":
+        with instrument.Stage("Rasterise", [HabFname, LandFname]) as stage:
+            geoGrid = HabitatNetworkShapefile.ShapefileGrid(LandFname, CellSize)
+            geoGrid.SpatialRef = arcpy.Describe(LandFname).spatialReference
+            geoLand, geoHab = RasteriseToBil(LandFname, Field, geoGrid), RasteriseToBil(HabFname, None, geoGrid)
+            stage.Outputs(geoLand, geoHab)
+        return geoGrid, HabitatNetworkEngine.MemmapReader(geoHab.arr), HabitatNetworkEngine.MemmapReader(geoLand.arr), geoLand
+    geoGrid = DescribeGrid(LandFname)
+    return geoGrid, RasterReader(HabFname, geoGrid), RasterReader(LandFname, geoGrid), LandFname
+
+
+
+def WriteTiledOutputs(dicLayers, Land, geoGrid, MaxCost, Nhood, fnHabOut, fnNetOut, intCsv, NetStats=False, WithinNet=False, BetweenNet=False, Corridors=False, PercentLCP=0, LinkCostFactor=2, TileSize=2048):
+    """The vector outputs, area csv and any connectivity outputs of a tiled run, straight from the
+    memory mapped label rasters in dicLayers (see HabitatNetworkEngine.LCNTiled), with the links
+    between networks found a tile of TileSize cells at a time"""
+    WriteLCNOutputs(dicLayers["HabNetworks"], dicLayers["HabRegions"], dicLayers["Networks"], Nhood, fnHabOut, fnNetOut,
+                    intCsv, True, geoGrid.SpatialRef, dicLayers["CostDist"] if NetStats else None)
+    if WithinNet:
+        # A window of each network at a time, landcover included
+        WriteWithinNetwork(dicLayers["HabRegions"], dicLayers["Networks"], Land, Nhood, MaxCost, fnNetOut)
+    if BetweenNet or Corridors:
+        WriteNetworkLinks(dicLayers["Networks"], Land, Nhood, fnNetOut, geoGrid.SpatialRef, BetweenNet, PercentLCP if Corridors else None, MaxCost, LinkCostFactor, TileSize)
+
+
+
+def GivenGeoArray(VecOrRast, Fname, Field, CellSize, geoTemplate=None):
+    """Reads the given file into a GeoArray (on the grid of geoTemplate if given), rasterising vector
+    files with HabitatNetworkShapefile instead of PolygonToRaster. Field is the vector field to
+    rasterise, or None for the first field."""
+    if VecOrRast != "Vector":
+        return ReadGeoArray(Fname, geoTemplate)
+    if Field is None:
+        Field = HabitatNetworkShapefile.ListFields(Fname)[0]
+    if geoTemplate is None:
+        geoTemplate = HabitatNetworkShapefile.ShapefileGrid(Fname, CellSize)
+    return HabitatNetworkShapefile.RasterisePolygons(Fname, Field, geoTemplate)
+
+
+
+def RasteriseToBil(Fname, Field, geoGrid):
+    """Rasterises a vector file onto the grid of geoGrid into a memory mapped BIL file in the scratch folder,
+    for rasters too big to hold in memory. Field is the vector field to rasterise, or None for the first field."""
+    if Field is None:
+        Field = HabitatNetworkShapefile.ListFields(Fname)[0]
+    geo = HabitatNetworkEngine.NewBil(geoGrid, numpy.float32, tmp)
+    HabitatNetworkShapefile.RasterisePolygons(Fname, Field, geoGrid, geo.arr)
+    geo.arr.flush()
+    return geo
+
+
+
+def ReadLCNInputs(VecOrRast, HabFname, LandFname, Field, MinHabArea, Nhood, CellSize, cache=None):
+    """Reads the landcover and habitat into GeoArrays, both on the grid of the landcover raster.
+    If a cache is given, the rasterised inputs and selected habitat are taken from it when they
+    have been made before from the same files and parameters. Returns the landcover, the habitat,
+    the habitat less any patches below the minimum area (a mask of its cells), and the cache key of the latter."""
+    if cache is None:
+        # A cache with no directory never keeps anything
+        cache = HabitatNetworkEngine.Cache(None)
+
+    strLandKey = cache.Key("Land", HabitatNetworkEngine.HashFile(LandFname), VecOrRast, Field, CellSize)
+    strHabKey = cache.Key("Hab", HabitatNetworkEngine.HashFile(HabFname), strLandKey)
+    strSelectedKey = cache.Key("SelectedHab", strHabKey, MinHabArea, Nhood, "Mask")
+
+    with instrument.Stage("Rasterise", [HabFname, LandFname]) as stage:
+        geoLand = cache.GetOrMake(strLandKey, lambda: GivenGeoArray(VecOrRast, LandFname, Field, CellSize))
+        geoHab = cache.GetOrMake(strHabKey, lambda: GivenGeoArray(VecOrRast, HabFname, None, CellSize, geoLand))
+        stage.Outputs(geoLand, geoHab)
+    if MinHabArea > 0:
+        with instrument.Stage("AreaFilter", [geoHab]) as stage:
+            geoSelectedHab = cache.GetOrMake(strSelectedKey, lambda: geoHab.Like(HabitatNetworkEngine.SelectHabByArea(geoHab.arr, MinHabArea, geoHab.CellSize, Nhood, Mask=True)))
+            stage.Outputs(geoSelectedHab)
     else:
-        arcpy.CopyFeatures_management(fnNetDissolve, fnNetOut)
+        geoSelectedHab = geoHab
+
+    # The cache does not keep the spatial reference
+    SpatialRef = arcpy.Describe(LandFname).spatialReference
+    for geo in (geoLand, geoHab, geoSelectedHab):
+        geo.SpatialRef = SpatialRef
+    return geoLand, geoHab, geoSelectedHab, strSelectedKey
+
+
+
+def CostDistanceArray(geoSource, geoCost, MaxCost, Nhood, CostEngine, cache=None, strSourceKey=None):
+    """Cost distance from every data cell of geoSource over geoCost, as a float32 array with NaN for NoData.
+    Uses the NumPy engine, or arcpy.sa.CostDistance on rasters converted from the arrays.
+    If a cache is given (with the cache key of the sources), the surface is taken from it
+    when it has been made before."""
+    def Make():
+        arrSource = HabitatNetworkEngine.IsData(geoSource.arr)
+        if CostEngine == "NumPy":
+            return geoCost.Like(HabitatNetworkEngine.CostDistance(arrSource, geoCost.arr, geoCost.CellSize, MaxCost, Nhood, numpy.float32))
+        CostDist = arcpy.sa.CostDistance(GeoArrayToRaster(geoCost.Like(arrSource)), GeoArrayToRaster(geoCost), MaxCost)
+        return ReadGeoArray(CostDist, geoCost)
+    if cache is None:
+        return Make().arr
+    return cache.GetOrMake(cache.Key("CostDist", strSourceKey, MaxCost, Nhood, CostEngine), Make).arr
+
+
+
+def SweepFilename(fn, MaxCost):
+    """Output filename for one distance of a sweep, e.g. Networks.shp -> Networks_1000.shp"""
+    strRoot, strExt = os.path.splitext(fn)
+    return "%s_%s%s" %(strRoot, MaxCost, strExt)
+
+
 
+def SelectHabByArea(fnGivenHab, MinHabArea, Nhood):
+    """Removes habitat patches smaller than MinHabArea, working directly on the habitat raster
+    rather than through polygons of the patches. Returns the filename of the selected habitat raster."""
+    geoHab = ReadGeoArray(fnGivenHab)
+    geoSelectedHab = geoHab.Like(HabitatNetworkEngine.SelectHabByArea(geoHab.arr, MinHabArea, geoHab.CellSize, Nhood))
+    fnSelectedHab = tmp("tif")
+    SaveGeoArray(geoSelectedHab, fnSelectedHab) # DEBUG tmp2.tif
+    return fnSelectedHab
 
-    # If user wanted a csv of the habitat and network areas, then calculate and output this
+
+
+def WriteLCNOutputs(HabNetworks, HabRegions, Networks, Nhood, fnHabOut, fnNetOut, intCsv, InMemory=False, SpatialRef=None, CostDist=None):
+    """Writes the habitat and network shapefiles, and the area csv if requested.
+    The rasters can be filenames or arcpy Rasters, or GeoArrays of labels. They are
+    vectorised straight into dissolved shapefiles by HabitatNetworkShapefile (rasters
+    given as files are read into memory for it first), unless they are memory mapped,
+    when they go through arcpy as files. With InMemory the intermediate feature classes
+    of arcpy go in the in_memory workspace rather than the scratch folder. The output
+    shapefiles get SpatialRef if given, else that of the network raster file. The areas
+    and patch counts come from histograms of the label rasters. If the cost distance
+    raster is given, the csv also gets the number of cells and the mean and maximum
+    cost distance of each network."""
+
+    # The file pipeline's label rasters are read in once, for both the stats and the vectoriser
+    if not isinstance(Networks, HabitatNetworkEngine.GeoArray):
+        with instrument.Stage("ReadLabels", [Networks, HabNetworks]) as stage:
+            Networks = LabelGeoArray(Networks)
+            HabNetworks = LabelGeoArray(HabNetworks, Networks)
+            stage.Outputs(Networks, HabNetworks)
+        if SpatialRef is None:
+            SpatialRef = Networks.SpatialRef
+
+    # Areas and patch counts of each network, in one pass over the label rasters
+    dicStats = None
     if intCsv:
-        # Calculate polygon areas for networks and habitats
-        # Should work for ArcGIS 10.0+
-        # area
-        for FinalShapeFile in (fnNetOut, fnHabOut):
-            arcpy.AddField_management(FinalShapeFile, "POLY_AREA", "DOUBLE")
-            geometryField = arcpy.Describe(FinalShapeFile).shapeFieldName
-            cursor = arcpy.UpdateCursor(FinalShapeFile)
-            for row in cursor:
-                row.setValue("POLY_AREA", row.getValue(geometryField).area)
-                cursor.updateRow(row)
-            del row, cursor
-            
-        # count patches
-        arcpy.MakeFeatureLayer_management(fnNetOut, "NetworkLyr")
-        arcpy.MakeFeatureLayer_management(fnHabForPartCount, "HabitatLyr")
-        cursor = arcpy.SearchCursor(fnNetOut)
-        dicPartCount = {}
-        for row in cursor:
-            FID = row.getValue("FID")
-            arcpy.SelectLayerByAttribute_management("NetworkLyr", "NEW_SELECTION", "\"FID\" = %s" %FID)
-            arcpy.SelectLayerByLocation_management("HabitatLyr", "WITHIN", "NetworkLyr", selection_type="NEW_SELECTION")
-            dicPartCount[FID] = int(arcpy.GetCount_management("HabitatLyr").getOutput(0))
-        del row, cursor
+        with instrument.Stage("NetworkStats", [Networks, HabNetworks, HabRegions]):
+            if CostDist is not None and not isinstance(CostDist, HabitatNetworkEngine.GeoArray):
+                CostDist = ReadGeoArray(CostDist, Networks)
+            dicStats = HabitatNetworkEngine.NetworkStats(Networks.arr, HabNetworks.arr, LabelGeoArray(HabRegions, Networks).arr,
+                                                         Networks.CellSize, None if CostDist is None else CostDist.arr)
+
+    with instrument.Stage("Vectorise", [HabNetworks, Networks]) as stage:
+        WriteLCNShapefiles(HabNetworks, Networks, Nhood, fnHabOut, fnNetOut, InMemory, dicStats)
+        stage.Outputs(fnHabOut, fnNetOut)
+    if SpatialRef is not None:
+        arcpy.DefineProjection_management(fnHabOut, SpatialRef)
+        arcpy.DefineProjection_management(fnNetOut, SpatialRef)
+
+
+    # If user wanted a csv of the habitat and network areas, then output this
+    if intCsv:
+        with instrument.Stage("Csv"):
+            WriteLCNCsv(fnHabOut, fnNetOut, Nhood, dicStats)
+
+    return
+
+
+
+def WriteLCNShapefiles(HabNetworks, Networks, Nhood, fnHabOut, fnNetOut, InMemory=False, dicStats=None):
+    """Writes the habitat and network shapefiles from the label rasters, with the areas and
+    patch counts of the networks from dicStats (see HabitatNetworkEngine.NetworkStats) if given.
+    Label GeoArrays in memory are vectorised by HabitatNetworkShapefile; anything else (the
+    memory mapped rasters of tiled runs) goes through RasterToPolygon and Dissolve."""
+    if isinstance(HabNetworks, HabitatNetworkEngine.GeoArray) and not isinstance(HabNetworks.arr, numpy.memmap):
+        # One multipart polygon per network traced from the label arrays, already dissolved,
+        # with the areas and patch counts written along with the polygons
+        HabitatNetworkShapefile.WriteNetworkShapefiles(HabNetworks, Networks, Nhood, fnHabOut, fnNetOut, dicStats)
+    else:
+        # The output hab file
+        fnHabPoly = tmpVec(InMemory)
+        arcpy.RasterToPolygon_conversion(LabelRaster(HabNetworks), fnHabPoly, "NO_SIMPLIFY", "VALUE")
+        arcpy.Dissolve_management(fnHabPoly, fnHabOut, "GRIDCODE")
+
+        # Output networks as vector (shape) file
+        fnNetSeparate = tmpVec(InMemory)
+        arcpy.RasterToPolygon_conversion(LabelRaster(Networks), fnNetSeparate, "NO_SIMPLIFY", "VALUE")
+        fnNetDissolve = tmpVec(InMemory)
+        arcpy.Dissolve_management(fnNetSeparate, fnNetDissolve, "GRIDCODE")
+
+        # Network polygons can become separated from habitats when considering a 4 cell neighbourhood,
+        # so remove these when the neighbourhood has been set as 4
+        # NETWORK SHAPEFILE FINAL OUTPUT
+        if Nhood == 4:
+            arcpy.MakeFeatureLayer_management(fnNetDissolve, "NetLyr")
+            arcpy.SelectLayerByLocation_management("NetLyr", "contains", fnHabOut)
+            arcpy.Select_analysis("NetLyr", fnNetOut)
+            arcpy.Delete_management("NetLyr")
+        else:
+            arcpy.CopyFeatures_management(fnNetDissolve, fnNetOut)
+
+        # Join the areas and patch counts to the outputs by network (GRIDCODE)
+        if dicStats is not None:
+            ExtendByGridCode(fnNetOut, [("POLY_AREA", dicStats["NetArea"])])
+            ExtendByGridCode(fnHabOut, [("POLY_AREA", dicStats["HabArea"]), ("PART_COUNT", dicStats["PartCount"].astype(numpy.int32))])
+
+    return
+
+
+
+def WriteLCNCsv(fnHabOut, fnNetOut, Nhood, dicStats):
+    """Writes the csv of the habitat and network areas, named after the output shapefiles,
+    from the areas and patch counts of the networks in dicStats"""
+    # Create a path and filename for the csv file based on the other output files
+    # Note: could add extra filename parameter for this...
+    [pthOut, strNet] = os.path.split(fnNetOut)
+    strHab = os.path.split(fnHabOut)[1]
+    pthCsv = os.path.join(pthOut, "%s%s.csv" %(strNet.split(".")[0], strHab.split(".")[0]))
+
+    # Get the linear units of the shapefiles being used
+    strHabUnit = arcpy.Describe(fnHabOut).spatialReference.linearUnitName
+    strNetUnit = arcpy.Describe(fnNetOut).spatialReference.linearUnitName
+    if strHabUnit == "":
+        strHabUnit = "undefined"
+    if strNetUnit == "":
+        strNetUnit = "undefined"
+
+    # Write the habitat and network area info to a csv file in one go
+    HabitatNetworkEngine.WriteAreaCsv(pthCsv, dicStats, Nhood, strHabUnit, strNetUnit)
+
+    return
+
+
+
+def WriteNetworkLinks(Networks, Land, Nhood, fnNetOut, SpatialRef=None, Links=True, PercentLCP=None, MaxCost=None, LinkCostFactor=2, TileSize=0):
+    """Writes the least-cost links between networks, found by one cost allocation from every
+    network at once over the landcover (always with the NumPy engine). Networks whose allocated
+    areas meet are linked, with the cost of the cheapest crossing (see HabitatNetworkEngine.ZoneLinks).
+    If the maximum dispersal distance MaxCost is given, the allocation stops at LinkCostFactor
+    times it (none if 0), and only the links up to that cost are written.
+    With Links, the links go next to the network output as an edge table (e.g. Networks_links.csv,
+    headed by the link cost factor and the cost the links were looked for up to) and as lines from the centre of one network through the crossing to the centre of the other
+    (Networks_links.shp), with the networks given by their GRIDCODE in the network output.
+    If PercentLCP is given the corridors along the links are written too (see WriteCorridors).
+    Networks and Land can be filenames, arcpy Rasters or GeoArrays. With a TileSize (for the memory
+    mapped label rasters of a tiled run) the allocation is done a tile at a time (see
+    HabitatNetworkEngine.ZoneLinksTiled), which needs the bound of MaxCost and LinkCostFactor."""
+    geoNetworks = LabelGeoArray(Networks)
+    ReadLand = LandReader(Land, geoNetworks)
+
+    MaxLinkCost = None
+    if MaxCost and LinkCostFactor:
+        MaxLinkCost = LinkCostFactor * float(MaxCost)
+    if TileSize > 0:
+        with instrument.Stage("NetworkLinks", [geoNetworks, Land]) as stage:
+            dicLinks = HabitatNetworkEngine.ZoneLinksTiled(HabitatNetworkEngine.ArrayReader(geoNetworks.arr), ReadLand, geoNetworks.Shape,
+                                                           geoNetworks.CellSize, MaxLinkCost, Nhood, TileSize)
+            stage.Outputs(dicLinks["From"])
+    else:
+        arrLand = ReadLand(0, geoNetworks.nRows, 0, geoNetworks.nCols)
+        with instrument.Stage("CostAllocation", [geoNetworks, arrLand]) as stage:
+            arrDist, arrAlloc = HabitatNetworkEngine.CostAllocation(geoNetworks.arr, arrLand, geoNetworks.CellSize, MaxLinkCost, Nhood)
+            stage.Outputs(arrDist, arrAlloc)
+        with instrument.Stage("NetworkLinks", [arrAlloc]) as stage:
+            dicLinks = HabitatNetworkEngine.ZoneLinks(arrDist, arrAlloc, arrLand, geoNetworks.CellSize, Nhood, MaxLinkCost)
+            del arrDist, arrAlloc, arrLand
+    strRoot = os.path.splitext(fnNetOut)[0]
+
+    if Links:
+        with instrument.Stage("WriteLinks") as stage:
+            arrRow, arrCol = HabitatNetworkEngine.LabelCentroids(geoNetworks.arr)
+            # Positions in cells from the top left corner to map coordinates
+            def XY(arrR, arrC):
+                return numpy.column_stack((geoNetworks.XMin + arrC * geoNetworks.CellSize, geoNetworks.YMax - arrR * geoNetworks.CellSize))
+            arrFrom, arrCross, arrTo = XY(arrRow[dicLinks["From"]], arrCol[dicLinks["From"]]), XY(dicLinks["Row"], dicLinks["Col"]), XY(arrRow[dicLinks["To"]], arrCol[dicLinks["To"]])
+
+            fOut = open(strRoot + "_links.csv", "w")
+            fOut.write("Link cost factor,%s,Max link cost,%s\n" %(LinkCostFactor, "" if MaxLinkCost is None else MaxLinkCost))
+            fOut.write("From,To,Cost,X,Y\n")
+            fOut.write("".join([",".join([str(x) for x in row]) + "\n" for row in zip(dicLinks["From"].tolist(), dicLinks["To"].tolist(),
+                                dicLinks["Cost"].tolist(), arrCross[:, 0].tolist(), arrCross[:, 1].tolist())]))
+            fOut.close()
+
+            iterRecords = (([From, To, Cost], numpy.array([arrFrom[i], arrCross[i], arrTo[i]]), [0])
+                           for i, (From, To, Cost) in enumerate(zip(dicLinks["From"].tolist(), dicLinks["To"].tolist(), dicLinks["Cost"].tolist())))
+            lFields = [("FROM_NET", "N", 10, 0), ("TO_NET", "N", 10, 0), ("COST", "F", 19, 11)]
+            HabitatNetworkShapefile.WritePolygons(strRoot + "_links.shp", iterRecords, lFields, ShapeType=3)
+            stage.Outputs(strRoot + "_links.shp")
+        if SpatialRef is not None:
+            arcpy.DefineProjection_management(strRoot + "_links.shp", SpatialRef)
+
+    if PercentLCP is not None:
+        WriteCorridors(geoNetworks, ReadLand, dicLinks, PercentLCP, Nhood, strRoot, SpatialRef)
+
+    return
+
+
+
+def WriteWithinNetwork(HabRegions, Networks, Land, Nhood, MaxCost, fnNetOut, lFractions=(0.25, 0.5, 0.75, 1.0)):
+    """Writes connectivity metrics of the habitat patches (the habitat regions) within each network.
+    The least-cost links between neighbouring patches come from one cost allocation per network over
+    its own cells (see HabitatNetworkEngine.PatchLinks), and make a sparse graph of the patches for the
+    metrics (see HabitatNetworkGraph.PatchGraphMetrics). Patches are joined when their link is within
+    twice the maximum dispersal distance, as patches meeting within MaxCost of a common cell join a
+    network. The files go next to the network output:
+        Networks_patchlinks.csv, the links, with the network, patches, cost and crossing point
+        Networks_patches.csv, each patch with its network, area, centre and betweenness
+        Networks_within.csv, each network with its number of patches and links, IIC, the mean least-cost
+            distance between its patches, and the number of components at each fraction of the threshold
+    HabRegions, Networks and Land can be filenames, arcpy Rasters or GeoArrays. With the memory
+    mapped label rasters of a tiled run, a landcover file is read a network's window at a time."""
+    geoNetworks = LabelGeoArray(Networks)
+    geoRegions = LabelGeoArray(HabRegions, geoNetworks)
+    ReadLand = LandReader(Land, geoNetworks)
+    CellSize = geoNetworks.CellSize
+    Threshold = 2.0 * MaxCost if MaxCost and MaxCost > 0 else numpy.inf
+
+    with instrument.Stage("PatchLinks", [geoNetworks, geoRegions, Land]) as stage:
+        dicLinks = HabitatNetworkEngine.PatchLinks(geoNetworks.arr, geoRegions.arr, ReadLand, CellSize, Nhood)
+        stage.Outputs(dicLinks["From"])
+
+    with instrument.Stage("WithinNetwork") as stage:
+        # The network, area and centre of each patch
+        arrPatchNet, arrPatchCells, arrNetCells = HabitatNetworkEngine.PatchNetworks(geoNetworks.arr, geoRegions.arr)
+        arrPatchArea = arrPatchCells * float(CellSize) ** 2
+        arrNetArea = arrNetCells * float(CellSize) ** 2
+        arrRow, arrCol = HabitatNetworkEngine.LabelCentroids(geoRegions.arr)
+        arrBetween = numpy.zeros(len(arrPatchNet))
+
+        # The patches and links of each network, as runs of the sorted arrays
+        arrPatches = numpy.nonzero(arrPatchNet)[0]
+        arrPatches = arrPatches[numpy.argsort(arrPatchNet[arrPatches], kind="mergesort")]
+        arrNets, arrPatchStart = numpy.unique(arrPatchNet[arrPatches], return_index=True)
+        arrPatchEnd = numpy.r_[arrPatchStart[1:], len(arrPatches)]
+        arrLinkStart = numpy.searchsorted(dicLinks["Network"], arrNets)
+        arrLinkEnd = numpy.searchsorted(dicLinks["Network"], arrNets, side="right")
+        arrNode = numpy.zeros(len(arrPatchNet), numpy.int64)
+        lRows = []
+        for Network, p0, p1, l0, l1 in zip(arrNets.tolist(), arrPatchStart.tolist(), arrPatchEnd.tolist(), arrLinkStart.tolist(), arrLinkEnd.tolist()):
+            # Nodes of the graph numbered from 0 within the network
+            arrNetPatches = arrPatches[p0:p1]
+            arrNode[arrNetPatches] = numpy.arange(p1 - p0)
+            dicMetrics = HabitatNetworkGraph.PatchGraphMetrics(arrPatchArea[arrNetPatches], arrNode[dicLinks["From"][l0:l1]], arrNode[dicLinks["To"][l0:l1]],
+                                                               dicLinks["Cost"][l0:l1], Threshold, lFractions, arrNetArea[Network])
+            arrBetween[arrNetPatches] = dicMetrics["Betweenness"]
+            lRows.append([Network, p1 - p0, l1 - l0, arrNetArea[Network], dicMetrics["IIC"], dicMetrics["MeanCost"]] + dicMetrics["Components"])
+
+        strRoot = os.path.splitext(fnNetOut)[0]
+        def WriteCsv(fnCsv, strHeader, lColumns):
+            fOut = open(fnCsv, "w")
+            fOut.write(strHeader + "\n")
+            fOut.write("".join([",".join([str(x) for x in row]) + "\n" for row in zip(*[numpy.asarray(arr).tolist() for arr in lColumns])]))
+            fOut.close()
+        WriteCsv(strRoot + "_patchlinks.csv", "Network,From,To,Cost,X,Y", [dicLinks["Network"], dicLinks["From"], dicLinks["To"], dicLinks["Cost"],
+                 geoNetworks.XMin + dicLinks["Col"] * CellSize, geoNetworks.YMax - dicLinks["Row"] * CellSize])
+        WriteCsv(strRoot + "_patches.csv", "Patch,Network,Area,X,Y,Betweenness", [arrPatches, arrPatchNet[arrPatches], arrPatchArea[arrPatches],
+                 geoNetworks.XMin + arrCol[arrPatches] * CellSize, geoNetworks.YMax - arrRow[arrPatches] * CellSize, arrBetween[arrPatches]])
+        strHeader = "Network,Patches,Links,Area,IIC,Mean cost," + ",".join(["Components (%g%%)" %(100 * Fraction) for Fraction in lFractions])
+        WriteCsv(strRoot + "_within.csv", strHeader, list(zip(*lRows)) if lRows else [[]] * (6 + len(lFractions)))
+        stage.Outputs(strRoot + "_within.csv")
+
+    return
 
-        arcpy.AddField_management(fnHabOut, "PART_COUNT", "LONG")
-        cursor = arcpy.UpdateCursor(fnHabOut)
+
+
+def WriteCorridors(geoNetworks, ReadLand, dicLinks, PercentLCP, Nhood, strRoot, SpatialRef=None):
+    """Writes the least-cost corridors along the links between networks, keeping the cells within
+    PercentLCP percent of the cost of the least-cost path (see HabitatNetworkEngine.LeastCostCorridors).
+    Each corridor is a polygon in strRoot_corridors.shp, with its networks, the cost of its least-cost
+    path, its area, the mean and maximum cost of the paths through its cells and the mean landcover cost
+    of its cells, which also go in strRoot_corridors.csv. strRoot_corridors.tif counts the corridors
+    through each cell. The corridors are streamed to the files one at a time as they are found.
+    The landcover is given by a window reader (see LandReader). With memory mapped networks (a
+    tiled run) the count is kept in a memory mapped file too."""
+    CellSize = geoNetworks.CellSize
+    if isinstance(geoNetworks.arr, numpy.memmap):
+        geoCount = HabitatNetworkEngine.NewBil(geoNetworks, numpy.int32, tmp)
+    else:
+        geoCount = geoNetworks.Like(numpy.zeros(geoNetworks.Shape, numpy.int32))
+    arrCount = geoCount.arr
+    lStats = []
+    def Records():
+        for dicCorridor in HabitatNetworkEngine.LeastCostCorridors(geoNetworks.arr, ReadLand, CellSize, dicLinks["From"], dicLinks["To"],
+                                                                    dicLinks["Cost"], PercentLCP, Nhood):
+            r0, r1, c0, c1 = dicCorridor["Window"]
+            arrIn = ~numpy.isnan(dicCorridor["PathCost"])
+            arrCount[r0:r1, c0:c1] += arrIn
+            arrPath = dicCorridor["PathCost"][arrIn]
+            lValues = [dicCorridor["From"], dicCorridor["To"], dicCorridor["LCP"], arrPath.size * float(CellSize) ** 2,
+                       arrPath.mean(), arrPath.max(), numpy.asarray(ReadLand(r0, r1, c0, c1), numpy.float64)[arrIn].mean()]
+            lStats.append(lValues)
+            # The corridor vectorised on its own window of the grid
+            geoWindow = geoNetworks.Window(r0, r1, c0, c1).Like(arrIn.view(numpy.uint8))
+            for Label, arrPoints, arrParts in HabitatNetworkShapefile.IterLabelPolygons(geoWindow):
+                yield lValues, arrPoints, arrParts
+
+    with instrument.Stage("Corridors", [geoNetworks]) as stage:
+        lFields = [("FROM_NET", "N", 10, 0), ("TO_NET", "N", 10, 0), ("LCP_COST", "F", 19, 11), ("AREA", "F", 19, 11),
+                   ("MEAN_PATH", "F", 19, 11), ("MAX_PATH", "F", 19, 11), ("MEAN_COST", "F", 19, 11)]
+        HabitatNetworkShapefile.WritePolygons(strRoot + "_corridors.shp", Records(), lFields)
+
+        fOut = open(strRoot + "_corridors.csv", "w")
+        fOut.write("From,To,Least-cost path,Area,Mean path cost,Max path cost,Mean cost\n")
+        fOut.write("".join([",".join([str(x) for x in lValues]) + "\n" for lValues in lStats]))
+        fOut.close()
+
+        if isinstance(arrCount, numpy.memmap):
+            arrCount.flush()
+            arcpy.CopyRaster_management(arrCount.filename, strRoot + "_corridors.tif")
+            if SpatialRef is not None:
+                arcpy.DefineProjection_management(strRoot + "_corridors.tif", SpatialRef)
+        else:
+            SaveGeoArray(geoCount, strRoot + "_corridors.tif")
+        stage.Outputs(strRoot + "_corridors.shp", arrCount)
+    if SpatialRef is not None:
+        arcpy.DefineProjection_management(strRoot + "_corridors.shp", SpatialRef)
+
+    return
+
+
+
+def CostDistanceNumPy(fnSource, fnCost, fnOut, MaxCost, Nhood):
+    """Cost distance using the NumPy engine instead of arcpy.gp.CostDistance_sa.
+    The source raster is read onto the grid of the cost raster, and the output has the same grid."""
+    geoCost = ReadGeoArray(fnCost)
+    geoSource = ReadGeoArray(fnSource, geoCost)
+    arrDist = HabitatNetworkEngine.CostDistance(~numpy.isnan(geoSource.arr), geoCost.arr, geoCost.CellSize, MaxCost, Nhood)
+    SaveGeoArray(geoCost.Like(arrDist), fnOut)
+
+def ReadGeoArray(Raster, geoTemplate=None, Labels=False):
+    """Reads a raster (filename or arcpy Raster) into a GeoArray of floats with NaN for NoData.
+    If a template GeoArray is given, the array covers the same cells as the template.
+    With Labels, an integer label raster is read as it is, with 0 for NoData."""
+    if geoTemplate is None:
+        geoTemplate = DescribeGrid(Raster)
+    nRows, nCols = geoTemplate.nRows, geoTemplate.nCols
+    if Labels:
+        arr = arcpy.RasterToNumPyArray(Raster, arcpy.Point(geoTemplate.XMin, geoTemplate.YMin), nCols, nRows, 0)
+    else:
+        # Convert to floating point first so that NoData can be represented as NaN
+        arr = arcpy.RasterToNumPyArray(arcpy.sa.Float(Raster), arcpy.Point(geoTemplate.XMin, geoTemplate.YMin), nCols, nRows, numpy.nan)
+    return geoTemplate.Like(arr)
+
+def DescribeGrid(Raster):
+    """The grid of a raster (filename or arcpy Raster), as a GeoArray with no array"""
+    desc = arcpy.Describe(Raster)
+    CellSize = desc.meanCellWidth
+    nCols = int(round(desc.extent.width / CellSize))
+    nRows = int(round(desc.extent.height / CellSize))
+    return HabitatNetworkEngine.GeoArray(None, desc.extent.XMin, desc.extent.YMin, CellSize, desc.spatialReference, (nRows, nCols))
+
+def LabelGeoArray(Labels, geoTemplate=None):
+    """A label raster (filename, arcpy Raster or GeoArray) as a GeoArray of labels with 0 for NoData"""
+    if isinstance(Labels, HabitatNetworkEngine.GeoArray):
+        return Labels
+    return ReadGeoArray(Labels, geoTemplate, Labels=True)
+
+def LabelRaster(Labels):
+    """A label raster (filename, arcpy Raster or GeoArray) as something arcpy tools accept.
+    Memory mapped GeoArrays are given as their BIL file, others are converted to Rasters."""
+    if not isinstance(Labels, HabitatNetworkEngine.GeoArray):
+        return Labels
+    if isinstance(Labels.arr, numpy.memmap):
+        return Labels.arr.filename
+    return GeoArrayToRaster(Labels)
+
+def LandReader(Land, geoGrid):
+    """Window reader (see HabitatNetworkEngine.ArrayReader) for the landcover (filename, arcpy Raster
+    or GeoArray) on the grid of geoGrid. A file is read a window at a time through arcpy when geoGrid
+    is memory mapped (as the label rasters of a tiled run are), otherwise it is read whole."""
+    if isinstance(Land, HabitatNetworkEngine.GeoArray):
+        return HabitatNetworkEngine.ArrayReader(Land.arr)
+    if isinstance(geoGrid.arr, numpy.memmap):
+        return RasterReader(Land, geoGrid)
+    return HabitatNetworkEngine.ArrayReader(ReadGeoArray(Land, geoGrid).arr)
+
+def RasterReader(Raster, geoGrid):
+    """Window reader (as used by HabitatNetworkEngine.LCNTiled) for a raster on the grid of geoGrid.
+    Each window is read through arcpy, so only the window is ever held in memory."""
+    FloatRaster = arcpy.sa.Float(Raster)
+    def ReadWindow(r0, r1, c0, c1):
+        ptLowerLeft = arcpy.Point(geoGrid.XMin + c0 * geoGrid.CellSize, geoGrid.YMax - r1 * geoGrid.CellSize)
+        return arcpy.RasterToNumPyArray(FloatRaster, ptLowerLeft, c1 - c0, r1 - r0, numpy.nan)
+    return ReadWindow
+
+def GeoArrayToRaster(geo):
+    """Converts a GeoArray into an arcpy Raster (held by ArcGIS, not saved).
+    NoData is NaN for float arrays, 0 for label arrays and False for masks."""
+    arr = geo.arr
+    if arr.dtype == bool:
+        # The same bytes, so no copy
+        arr = arr.view(numpy.uint8)
+    if arr.dtype.kind == "f":
+        NoData = numpy.nan
+    else:
+        NoData = 0
+    return arcpy.NumPyArrayToRaster(arr, arcpy.Point(geo.XMin, geo.YMin), geo.CellSize, geo.CellSize, NoData)
+
+def SaveGeoArray(geo, fnOut):
+    """Saves a GeoArray as a raster file"""
+    GeoArrayToRaster(geo).save(fnOut)
+    if geo.SpatialRef is not None:
+        arcpy.DefineProjection_management(fnOut, geo.SpatialRef)
+
+def ExtendByGridCode(fnShp, lFields):
+    """Adds fields to a shapefile in one go, joining on GRIDCODE.
+    lFields is a list of (field name, array of values indexed by GRIDCODE)."""
+    nValues = len(lFields[0][1])
+    arrJoin = numpy.zeros(nValues - 1, dtype=[("GRIDCODE", numpy.int32)] + [(strField, arr.dtype) for (strField, arr) in lFields])
+    arrJoin["GRIDCODE"] = numpy.arange(1, nValues)
+    for strField, arr in lFields:
+        arrJoin[strField] = arr[1:]
+    try:
+        # Only works for ArcGIS 10.1+
+        arcpy.da.ExtendTable(fnShp, "GRIDCODE", arrJoin, "GRIDCODE")
+    except AttributeError:
+        # No arcpy.da in ArcGIS 10.0, so fill the fields with a single cursor pass instead
+        for strField, arr in lFields:
+            if arr.dtype.kind == "f":
+                arcpy.AddField_management(fnShp, strField, "DOUBLE")
+            else:
+                arcpy.AddField_management(fnShp, strField, "LONG")
+        cursor = arcpy.UpdateCursor(fnShp)
         for row in cursor:
-            row.setValue("PART_COUNT", dicPartCount[row.getValue("FID")])
+            GridCode = row.getValue("GRIDCODE")
+            for strField, arr in lFields:
+                row.setValue(strField, arr[GridCode].item())
             cursor.updateRow(row)
         del row, cursor
-    
-        # Create a path and filename for the csv file based on the other output files
-        # Note: could add extra filename parameter for this...
-        [pthOut, strNet] = os.path.split(fnNetOut)
-        strHab = os.path.split(fnHabOut)[1]
-        pthCsv = os.path.join(pthOut, "%s%s.csv" %(strNet.split(".")[0], strHab.split(".")[0]))
-
-        # Use cursor to collect the area info
-        dicNet = {}
-        dicHab = {}
-        cursor = arcpy.SearchCursor(fnNetOut)
-        for row in cursor:
-            dicNet[row.getValue("FID")] = row.getValue("POLY_AREA")
-        del row, cursor
-        cursor = arcpy.SearchCursor(fnHabOut)
-        for row in cursor:
-            dicHab[row.getValue("FID")] = [row.getValue("PART_COUNT"), row.getValue("POLY_AREA")]
-        del row, cursor
 
-        # Get the linear units of the shapefiles being used
-        strHabUnit = arcpy.Describe(fnHabOut).spatialReference.linearUnitName
-        strNetUnit = arcpy.Describe(fnNetOut).spatialReference.linearUnitName
-        if strHabUnit == "":
-            strHabUnit = "undefined"
-        if strNetUnit == "":
-            strNetUnit = "undefined"
-        
-        # Write the habitat and network area info to a csv file
-        fOut = open(pthCsv, "w")
-        fOut.write("Network,,Home,\nID,Area (%s^2),Count,Area (%s^2)\n" %(strHabUnit,strNetUnit))
-        for ID in dicNet.keys():
-            fOut.write("%s,%s,%s\n" %(ID,dicNet[ID],",".join([str(x) for x in dicHab[ID]])))
-        fOut.close()
+def DebugSave(geo, Debug):
+    """Saves an intermediate GeoArray to a scratch file when debugging"""
+    if Debug:
+        fnDebug = tmp("tif")
+        SaveGeoArray(geo, fnDebug)
+        print("DEBUG %s" %fnDebug)
+
 
-    # Message box to confirm that the analysis is complete
-    tkMessageBox.showinfo("Finised", "Habitat network tool has finished running")
-    
-    return
 
+# Persistent cache of rasterised inputs and cost surfaces (see HabitatNetworkEngine.Cache),
+# used when "Cache inputs and cost surfaces" is ticked
+pthCache = os.path.join(tempfile.gettempdir(), "HabitatNetworkCache")
+CacheMaxBytes = 4 * 1024 ** 3
 
+# Scratch files created by tmp() during a run, deleted by CleanScratch()
+lScratch = []
 
 def tmp(extension):
     """Generates a unique filename in the scratch folder using arcpy"""
@@ -429,7 +1165,63 @@ def tmp(extension):
         scratch = os.path.join(tempfile.gettempdir(), "scratch")
         if not os.path.exists(scratch):
             os.mkdir(scratch)
-    return arcpy.CreateUniqueName("tmp." + extension, scratch)
+    fnTmp = arcpy.CreateUniqueName("tmp." + extension, scratch)
+    lScratch.append(fnTmp)
+    return fnTmp
+
+def tmpVec(InMemory=False):
+    """Generates a unique name for a temporary feature class, either
+    in the in_memory workspace or as a shapefile in the scratch folder"""
+    if InMemory:
+        return arcpy.CreateUniqueName("tmp", "in_memory")
+    return tmp("shp")
+
+def CleanScratch():
+    """Deletes the scratch files made by tmp() and anything left in the in_memory workspace"""
+    for fnTmp in lScratch:
+        if arcpy.Exists(fnTmp):
+            arcpy.Delete_management(fnTmp)
+    del lScratch[:]
+    arcpy.Delete_management("in_memory")
+
+def ScratchBytes():
+    """The total size of the scratch files made by tmp() so far, including the
+    side files of rasters and shapefiles (e.g. .hdr, .dbf)"""
+    dicRoots = {}
+    for fnTmp in lScratch:
+        pthTmp, strTmp = os.path.split(fnTmp)
+        dicRoots.setdefault(pthTmp, set()).add(strTmp.split(".")[0])
+    Bytes = 0
+    for pthTmp in dicRoots:
+        if not os.path.isdir(pthTmp):
+            continue
+        for strFile in os.listdir(pthTmp):
+            if strFile.split(".")[0] in dicRoots[pthTmp]:
+                Bytes += os.path.getsize(os.path.join(pthTmp, strFile))
+    return Bytes
+
+
+
+# Instrument for the stages of a run, disabled unless a report is asked for
+instrument = HabitatNetworkInstrument.Instrument()
+
+def StartInstrument(Report=False, ProfileStage=None):
+    """Starts a fresh instrument for a run, enabled if a report is wanted"""
+    global instrument
+    instrument = HabitatNetworkInstrument.Instrument(Report, ProfileStage, ScratchBytes, DescribeRaster, HabitatNetworkEngine.WorkerCpuTime)
+    return instrument
+
+def ReportFilename(fnNetOut):
+    """The run report is written next to the network output, e.g. Networks_report.json"""
+    return os.path.splitext(fnNetOut)[0] + "_report.json"
+
+def DescribeRaster(Raster):
+    """Describes a raster file for the run report through arcpy"""
+    ras = arcpy.Raster(Raster)
+    dic = {"File": str(Raster), "Shape": [ras.height, ras.width], "CellSize": ras.meanCellWidth}
+    if ras.isInteger:
+        dic["Labels"] = ras.maximum
+    return dic
 
 
 
@@ -0,0 +1,625 @@
+# Tests for the arcpy-free parts of the habitat network tool
+# Each engine stage is checked against a plain reference: region groups
+# against scipy.ndimage, the habitat area filter patch by patch, cost
+# distance against a naive Dijkstra, the tiled run (serial and over a
+# pool) against the whole raster run, vectorising against rasterising,
+# the network areas and counts network by network, and the patch graph
+# metrics against brute force.
+# Run with "python -m unittest test_HabitatNetwork" (or pytest). Only
+# numpy 1.9 is needed (as shipped with ArcGIS 10.4), so NaNs are compared
+# through isnan masks rather than the newer equal_nan arguments.
+#
+#########################################################
+
+
+import itertools, os, shutil, sys, tempfile, time, unittest
+import numpy
+
+import HabitatNetworkEngine, HabitatNetworkGraph, HabitatNetworkInstrument, HabitatNetworkShapefile
+
+try:
+    import scipy.ndimage
+except ImportError:
+    scipy = None
+
+try:
+    import arcpy
+except ImportError:
+    arcpy = None
+
+
+
+def RandomLandscape(nRows, nCols, Seed, HabCover=0.08):
+    """A random habitat raster (0 for habitat, NaN elsewhere) and landcover cost raster (1 to 6,
+    with a few NoData barriers), clumped by smoothing random noise"""
+    rng = numpy.random.RandomState(Seed)
+    arrNoise = rng.rand(nRows + 4, nCols + 4)
+    arrSmooth = sum([arrNoise[r:r + nRows, c:c + nCols] for r in range(5) for c in range(5)]) / 25.0
+    arrHab = numpy.where(arrSmooth > numpy.percentile(arrSmooth, 100 * (1 - HabCover)), 0.0, numpy.nan)
+    arrCost = 1.0 + 5.0 * rng.rand(nRows, nCols)
+    arrCost[(rng.rand(nRows, nCols) < 0.02) & numpy.isnan(arrHab)] = numpy.nan
+    return arrHab.astype(numpy.float32), arrCost.astype(numpy.float32)
+
+
+def SameNaN(arr1, arr2):
+    """True if the arrays are NaN in the same cells and equal everywhere else"""
+    arr1, arr2 = numpy.asarray(arr1), numpy.asarray(arr2)
+    arrNaN = numpy.isnan(arr1)
+    return arr1.shape == arr2.shape and numpy.array_equal(arrNaN, numpy.isnan(arr2)) and numpy.array_equal(arr1[~arrNaN], arr2[~arrNaN])
+
+
+def CloseNaN(arr1, arr2, rtol):
+    """True if the arrays are NaN in the same cells and within rtol everywhere else"""
+    arrNaN = numpy.isnan(arr1)
+    return numpy.array_equal(arrNaN, numpy.isnan(arr2)) and numpy.allclose(arr1[~arrNaN], arr2[~arrNaN], rtol=rtol, atol=0)
+
+
+def NaiveCostDistance(arrSource, arrCost, CellSize, Nhood):
+    """Cost distance by the textbook O(n^2) Dijkstra, with no heap and no bounds"""
+    nRows, nCols = arrCost.shape
+    dicDist = {}
+    for r, c in zip(*numpy.nonzero(arrSource & ~numpy.isnan(arrCost))):
+        dicDist[(r, c)] = 0.0
+    setDone = set()
+    while True:
+        lLeft = [(d, cell) for cell, d in dicDist.items() if cell not in setDone]
+        if not lLeft:
+            break
+        d, (r, c) = min(lLeft)
+        setDone.add((r, c))
+        for dr, dc, f in HabitatNetworkEngine.dicOffsets[Nhood]:
+            rr, cc = r + dr, c + dc
+            if 0 <= rr < nRows and 0 <= cc < nCols and not numpy.isnan(arrCost[rr, cc]):
+                dNew = d + (arrCost[r, c] + arrCost[rr, cc]) / 2.0 * CellSize * f
+                if dNew < dicDist.get((rr, cc), numpy.inf):
+                    dicDist[(rr, cc)] = dNew
+    arrDist = numpy.empty((nRows, nCols))
+    arrDist.fill(numpy.nan)
+    for (r, c), d in dicDist.items():
+        arrDist[r, c] = d
+    return arrDist
+
+
+
+class TestRegionGroup(unittest.TestCase):
+    @unittest.skipIf(scipy is None, "needs scipy")
+    def test_matches_ndimage(self):
+        rng = numpy.random.RandomState(1)
+        for Nhood in (4, 8):
+            structure = numpy.ones((3, 3)) if Nhood == 8 else None
+            for t in range(10):
+                arr = rng.randint(0, 4, (37, 53)).astype(numpy.float64)
+                arr[arr == 0] = numpy.nan
+                # Label each value's cells on their own, then number the groups in order of their first cell
+                arrRef = numpy.zeros(arr.shape, numpy.int64)
+                nGroups = 0
+                for Value in (1, 2, 3):
+                    arrValue, n = scipy.ndimage.label(arr == Value, structure)
+                    arrRef[arrValue > 0] = arrValue[arrValue > 0] + nGroups
+                    nGroups += n
+                arrGroups, arrFirst, arrInverse = numpy.unique(arrRef.ravel(), return_index=True, return_inverse=True)
+                arrRank = numpy.zeros(len(arrGroups), numpy.int64)
+                arrRank[numpy.argsort(arrFirst[1:]) + 1] = numpy.arange(1, len(arrGroups))
+                arrLabels = HabitatNetworkEngine.RegionGroup(arr, Nhood)
+                self.assertTrue(numpy.array_equal(arrLabels.ravel(), arrRank[arrInverse.ravel()]))
+                self.assertEqual(arrLabels.dtype, HabitatNetworkEngine.LabelDType(nGroups))
+
+
+
+class TestSelectHabByArea(unittest.TestCase):
+    def test_matches_patch_by_patch(self):
+        arrHab, arrCost = RandomLandscape(60, 70, 9, 0.15)
+        for Nhood in (4, 8):
+            arrPatches = HabitatNetworkEngine.RegionGroup(arrHab, Nhood)
+            MinHabArea = 12 * 10.0 ** 2
+            # The kept patches numbered from 0 in region group order, as the FIDs of the selected polygons
+            arrRef = numpy.empty(arrHab.shape, numpy.float32)
+            arrRef.fill(numpy.nan)
+            FID = 0
+            for Patch in range(1, int(arrPatches.max()) + 1):
+                arrIn = arrPatches == Patch
+                if arrIn.sum() * 10.0 ** 2 >= MinHabArea:
+                    arrRef[arrIn] = FID
+                    FID += 1
+            self.assertTrue(0 < FID < arrPatches.max())
+            arrSelected = HabitatNetworkEngine.SelectHabByArea(arrHab, MinHabArea, 10.0, Nhood)
+            self.assertEqual(arrSelected.dtype, numpy.float32)
+            self.assertTrue(SameNaN(arrSelected, arrRef))
+            arrMask = HabitatNetworkEngine.SelectHabByArea(arrHab, MinHabArea, 10.0, Nhood, Mask=True)
+            self.assertTrue(numpy.array_equal(arrMask, ~numpy.isnan(arrRef)))
+
+
+
+class TestCostDistance(unittest.TestCase):
+    def Engines(self):
+        """Runs the body of a loop over this with scipy's Dijkstra (if installed) and without"""
+        scipyModule = HabitatNetworkEngine.scipy
+        try:
+            for Mode in ([scipyModule, None] if scipyModule is not None else [None]):
+                HabitatNetworkEngine.scipy = Mode
+                yield Mode
+        finally:
+            HabitatNetworkEngine.scipy = scipyModule
+
+    def test_matches_naive_dijkstra(self):
+        for Mode, Nhood in itertools.product(self.Engines(), (4, 8)):
+            rng = numpy.random.RandomState(2)
+            for t in range(4):
+                arrCost = 0.5 + 3 * rng.rand(14, 17)
+                arrCost[rng.rand(14, 17) < 0.1] = numpy.nan
+                arrSource = rng.rand(14, 17) < 0.03
+                arrSource[0, 0] = True
+                arrRef = NaiveCostDistance(arrSource, arrCost, 2.5, Nhood)
+                arrDist = HabitatNetworkEngine.CostDistance(arrSource, arrCost, 2.5, None, Nhood)
+                self.assertTrue(CloseNaN(arrDist, arrRef, 1e-12))
+                # Bounded, the cells beyond MaxCost are NoData and the rest unchanged
+                MaxCost = numpy.nanmedian(arrRef)
+                arrDist = HabitatNetworkEngine.CostDistance(arrSource, arrCost, 2.5, MaxCost, Nhood)
+                arrRef[arrRef > MaxCost] = numpy.nan
+                self.assertTrue(CloseNaN(arrDist, arrRef, 1e-12))
+                # A float32 cost raster gives the same as its values in float64
+                arrCost32 = arrCost.astype(numpy.float32)
+                self.assertTrue(SameNaN(HabitatNetworkEngine.CostDistance(arrSource, arrCost32, 2.5, MaxCost, Nhood),
+                                        HabitatNetworkEngine.CostDistance(arrSource, arrCost32.astype(numpy.float64), 2.5, MaxCost, Nhood)))
+
+    def test_allocation_matches_distance(self):
+        arrHab, arrCost = RandomLandscape(40, 50, 3)
+        arrZones = HabitatNetworkEngine.RegionGroup(arrHab)
+        for Mode in self.Engines():
+            arrDist, arrAlloc = HabitatNetworkEngine.CostAllocation(arrZones, arrCost, 10.0, 200.0)
+            arrRef = HabitatNetworkEngine.CostDistance(arrZones > 0, arrCost, 10.0, 200.0)
+            self.assertTrue(SameNaN(arrDist, arrRef))
+            self.assertTrue(numpy.array_equal(arrAlloc > 0, ~numpy.isnan(arrRef)))
+            self.assertTrue(numpy.array_equal(arrAlloc[arrZones > 0], arrZones[arrZones > 0]))
+
+    @unittest.skipIf(HabitatNetworkEngine.scipy is None, "needs scipy 1.3 or later")
+    def test_scipy_matches_pure_python(self):
+        arrHab, arrCost = RandomLandscape(120, 90, 8)
+        arrZones = HabitatNetworkEngine.RegionGroup(arrHab)
+        for Nhood, MaxCost in itertools.product((4, 8), (None, 400.0)):
+            lRuns = [(HabitatNetworkEngine.CostDistance(arrZones > 0, arrCost, 10.0, MaxCost, Nhood),
+                      HabitatNetworkEngine.CostAllocation(arrZones, arrCost, 10.0, MaxCost, Nhood)) for Mode in self.Engines()]
+            self.assertTrue(SameNaN(lRuns[0][0], lRuns[1][0]))
+            self.assertTrue(SameNaN(lRuns[0][1][0], lRuns[1][1][0]))
+            self.assertTrue(numpy.array_equal(lRuns[0][1][1], lRuns[1][1][1]))
+
+    def test_bounded_links_match_unbounded(self):
+        arrHab, arrCost = RandomLandscape(40, 50, 3, 0.05)
+        arrZones = HabitatNetworkEngine.RegionGroup(arrHab)
+        arrDist, arrAlloc = HabitatNetworkEngine.CostAllocation(arrZones, arrCost, 10.0, None)
+        dicRef = HabitatNetworkEngine.ZoneLinks(arrDist, arrAlloc, arrCost, 10.0)
+        MaxCost = numpy.median(dicRef["Cost"])
+        arrDist, arrAlloc = HabitatNetworkEngine.CostAllocation(arrZones, arrCost, 10.0, MaxCost)
+        dicLinks = HabitatNetworkEngine.ZoneLinks(arrDist, arrAlloc, arrCost, 10.0, 8, MaxCost)
+        arrKeep = dicRef["Cost"] <= MaxCost
+        self.assertTrue(0 < arrKeep.sum() < len(arrKeep))
+        for Key in ("From", "To", "Cost", "Row", "Col"):
+            self.assertTrue(numpy.array_equal(dicLinks[Key], dicRef[Key][arrKeep]))
+
+    def test_corridors_match_whole_surfaces(self):
+        arrHab, arrCost = RandomLandscape(40, 50, 3, 0.05)
+        arrZones = HabitatNetworkEngine.RegionGroup(arrHab)
+        arrDist, arrAlloc = HabitatNetworkEngine.CostAllocation(arrZones, arrCost, 10.0, None)
+        dicLinks = HabitatNetworkEngine.ZoneLinks(arrDist, arrAlloc, arrCost, 10.0)
+        PercentLCP = 10
+        lCorridors = list(HabitatNetworkEngine.LeastCostCorridors(arrZones, HabitatNetworkEngine.ArrayReader(arrCost), 10.0, dicLinks["From"],
+                                                                  dicLinks["To"], dicLinks["Cost"], PercentLCP, BlockRows=7))
+        self.assertEqual(len(lCorridors), len(dicLinks["From"]))
+        for dicCorridor, From, To, LinkCost in zip(lCorridors, dicLinks["From"], dicLinks["To"], dicLinks["Cost"]):
+            # The sum of the unbounded cost distances over the whole raster, within PercentLCP of its minimum
+            arrPath = HabitatNetworkEngine.CostDistance(arrZones == From, arrCost, 10.0) + HabitatNetworkEngine.CostDistance(arrZones == To, arrCost, 10.0)
+            LCP = numpy.nanmin(arrPath)
+            arrPath[~(arrPath <= LCP * (1 + PercentLCP / 100.0 + 1e-9))] = numpy.nan
+            self.assertEqual((dicCorridor["From"], dicCorridor["To"]), (From, To))
+            self.assertEqual(dicCorridor["LCP"], LCP)
+            # The link crosses from one allocated area to the other, but the path may cut through a third
+            self.assertTrue(LCP <= LinkCost * (1 + 1e-12))
+            r0, r1, c0, c1 = dicCorridor["Window"]
+            arrWindow = numpy.empty(arrPath.shape)
+            arrWindow.fill(numpy.nan)
+            arrWindow[r0:r1, c0:c1] = dicCorridor["PathCost"]
+            self.assertTrue(SameNaN(arrWindow, arrPath))
+
+
+
+class TestArcGIS(unittest.TestCase):
+    @unittest.skipIf(arcpy is None, "needs arcpy")
+    def test_matches_arcgis_cost_distance(self):
+        """The NumPy engine against arcpy.sa.CostDistance (8 cell neighbourhood, as ArcGIS has no
+        other), to within ArcGIS's float32 output. The timings of both are printed."""
+        if arcpy.CheckExtension("Spatial") != "Available":
+            self.skipTest("needs the Spatial Analyst extension")
+        arcpy.CheckOutExtension("Spatial")
+        pthScratch = tempfile.mkdtemp()
+        arcpy.env.scratchWorkspace = arcpy.env.workspace = pthScratch
+        try:
+            CellSize, MaxCost, NoData = 10.0, 3000.0, -9999.0
+            arrHab, arrCost = RandomLandscape(1000, 1000, 9)
+            ptLowerLeft = arcpy.Point(0.0, 0.0)
+            rasSource = arcpy.NumPyArrayToRaster(numpy.where(numpy.isnan(arrHab), NoData, 1.0), ptLowerLeft, CellSize, CellSize, NoData)
+            rasCost = arcpy.NumPyArrayToRaster(numpy.where(numpy.isnan(arrCost), NoData, arrCost), ptLowerLeft, CellSize, CellSize, NoData)
+            Start = time.time()
+            arrArcGIS = arcpy.RasterToNumPyArray(arcpy.sa.CostDistance(rasSource, rasCost, MaxCost), nodata_to_value=numpy.nan)
+            ArcGIS = time.time() - Start
+            Start = time.time()
+            arrNumPy = HabitatNetworkEngine.CostDistance(~numpy.isnan(arrHab), arrCost, CellSize, MaxCost, 8)
+            NumPy = time.time() - Start
+            sys.stderr.write("\nCost distance of 1000 x 1000 cells: ArcGIS %.2f s, NumPy engine %.2f s (%s)\n"
+                             %(ArcGIS, NumPy, "scipy" if HabitatNetworkEngine.scipy is not None else "pure Python"))
+            # Cells can only fall either side of MaxCost by ArcGIS's float32 rounding
+            arrBoth = ~numpy.isnan(arrArcGIS) & ~numpy.isnan(arrNumPy)
+            arrEither = numpy.isnan(arrArcGIS) != numpy.isnan(arrNumPy)
+            self.assertTrue(numpy.allclose(arrArcGIS[arrBoth], arrNumPy[arrBoth], rtol=1e-5, atol=0))
+            self.assertTrue(numpy.allclose(numpy.fmin(arrArcGIS, arrNumPy)[arrEither], MaxCost, rtol=1e-5, atol=0))
+        finally:
+            arcpy.CheckInExtension("Spatial")
+            shutil.rmtree(pthScratch, ignore_errors=True)
+
+
+
+class TestTiled(unittest.TestCase):
+    def setUp(self):
+        self.pthScratch = tempfile.mkdtemp()
+        self.counter = itertools.count()
+
+    def tearDown(self):
+        shutil.rmtree(self.pthScratch, ignore_errors=True)
+
+    def Scratch(self, strExt):
+        return os.path.join(self.pthScratch, "t%s.%s" %(next(self.counter), strExt))
+
+    def test_tiled_matches_whole_raster(self):
+        CellSize, MaxCost, MinHabArea = 10.0, 300.0, 800.0
+        arrHab, arrCost = RandomLandscape(130, 110, 4)
+        geoGrid = HabitatNetworkEngine.GeoArray(arrHab, 0.0, 0.0, CellSize)
+        for Nhood in (4, 8):
+            arrSource = HabitatNetworkEngine.SelectHabByArea(arrHab, MinHabArea, CellSize, Nhood, Mask=True)
+            arrCostDist = HabitatNetworkEngine.CostDistance(arrSource, arrCost, CellSize, MaxCost, Nhood, numpy.float32)
+            lWhole = HabitatNetworkEngine.NetworksFromCostDist(arrCostDist, arrHab, Nhood)
+            dicStats = HabitatNetworkEngine.NetworkStats(lWhole[0], lWhole[1], lWhole[2], CellSize)
+
+            lRuns = [HabitatNetworkEngine.LCNTiled(HabitatNetworkEngine.ArrayReader(arrHab), HabitatNetworkEngine.ArrayReader(arrCost),
+                                                   geoGrid, MaxCost, Nhood, MinHabArea, self.Scratch, 40, Workers)
+                     for Workers in (1, 3)]
+            for dicRun in lRuns:
+                self.assertTrue(SameNaN(dicRun["CostDist"].arr, arrCostDist))
+                for strKey, arrWhole in zip(("Networks", "HabNetworks", "HabRegions"), lWhole):
+                    self.assertTrue(numpy.array_equal(numpy.asarray(dicRun[strKey].arr), arrWhole), strKey)
+                self.assertTrue(numpy.array_equal(dicRun["PartCount"], dicStats["PartCount"]))
+            # Over a pool the output files are byte for byte the same as the serial run's
+            for strKey in ("CostDist", "Networks", "HabNetworks", "HabRegions"):
+                self.assertEqual(numpy.asarray(lRuns[0][strKey].arr).tobytes(), numpy.asarray(lRuns[1][strKey].arr).tobytes(), strKey)
+
+            # A smaller distance from the same surface, as in a sweep
+            lSmaller = HabitatNetworkEngine.NetworksFromCostDist(arrCostDist, arrHab, Nhood, MaxCost / 2)
+            for Workers in (1, 3):
+                dicRun = HabitatNetworkEngine.NetworksTiled(lRuns[0]["CostDist"], HabitatNetworkEngine.ArrayReader(arrHab), Nhood,
+                                                            self.Scratch, 40, Workers, MaxCost / 2)
+                for strKey, arrWhole in zip(("Networks", "HabNetworks", "HabRegions"), lSmaller):
+                    self.assertTrue(numpy.array_equal(numpy.asarray(dicRun[strKey].arr), arrWhole), strKey)
+
+    def test_patch_links_read_by_window(self):
+        CellSize, MaxCost = 10.0, 100.0
+        arrHab, arrCost = RandomLandscape(130, 110, 5)
+        arrCostDist = HabitatNetworkEngine.CostDistance(HabitatNetworkEngine.IsData(arrHab), arrCost, CellSize, MaxCost, 8, numpy.float32)
+        arrNetworks, arrHabNetworks, arrRegions = HabitatNetworkEngine.NetworksFromCostDist(arrCostDist, arrHab, 8)
+        # The label rasters as memmaps, as in a tiled run
+        lMemmaps = []
+        for arr in (arrNetworks, arrRegions):
+            fn = self.Scratch("bil")
+            arr.tofile(fn)
+            lMemmaps.append(numpy.memmap(fn, arr.dtype, "r", shape=arr.shape))
+        mmNetworks, mmRegions = lMemmaps
+
+        arrR0, arrR1, arrC0, arrC1 = HabitatNetworkEngine.LabelBoxes(mmNetworks, BlockRows=7)
+        for Network in range(1, int(arrNetworks.max()) + 1):
+            arrR, arrC = numpy.nonzero(arrNetworks == Network)
+            self.assertEqual((arrR0[Network], arrR1[Network], arrC0[Network], arrC1[Network]), (arrR.min(), arrR.max() + 1, arrC.min(), arrC.max() + 1))
+        arrPatchNet, arrPatchCells, arrNetCells = HabitatNetworkEngine.PatchNetworks(mmNetworks, mmRegions, BlockRows=7)
+        self.assertTrue(numpy.array_equal(arrPatchCells, numpy.bincount(arrRegions.ravel())))
+        self.assertTrue(numpy.array_equal(arrNetCells, numpy.bincount(arrNetworks.ravel())))
+        self.assertTrue(numpy.array_equal(arrPatchNet[arrRegions[arrRegions > 0]], arrNetworks[arrRegions > 0]))
+
+        # Only the windows of networks with several patches are read
+        lWindows = []
+        ReadWhole = HabitatNetworkEngine.ArrayReader(arrCost)
+        def ReadWindow(r0, r1, c0, c1):
+            lWindows.append((r0, r1, c0, c1))
+            return ReadWhole(r0, r1, c0, c1)
+        dicLinks = HabitatNetworkEngine.PatchLinks(mmNetworks, mmRegions, ReadWindow, CellSize)
+        dicRef = HabitatNetworkEngine.PatchLinks(arrNetworks, arrRegions, ReadWhole, CellSize)
+        self.assertTrue(len(dicLinks["From"]) > 0)
+        for strKey in dicRef:
+            self.assertTrue(numpy.array_equal(dicLinks[strKey], dicRef[strKey]), strKey)
+        lBoxes = [(arrR0[Network], arrR1[Network], arrC0[Network], arrC1[Network]) for Network in numpy.unique(dicLinks["Network"]).tolist()]
+        self.assertTrue(set(lBoxes) <= set(lWindows))
+        self.assertTrue(all([(r1 - r0) * (c1 - c0) < arrCost.size for r0, r1, c0, c1 in lWindows]))
+
+    def test_tiled_links_match_whole_raster(self):
+        CellSize, MaxCost = 10.0, 60.0
+        arrHab, arrCost = RandomLandscape(130, 110, 7)
+        arrCostDist = HabitatNetworkEngine.CostDistance(HabitatNetworkEngine.IsData(arrHab), arrCost, CellSize, MaxCost, 8, numpy.float32)
+        arrNetworks = HabitatNetworkEngine.NetworksFromCostDist(arrCostDist, arrHab, 8)[0]
+        for Nhood in (4, 8):
+            arrDist, arrAlloc = HabitatNetworkEngine.CostAllocation(arrNetworks, arrCost, CellSize, 2 * MaxCost, Nhood)
+            dicWhole = HabitatNetworkEngine.ZoneLinks(arrDist, arrAlloc, arrCost, CellSize, Nhood, 2 * MaxCost)
+            dicTiled = HabitatNetworkEngine.ZoneLinksTiled(HabitatNetworkEngine.ArrayReader(arrNetworks), HabitatNetworkEngine.ArrayReader(arrCost),
+                                                           arrCost.shape, CellSize, 2 * MaxCost, Nhood, 40)
+            self.assertTrue(len(dicWhole["From"]) > 20)
+            for strKey in ("From", "To", "Row", "Col"):
+                self.assertTrue(numpy.array_equal(dicTiled[strKey], dicWhole[strKey]), strKey)
+            self.assertTrue(numpy.allclose(dicTiled["Cost"], dicWhole["Cost"], rtol=1e-12, atol=0))
+
+
+
+class TestNetworkStats(unittest.TestCase):
+    def setUp(self):
+        self.pthScratch = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.pthScratch, ignore_errors=True)
+
+    def Networks(self, Nhood):
+        CellSize, MaxCost = 10.0, 100.0
+        arrHab, arrCost = RandomLandscape(70, 80, 6)
+        arrSource = HabitatNetworkEngine.SelectHabByArea(arrHab, 300.0, CellSize, Nhood, Mask=True)
+        arrCostDist = HabitatNetworkEngine.CostDistance(arrSource, arrCost, CellSize, MaxCost, Nhood, numpy.float32)
+        return HabitatNetworkEngine.NetworksFromCostDist(arrCostDist, arrHab, Nhood), arrCostDist
+
+    def test_matches_network_by_network(self):
+        for Nhood in (4, 8):
+            (arrNetworks, arrHabNetworks, arrRegions), arrCostDist = self.Networks(Nhood)
+            # A few rows a block, so the patches of a network span several blocks
+            dicStats = HabitatNetworkEngine.NetworkStats(arrNetworks, arrHabNetworks, arrRegions, 10.0, arrCostDist, BlockRows=7)
+            self.assertTrue(arrNetworks.max() > 3)
+            for Net in range(1, int(arrNetworks.max()) + 1):
+                arrIn = arrNetworks == Net
+                self.assertEqual(dicStats["NetCells"][Net], arrIn.sum())
+                self.assertEqual(dicStats["NetArea"][Net], arrIn.sum() * 100.0)
+                self.assertEqual(dicStats["HabArea"][Net], (arrHabNetworks == Net).sum() * 100.0)
+                self.assertEqual(dicStats["PartCount"][Net], len(set(arrRegions[arrIn & (arrRegions > 0)].tolist())))
+                arrNetCost = arrCostDist[arrIn].astype(numpy.float64)
+                self.assertTrue(numpy.allclose(dicStats["MeanCost"][Net], arrNetCost.mean(), rtol=1e-12, atol=0))
+                self.assertEqual(dicStats["MaxCost"][Net], arrNetCost.max())
+            # The same by the whole raster, and without the cost distance
+            dicWhole = HabitatNetworkEngine.NetworkStats(arrNetworks, arrHabNetworks, arrRegions, 10.0)
+            self.assertFalse("MeanCost" in dicWhole)
+            for strKey in ("NetCells", "NetArea", "HabArea", "PartCount"):
+                self.assertTrue(numpy.array_equal(dicWhole[strKey], dicStats[strKey]), strKey)
+
+    def test_area_csv(self):
+        for Nhood in (4, 8):
+            (arrNetworks, arrHabNetworks, arrRegions), arrCostDist = self.Networks(Nhood)
+            for arrDist in (None, arrCostDist):
+                dicStats = HabitatNetworkEngine.NetworkStats(arrNetworks, arrHabNetworks, arrRegions, 10.0, arrDist)
+                # A network with no habitat, as a 4 cell neighbourhood can leave
+                for strKey in dicStats:
+                    dicStats[strKey] = numpy.append(dicStats[strKey], 0 if strKey == "HabArea" else 5)
+                fnCsv = os.path.join(self.pthScratch, "areas%s.csv" %Nhood)
+                HabitatNetworkEngine.WriteAreaCsv(fnCsv, dicStats, Nhood, "m", "m")
+                fCsv = open(fnCsv)
+                lLines = fCsv.read().splitlines()
+                fCsv.close()
+                lNets = [Net for Net in range(1, len(dicStats["NetCells"])) if dicStats["NetCells"][Net] > 0
+                         and (Nhood == 8 or dicStats["HabArea"][Net] > 0)]
+                if arrDist is None:
+                    self.assertEqual(lLines[:2], ["Network,,Home,", "ID,Area (m^2),Count,Area (m^2)"])
+                else:
+                    self.assertEqual(lLines[:2], ["Network,,Home,,Network cost distance,,", "ID,Area (m^2),Count,Area (m^2),Cells,Mean,Max"])
+                self.assertEqual(len(lLines) - 2, len(lNets))
+                self.assertEqual(len(lNets) == arrNetworks.max() + 1, Nhood == 8)
+                for FID, (strLine, Net) in enumerate(zip(lLines[2:], lNets)):
+                    lRow = [float(x) for x in strLine.split(",")]
+                    self.assertEqual(lRow[:4], [FID, dicStats["NetArea"][Net], dicStats["PartCount"][Net], dicStats["HabArea"][Net]])
+                    if arrDist is not None:
+                        self.assertEqual(lRow[4:], [dicStats["NetCells"][Net], dicStats["MeanCost"][Net], dicStats["MaxCost"][Net]])
+
+
+
+class TestShapefile(unittest.TestCase):
+    def setUp(self):
+        self.pthScratch = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.pthScratch, ignore_errors=True)
+
+    def test_vectorise_rasterise_round_trip(self):
+        rng = numpy.random.RandomState(5)
+        arrHab = RandomLandscape(45, 60, 5, HabCover=0.4)[0]
+        for Nhood in (4, 8):
+            # Labels with holes and diagonal contacts, some of them left out
+            arrLabels = HabitatNetworkEngine.RegionGroup(numpy.where(numpy.isnan(arrHab), numpy.nan, rng.randint(1, 3, arrHab.shape)), Nhood)
+            geoLabels = HabitatNetworkEngine.GeoArray(arrLabels, 1000.0, 2000.0, 5.0)
+            lKeep = list(range(1, int(arrLabels.max()) + 1, 2))
+            fnShp = os.path.join(self.pthScratch, "labels%s.shp" %Nhood)
+            nPolygons = HabitatNetworkShapefile.WriteLabelShapefile(geoLabels, fnShp, lKeep)
+            self.assertEqual(nPolygons, len(lKeep))
+            arrBack = HabitatNetworkShapefile.RasterisePolygons(fnShp, "GRIDCODE", geoLabels).arr
+            arrKeep = numpy.zeros(int(arrLabels.max()) + 1, bool)
+            arrKeep[lKeep] = True
+            arrExpected = numpy.where(arrKeep[arrLabels], arrLabels, numpy.nan)
+            self.assertTrue(SameNaN(arrBack, arrExpected))
+
+    def test_only_number_fields_are_read(self):
+        arrLabels = numpy.array([[1, 1, 0], [0, 2, 2]], dtype=numpy.uint8)
+        fnShp = os.path.join(self.pthScratch, "fields.shp")
+        HabitatNetworkShapefile.WriteLabelShapefile(HabitatNetworkEngine.GeoArray(arrLabels, 0.0, 0.0, 1.0), fnShp,
+                                                    lExtraFields=[(("COST", "N", 10, 2), numpy.array([0.0, 1.25, 7.5]))])
+        self.assertEqual([Value for Value, lRings in HabitatNetworkShapefile.IterPolygons(fnShp, "COST")], [1.25, 7.5])
+        # The same bytes declared as another type (e.g. the binary integers of Visual FoxPro) are refused
+        fnDbf = fnShp[:-4] + ".dbf"
+        for strType in ("I", "B", "C"):
+            fDbf = open(fnDbf, "r+b")
+            fDbf.seek(32 * 2 + 11)
+            fDbf.write(strType.encode("ascii"))
+            fDbf.close()
+            self.assertRaises(ValueError, lambda: list(HabitatNetworkShapefile.IterPolygons(fnShp, "COST")))
+
+
+
+class TestPatchGraph(unittest.TestCase):
+    def BruteForce(self, arrArea, arrA, arrB, arrCost, Threshold, lFractions, AreaTotal):
+        """The metrics of PatchGraphMetrics from Floyd-Warshall over the whole graph"""
+        nNodes = len(arrArea)
+        def AllPairs(arrKeep, arrWeight):
+            arrDist = numpy.empty((nNodes, nNodes))
+            arrDist.fill(numpy.inf)
+            numpy.fill_diagonal(arrDist, 0.0)
+            for a, b, w in zip(arrA[arrKeep], arrB[arrKeep], arrWeight[arrKeep]):
+                arrDist[a, b] = arrDist[b, a] = min(arrDist[a, b], w)
+            for k in range(nNodes):
+                arrDist = numpy.minimum(arrDist, arrDist[:, k:k + 1] + arrDist[k:k + 1, :])
+            return arrDist
+        arrLinks = AllPairs(arrCost <= Threshold, numpy.ones(len(arrCost)))
+        arrDist = AllPairs(numpy.ones(len(arrCost), bool), arrCost)
+        lComponents = [len(set(numpy.isfinite(AllPairs(arrCost <= Fraction * Threshold, arrCost)).argmax(axis=1).tolist()))
+                       for Fraction in lFractions]
+        arrPair = numpy.isfinite(arrDist) & ~numpy.eye(nNodes, dtype=bool)
+        arrBetween = numpy.zeros(nNodes)
+        for s in range(nNodes):
+            for t in range(s + 1, nNodes):
+                if arrPair[s, t]:
+                    arrOn = numpy.isclose(arrDist[s] + arrDist[:, t], arrDist[s, t], rtol=1e-12, atol=0)
+                    arrOn[[s, t]] = False
+                    arrBetween += arrOn
+        return {"IIC": (arrArea[:, None] * arrArea[None, :] / (1.0 + arrLinks)).sum() / AreaTotal ** 2,
+                "Components": lComponents, "MeanCost": arrDist[arrPair].mean(), "Betweenness": arrBetween}
+
+    def test_matches_brute_force(self):
+        rng = numpy.random.RandomState(6)
+        nNodes = 40
+        lPairs = sorted(set([tuple(sorted(rng.choice(nNodes, 2, replace=False).tolist())) for i in range(70)]))
+        arrA, arrB = numpy.array(lPairs).T
+        arrCost = 1 + 99 * rng.rand(len(lPairs))
+        arrArea = 1 + 10 * rng.rand(nNodes)
+        Threshold, lFractions = 60.0, (0.25, 0.5, 1.0)
+        dicRef = self.BruteForce(arrArea, arrA, arrB, arrCost, Threshold, lFractions, 1000.0)
+        lModes = [HabitatNetworkGraph.scipy, None] if HabitatNetworkGraph.scipy is not None else [None]
+        scipyModule = HabitatNetworkGraph.scipy
+        try:
+            for Mode in lModes:
+                # With and without scipy, in batches smaller than the graph
+                HabitatNetworkGraph.scipy = Mode
+                dic = HabitatNetworkGraph.PatchGraphMetrics(arrArea, arrA, arrB, arrCost, Threshold, lFractions, 1000.0, BatchSize=7)
+                self.assertTrue(numpy.isclose(dic["IIC"], dicRef["IIC"], rtol=1e-12))
+                self.assertEqual(list(dic["Components"]), dicRef["Components"])
+                self.assertTrue(numpy.isclose(dic["MeanCost"], dicRef["MeanCost"], rtol=1e-12))
+                self.assertTrue(numpy.array_equal(dic["Betweenness"], dicRef["Betweenness"]))
+        finally:
+            HabitatNetworkGraph.scipy = scipyModule
+
+
+
+class TestCache(unittest.TestCase):
+    def setUp(self):
+        self.pthScratch = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.pthScratch, ignore_errors=True)
+
+    def test_round_trip_and_keys(self):
+        cache = HabitatNetworkEngine.Cache(os.path.join(self.pthScratch, "cache"))
+        arrHab, arrCost = RandomLandscape(30, 20, 5)
+        for arr in (arrCost, ~numpy.isnan(arrHab), HabitatNetworkEngine.RegionGroup(arrHab)):
+            key = cache.Key("Test", arr.dtype.name)
+            geo = cache.GetOrMake(key, lambda: HabitatNetworkEngine.GeoArray(arr, 100.0, 200.0, 5.0))
+            geoBack = cache.Get(key)
+            self.assertEqual(geoBack.arr.dtype, arr.dtype)
+            self.assertTrue(SameNaN(geoBack.arr, arr) if arr.dtype.kind == "f" else numpy.array_equal(geoBack.arr, arr))
+            self.assertEqual((geoBack.XMin, geoBack.YMin, geoBack.CellSize), (100.0, 200.0, 5.0))
+        self.assertEqual((cache.nHits, cache.nMisses), (3, 3))
+        # A different parameter or engine version is a different entry
+        key = cache.Key("Test", 1)
+        self.assertNotEqual(key, cache.Key("Test", 2))
+        CacheVersion = HabitatNetworkEngine.CacheVersion
+        HabitatNetworkEngine.CacheVersion = CacheVersion + 1
+        try:
+            self.assertNotEqual(key, cache.Key("Test", 1))
+        finally:
+            HabitatNetworkEngine.CacheVersion = CacheVersion
+        # With no directory nothing is kept
+        cacheNone = HabitatNetworkEngine.Cache(None)
+        cacheNone.Put(key, HabitatNetworkEngine.GeoArray(arrCost, 0.0, 0.0, 1.0))
+        self.assertEqual(cacheNone.Get(key), None)
+
+    def test_evicts_least_recently_used(self):
+        pthCache = os.path.join(self.pthScratch, "cache")
+        cache = HabitatNetworkEngine.Cache(pthCache, MaxBytes=10 ** 9)
+        geo = HabitatNetworkEngine.GeoArray(numpy.zeros((100, 100)), 0.0, 0.0, 1.0)
+        for i, key in enumerate("abc"):
+            cache.Put(key, geo)
+            os.utime(os.path.join(pthCache, key + ".npz"), (1000000 + i, 1000000 + i))
+        cache.Get("a")
+        # Each entry is just over 80000 bytes, so only two fit
+        cache.MaxBytes = 2 * 81000
+        cache.Evict()
+        self.assertEqual(sorted(os.listdir(pthCache)), ["a.npz", "c.npz"])
+
+
+def _BurnCpu(Seconds):
+    """Keeps a CPU busy for about Seconds of CPU time. Returns the CPU time taken."""
+    Start = HabitatNetworkInstrument.CpuTime()
+    while HabitatNetworkInstrument.CpuTime() - Start < Seconds:
+        sum(range(10000))
+    return HabitatNetworkInstrument.CpuTime() - Start
+
+
+class TestInstrument(unittest.TestCase):
+    def setUp(self):
+        self.pthScratch = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.pthScratch, ignore_errors=True)
+
+    def test_stage_times_and_report(self):
+        instrument = HabitatNetworkInstrument.Instrument(True, WorkerCpu=HabitatNetworkEngine.WorkerCpuTime)
+        with instrument.Stage("Busy") as stage:
+            _BurnCpu(0.2)
+            stage.Outputs(numpy.arange(12, dtype=numpy.uint16).reshape(3, 4))
+        with instrument.Stage("Sleep"):
+            time.sleep(0.2)
+        pool = HabitatNetworkEngine.multiprocessing.Pool(2)
+        try:
+            with instrument.Stage("Workers"):
+                lWorker = HabitatNetworkEngine._Map(_BurnCpu, [0.1] * 4, pool)
+        finally:
+            pool.close()
+            pool.join()
+        dicBusy, dicSleep, dicWorkers = instrument.lStages
+        # CPU time is the process's own, not the wall time, and the workers' is counted apart
+        self.assertTrue(dicBusy["CPU"] >= 0.19)
+        self.assertTrue(dicSleep["Wall"] >= 0.19 and dicSleep["CPU"] < 0.1)
+        self.assertTrue(abs(dicWorkers["WorkerCPU"] - sum(lWorker)) < 0.05 and dicWorkers["CPU"] < dicWorkers["WorkerCPU"])
+        self.assertEqual(dicBusy["Outputs"], [{"Shape": [3, 4], "DType": "uint16", "Labels": 11}])
+
+        dicReport = instrument.Report(os.path.join(self.pthScratch, "report.json"))
+        self.assertEqual([dicStage["Stage"] for dicStage in dicReport["Stages"]], ["Busy", "Sleep", "Workers"])
+        self.assertTrue(abs(dicReport["Totals"]["WorkerCPU"] - sum(lWorker)) < 0.05)
+        self.assertTrue(os.path.exists(os.path.join(self.pthScratch, "report.json")))
+
+    def test_peak_memory(self):
+        if HabitatNetworkInstrument.PeakRss() is None:
+            self.skipTest("peak memory cannot be measured on this platform")
+        instrument = HabitatNetworkInstrument.Instrument(True)
+        with instrument.Stage("Big"):
+            arrBig = numpy.ones(50 * 1024 ** 2 // 8)
+            del arrBig
+        dicStage = instrument.lStages[0]
+        self.assertTrue(dicStage["ProcessPeakRssBytes"] >= 50 * 1024 ** 2)
+        if HabitatNetworkInstrument.ResetPeakRss():
+            self.assertEqual(dicStage["PeakRssBytes"], dicStage["ProcessPeakRssBytes"])
+        # Where the peak cannot be reset, each stage's own peak is given as unavailable
+        ResetPeakRss = HabitatNetworkInstrument.ResetPeakRss
+        HabitatNetworkInstrument.ResetPeakRss = lambda: False
+        try:
+            with instrument.Stage("Small"):
+                pass
+        finally:
+            HabitatNetworkInstrument.ResetPeakRss = ResetPeakRss
+        self.assertEqual(instrument.lStages[1]["PeakRssBytes"], None)
+        self.assertTrue("PeakRssBytes" in instrument.Report(os.path.join(self.pthScratch, "report.json"))["Unavailable"])
+
+
+
+if __name__ == "__main__":
+    unittest.main()